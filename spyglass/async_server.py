@@ -0,0 +1,379 @@
+import asyncio
+import io
+import os
+
+from http import HTTPStatus
+from http.client import parse_headers
+
+from spyglass import logger
+from spyglass.fmp4 import Fmp4Stream
+from spyglass.snapshot_variants import parse_variant
+from spyglass.frame_buffer import FrameQueue, FrameRateLimiter
+from spyglass.server import (FMP4_QUEUE_LENGTH, FRAME_TIMEOUT, KEEP_ALIVE_TIMEOUT, POST_HANDLERS, UNIX_SOCKET_MODE,
+                             create_routes, get_content_length, get_controls_content, get_controls_json,
+                             get_metrics_content, get_snapshot_headers, get_stream_fps, get_timelapse_json,
+                             is_not_modified, remove_stale_socket)
+
+# Clients with more than this many bytes pending in their socket buffer skip frames
+WRITE_BUFFER_LIMIT = 1024 * 1024
+
+
+class AsyncStreamingServer:
+    """Serves stream, snapshot, metrics and controls from a single asyncio event loop.
+
+    One broadcast task per frame buffer waits for its new frames and writes
+    every frame to all connected stream clients, instead of one thread per viewer.
+    Frame buffers wake the waiting tasks, so a stalled camera holds no threads.
+    Slow clients skip frames instead of holding up the others.
+    """
+    def __init__(self,
+                 server_address,
+                 cameras,
+                 snapshot_max_age=1.0,
+                 unix_socket=None):
+        # Either address may be None to listen on the other one only
+        self.server_address = server_address
+        self.unix_socket = unix_socket
+        self.cameras = cameras
+        self.routes = create_routes(cameras)
+        self.snapshot_max_age = snapshot_max_age
+        # Maps the writer of every stream client of a frame buffer to its client metrics and rate limiter
+        self.stream_writers = {
+            frame_buffer: {} for camera in cameras for frame_buffer in camera.frame_buffers()
+            if frame_buffer is not camera.h264_frame_buffer
+        }
+        # Maps the writer of every fMP4 client of an H.264 frame buffer to its client metrics and stream
+        self.fmp4_writers = {
+            camera.h264_frame_buffer: {} for camera in cameras if camera.h264_frame_buffer is not None
+        }
+        self.server = None
+        self.unix_server = None
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        await self.start()
+        servers = [s for s in (self.server, self.unix_server) if s is not None]
+        try:
+            await asyncio.gather(*(s.serve_forever() for s in servers))
+        finally:
+            for s in servers:
+                s.close()
+            if self.unix_server is not None:
+                remove_stale_socket(self.unix_socket)
+
+    async def start(self):
+        if self.server_address is not None:
+            host, port = self.server_address
+            self.server = await asyncio.start_server(self.handle_client, host, port, reuse_address=True)
+            self.server_address = self.server.sockets[0].getsockname()[:2]
+        if self.unix_socket is not None:
+            remove_stale_socket(self.unix_socket)
+            self.unix_server = await asyncio.start_unix_server(self.handle_client, self.unix_socket)
+            os.chmod(self.unix_socket, UNIX_SOCKET_MODE)
+        for frame_buffer in self.stream_writers:
+            asyncio.get_running_loop().create_task(self.broadcast_frames(frame_buffer))
+        for frame_buffer in self.fmp4_writers:
+            asyncio.get_running_loop().create_task(self.broadcast_fmp4_fragments(frame_buffer))
+
+    async def broadcast_frames(self, frame_buffer):
+        stream_writers = self.stream_writers[frame_buffer]
+        metrics = frame_buffer.metrics
+        sequence = 0
+        while True:
+            # Woken by the frame buffer, waiting must not take a thread of the executor
+            frame = await frame_buffer.wait_frame(sequence)
+            sequence = frame.sequence
+            for writer, (client, rate_limiter) in list(stream_writers.items()):
+                if writer.is_closing():
+                    continue
+                if rate_limiter is not None and not rate_limiter.accept(frame):
+                    continue
+                if writer.transport.get_write_buffer_size() < WRITE_BUFFER_LIMIT:
+                    writer.writelines(frame.part)
+                    metrics.record_sent_frame(client, frame, sum(len(b) for b in frame.part), client.frames_dropped)
+                else:
+                    client.frames_dropped += 1
+
+    async def broadcast_fmp4_fragments(self, frame_buffer):
+        # Unlike JPEG frames, every H.264 frame is needed to decode the following ones
+        fmp4_writers = self.fmp4_writers[frame_buffer]
+        metrics = frame_buffer.metrics
+        with FrameQueue(frame_buffer, maxlen=FMP4_QUEUE_LENGTH) as frame_queue:
+            dropped = 0
+            while True:
+                frame = await frame_queue.wait()
+                if frame is None:
+                    continue
+                resync = frame_queue.dropped != dropped
+                dropped = frame_queue.dropped
+                for writer, (client, stream) in list(fmp4_writers.items()):
+                    if writer.is_closing():
+                        continue
+                    if resync or writer.transport.get_write_buffer_size() >= WRITE_BUFFER_LIMIT:
+                        client.frames_dropped += 1
+                        stream.resync()
+                        continue
+                    buffers = stream.get_buffers(frame)
+                    if buffers:
+                        writer.writelines(buffers)
+                        metrics.record_sent_frame(client, frame, sum(len(b) for b in buffers), client.frames_dropped)
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    # Client closed or left the persistent connection idle
+                    break
+                request_line, header_lines = request.split(b'\r\n', 1)
+                request_line = request_line.decode('iso-8859-1').split()
+                headers = parse_headers(io.BytesIO(header_lines))
+                if len(request_line) != 3:
+                    self.send_error(writer, HTTPStatus.BAD_REQUEST)
+                    keep_alive = False
+                elif request_line[0] == 'GET':
+                    keep_alive = is_keep_alive(request_line[2], headers)
+                    keep_alive = await self.do_GET(reader, writer, request_line[1], headers) and keep_alive
+                elif request_line[0] == 'POST':
+                    keep_alive = is_keep_alive(request_line[2], headers)
+                    keep_alive = await self.do_POST(reader, writer, request_line[1], headers) and keep_alive
+                else:
+                    self.send_error(writer, HTTPStatus.NOT_IMPLEMENTED)
+                    keep_alive = False
+                await writer.drain()
+        except Exception as e:
+            logger.warning('Removed client %s: %s', client_address, str(e))
+        finally:
+            writer.close()
+
+    async def do_GET(self, reader, writer, path, headers):
+        """Send the response to a GET request, returns whether the connection can be kept open."""
+        route = self.routes.match(path)
+        if route is None:
+            self.send_error(writer, HTTPStatus.NOT_FOUND)
+            return False
+        kind, camera, frame_buffer = route
+        if kind == 'stream':
+            await self.start_streaming(frame_buffer, reader, writer, path)
+            return False
+        elif kind == 'fmp4':
+            await self.start_fmp4_streaming(frame_buffer, reader, writer)
+            return False
+        elif kind == 'snapshot':
+            return await self.send_snapshot(frame_buffer, writer, path, headers)
+        elif kind == 'metrics':
+            self.send_metrics(camera, writer, path)
+        elif kind == 'timelapse_api':
+            self.send_json(writer, get_timelapse_json(camera))
+        elif kind == 'motion':
+            self.send_json(writer, camera.motion.to_json())
+        elif kind in ('controls', 'controls_api'):
+            try:
+                if kind == 'controls':
+                    self.send_controls(camera, writer, path)
+                else:
+                    self.send_json(writer, get_controls_json(camera, path))
+            except ValueError:
+                self.send_error(writer, HTTPStatus.BAD_REQUEST)
+                return False
+        else:
+            self.send_error(writer, HTTPStatus.METHOD_NOT_ALLOWED)
+            return False
+        return True
+
+    async def do_POST(self, reader, writer, path, headers):
+        """Send the response to a POST request, returns whether the connection can be kept open."""
+        route = self.routes.match(path)
+        if route is None:
+            self.send_error(writer, HTTPStatus.NOT_FOUND)
+            return False
+        kind, camera, _ = route
+        if kind not in POST_HANDLERS:
+            self.send_error(writer, HTTPStatus.METHOD_NOT_ALLOWED)
+            return False
+        length = headers.get('Content-Length')
+        if length is None:
+            self.send_error(writer, HTTPStatus.LENGTH_REQUIRED)
+            return False
+        try:
+            length = get_content_length(length)
+        except ValueError:
+            self.send_error(writer, HTTPStatus.BAD_REQUEST)
+            return False
+        body = await reader.readexactly(length)
+        try:
+            # Reconfiguring restarts the camera, which must not block the event loop
+            content = await asyncio.get_running_loop().run_in_executor(None, POST_HANDLERS[kind], camera, body)
+        except ValueError:
+            self.send_error(writer, HTTPStatus.BAD_REQUEST)
+            return False
+        self.send_json(writer, content)
+        return True
+
+    async def start_streaming(self, frame_buffer, reader, writer, path):
+        try:
+            fps = get_stream_fps(path)
+        except ValueError:
+            self.send_error(writer, HTTPStatus.BAD_REQUEST)
+            return
+        if not await self.acquire(frame_buffer, writer):
+            return
+        try:
+            if not await self.wait_first_frame(frame_buffer, writer):
+                return
+            self.send_response(writer, HTTPStatus.OK, self.default_headers() + [
+                ('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME'),
+                ('Connection', 'close')
+            ])
+            stream_writers = self.stream_writers[frame_buffer]
+            client_address = writer.get_extra_info('peername')
+            with frame_buffer.metrics.stream_client(client_address) as client:
+                stream_writers[writer] = (client, FrameRateLimiter(fps) if fps else None)
+                try:
+                    # Frames are written by broadcast_frames, wait here until the client disconnects
+                    while await reader.read(1024):
+                        pass
+                finally:
+                    del stream_writers[writer]
+                    logger.info('Removed streaming client %s (%d frames dropped)',
+                                client_address, client.frames_dropped)
+        finally:
+            frame_buffer.release()
+
+    async def start_fmp4_streaming(self, frame_buffer, reader, writer):
+        if not await self.acquire(frame_buffer, writer):
+            return
+        try:
+            if not await self.wait_first_frame(frame_buffer, writer):
+                return
+            self.send_response(writer, HTTPStatus.OK, self.default_headers() + [
+                ('Content-Type', 'video/mp4'),
+                ('Connection', 'close')
+            ])
+            fmp4_writers = self.fmp4_writers[frame_buffer]
+            client_address = writer.get_extra_info('peername')
+            with frame_buffer.metrics.stream_client(client_address) as client:
+                fmp4_writers[writer] = (client, Fmp4Stream())
+                try:
+                    # Fragments are written by broadcast_frames, wait here until the client disconnects
+                    while await reader.read(1024):
+                        pass
+                finally:
+                    del fmp4_writers[writer]
+                    logger.info('Removed fMP4 streaming client %s (%d frames dropped)',
+                                client_address, client.frames_dropped)
+        finally:
+            frame_buffer.release()
+
+    async def send_snapshot(self, frame_buffer, writer, path, headers):
+        loop = asyncio.get_running_loop()
+        try:
+            variant = parse_variant(path)
+        except ValueError:
+            self.send_error(writer, HTTPStatus.BAD_REQUEST)
+            return False
+        if not await self.acquire(frame_buffer, writer):
+            return False
+        try:
+            with frame_buffer.metrics.snapshot_client():
+                frame = await frame_buffer.wait_fresh_frame(self.snapshot_max_age, FRAME_TIMEOUT)
+                if frame is None:
+                    self.send_error(writer, HTTPStatus.SERVICE_UNAVAILABLE)
+                    return False
+                if is_not_modified(headers, frame, variant):
+                    self.send_response(writer, HTTPStatus.NOT_MODIFIED, get_snapshot_headers(frame, variant))
+                    return True
+                if variant is not None:
+                    try:
+                        frame = await loop.run_in_executor(None, frame_buffer.variants.get, frame, variant)
+                    except ValueError:
+                        self.send_error(writer, HTTPStatus.BAD_REQUEST)
+                        return False
+                self.send_response(writer, HTTPStatus.OK, get_snapshot_headers(frame, variant) + [
+                    ('Content-Type', 'image/jpeg'),
+                    ('Content-Length', frame.length)
+                ])
+                writer.writelines(frame.jpeg)
+                await writer.drain()
+                return True
+        finally:
+            frame_buffer.release()
+
+    async def acquire(self, frame_buffer, writer):
+        """Start a camera started on demand, answers with 503 and returns ``False`` if it fails to start."""
+        # Only starting a camera on demand blocks
+        if frame_buffer.on_demand is None:
+            return True
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, frame_buffer.acquire)
+        except Exception as e:
+            logger.error('Failed to start camera: %s', e)
+            self.send_error(writer, HTTPStatus.SERVICE_UNAVAILABLE)
+            return False
+        return True
+
+    async def wait_first_frame(self, frame_buffer, writer):
+        """Wait for a frame before starting a stream, answers with 503 and returns ``False`` if there is none."""
+        if await frame_buffer.wait_frame(0, FRAME_TIMEOUT) is None:
+            self.send_error(writer, HTTPStatus.SERVICE_UNAVAILABLE)
+            return False
+        return True
+
+    def send_metrics(self, camera, writer, path):
+        content_type, content = get_metrics_content(camera, path)
+        self.send_response(writer, HTTPStatus.OK, [
+            ('Content-Type', content_type),
+            ('Content-Length', len(content))
+        ])
+        writer.write(content)
+
+    def send_controls(self, camera, writer, path):
+        content = get_controls_content(camera, path)
+        self.send_response(writer, HTTPStatus.OK, [
+            ('Content-Type', 'text/html'),
+            ('Content-Length', len(content))
+        ])
+        writer.write(content)
+
+    def send_json(self, writer, content):
+        self.send_response(writer, HTTPStatus.OK, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', len(content))
+        ])
+        writer.write(content)
+
+    def default_headers(self):
+        return [
+            ('Age', 0),
+            ('Cache-Control', 'no-cache, private'),
+            ('Pragma', 'no-cache')
+        ]
+
+    def send_response(self, writer, status, headers):
+        lines = [f'HTTP/1.1 {status.value} {status.phrase}']
+        lines += [f'{key}: {value}' for key, value in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1'))
+
+    def send_error(self, writer, status):
+        content = f'{status.value} {status.phrase}'.encode('utf-8')
+        self.send_response(writer, status, [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', len(content)),
+            ('Connection', 'close')
+        ])
+        writer.write(content)
+
+
+def is_keep_alive(version, headers):
+    """Check if the client of a request expects the connection to stay open, like ``BaseHTTPRequestHandler``."""
+    connection = headers.get('Connection', '').lower()
+    if connection == 'close':
+        return False
+    if connection == 'keep-alive':
+        return True
+    return version >= 'HTTP/1.1'
@@ -0,0 +1,279 @@
+"""Load test of the streaming server with a synthetic camera.
+
+Starts spyglass with the ``Synthetic`` camera in a child process and connects
+concurrent stream and snapshot clients to it. Reports the framerate and latency
+seen by the clients and the CPU, memory and context switches of the server,
+including its child processes like the capture process.
+
+    python -m spyglass.benchmark --stream_clients 20 --snapshot_clients 2 --duration 10
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import re
+import socket
+import time
+
+from spyglass.camera.process import ProcessCamera
+from spyglass.camera.synthetic import Synthetic, read_timestamp
+from spyglass.cli import install_terminate_handler
+
+CONTENT_LENGTH = re.compile(rb'Content-Length: (\d+)', re.IGNORECASE)
+# Seconds the terminated server has to stop its camera before it is killed
+SERVER_STOP_TIMEOUT = 10
+
+
+class ClientStats:
+    def __init__(self):
+        self.frames = 0
+        self.latencies = []
+        self.errors = 0
+
+
+def run_server(port, width, height, fps, server_mode, image_files, capture_process=False):
+    # Stopping the benchmark terminates the server, the camera must still be stopped to free its shared memory
+    install_terminate_handler()
+    if capture_process:
+        cam = ProcessCamera(fake=True, image_files=image_files)
+        cam.configure(width, height, fps, 'continuous', 0.0, 'normal')
+    else:
+        cam = Synthetic(image_files)
+        cam.configure(width, height, fps)
+    try:
+        cam.start_and_run_server('127.0.0.1', port, server_mode=server_mode)
+    finally:
+        cam.stop()
+
+
+async def stream_client(port, stats, stop_time):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(b'GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        await reader.readuntil(b'\r\n\r\n')
+        while time.monotonic() < stop_time:
+            headers = await reader.readuntil(b'\r\n\r\n')
+            length = int(CONTENT_LENGTH.search(headers).group(1))
+            jpeg = await reader.readexactly(length + 2)
+            timestamp = read_timestamp(jpeg)
+            if timestamp is not None:
+                stats.latencies.append(time.time() - timestamp)
+            stats.frames += 1
+    finally:
+        writer.close()
+
+
+async def snapshot_client(port, stats, stop_time, interval):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.monotonic() < stop_time:
+            start = time.monotonic()
+            # Polls on a persistent connection, like Moonraker and timelapse tools
+            writer.write(b'GET /snapshot HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            headers = await reader.readuntil(b'\r\n\r\n')
+            length = int(CONTENT_LENGTH.search(headers).group(1))
+            await reader.readexactly(length)
+            if headers.startswith(b'HTTP/1.1 200'):
+                stats.latencies.append(time.monotonic() - start)
+                stats.frames += 1
+            else:
+                stats.errors += 1
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
+    finally:
+        writer.close()
+
+
+async def run_clients(port, stream_clients, snapshot_clients, duration, snapshot_interval, pid):
+    stop_time = time.monotonic() + duration
+    stream_stats = [ClientStats() for _ in range(stream_clients)]
+    snapshot_stats = [ClientStats() for _ in range(snapshot_clients)]
+    tasks = [stream_client(port, stats, stop_time) for stats in stream_stats]
+    tasks += [snapshot_client(port, stats, stop_time, snapshot_interval) for stats in snapshot_stats]
+    before = read_process_stats(pid)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    after = read_process_stats(pid)
+    for stats, result in zip(stream_stats + snapshot_stats, results):
+        if isinstance(result, Exception):
+            stats.errors += 1
+    return stream_stats, snapshot_stats, before, after
+
+
+def read_process_stats(pid):
+    """Return CPU seconds, RSS in bytes and context switches of a process and its descendants from ``/proc``.
+
+    The RSS of the processes is summed up, so pages shared between them are counted once per process.
+    """
+    stats = {'time': time.monotonic(), 'cpu': 0.0, 'rss': 0, 'context_switches': 0, 'processes': 0}
+    for process in get_process_tree(pid):
+        try:
+            with open(f'/proc/{process}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            tasks = os.listdir(f'/proc/{process}/task')
+        except FileNotFoundError:
+            # The process exited meanwhile
+            continue
+        stats['cpu'] += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        stats['rss'] += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        stats['processes'] += 1
+        for task in tasks:
+            try:
+                with open(f'/proc/{process}/task/{task}/status') as f:
+                    for line in f:
+                        if line.startswith(('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches')):
+                            stats['context_switches'] += int(line.split()[-1])
+            except FileNotFoundError:
+                pass
+    return stats
+
+
+def get_process_tree(pid):
+    """Return ``pid`` and the pids of all its descendants."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    pids = [pid]
+    for process in pids:
+        pids += children.get(process, [])
+    return pids
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def find_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(port, timeout):
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'Server did not start within {timeout}s')
+
+
+def run_benchmark(stream_clients=10,
+                  snapshot_clients=2,
+                  duration=10.0,
+                  snapshot_interval=0.5,
+                  width=640,
+                  height=480,
+                  fps=30,
+                  server_mode='threaded',
+                  image_files=None,
+                  capture_process=False):
+    port = find_free_port()
+    server = multiprocessing.Process(
+        target=run_server,
+        args=(port, width, height, fps, server_mode, image_files, capture_process),
+        # Daemonic processes can not start the capture process
+        daemon=not capture_process)
+    server.start()
+    try:
+        wait_for_server(port, 30)
+        stream_stats, snapshot_stats, before, after = asyncio.run(run_clients(
+            port, stream_clients, snapshot_clients, duration, snapshot_interval, server.pid))
+    finally:
+        server.terminate()
+        server.join(SERVER_STOP_TIMEOUT)
+        if server.is_alive():
+            server.kill()
+            server.join()
+
+    elapsed = after['time'] - before['time']
+    return {
+        'server_mode': server_mode,
+        'capture_process': capture_process,
+        'duration': elapsed,
+        'stream_fps': [stats.frames / elapsed for stats in stream_stats],
+        'stream_errors': [stats.errors for stats in stream_stats],
+        'stream_latencies': [latency for stats in stream_stats for latency in stats.latencies],
+        'snapshots': sum(stats.frames for stats in snapshot_stats),
+        'snapshot_latencies': [latency for stats in snapshot_stats for latency in stats.latencies],
+        'snapshot_errors': [stats.errors for stats in snapshot_stats],
+        'errors': sum(stats.errors for stats in stream_stats + snapshot_stats),
+        'cpu_percent': 100 * (after['cpu'] - before['cpu']) / elapsed,
+        'rss': after['rss'],
+        'processes': after['processes'],
+        'context_switches_per_second': (after['context_switches'] - before['context_switches']) / elapsed,
+    }
+
+
+def print_report(results):
+    def latency_str(latencies):
+        return ' / '.join(f'{1000 * percentile(latencies, p):.1f}' for p in (50, 90, 99))
+
+    stream_fps = results['stream_fps'] or [0.0]
+    print(f"Server mode:                 {results['server_mode']}")
+    print(f"Capture process:             {results['capture_process']}")
+    print(f"Stream clients:              {len(results['stream_fps'])}")
+    print(f"Stream fps min / avg / max:  {min(stream_fps):.1f} / "
+          f"{sum(stream_fps) / len(stream_fps):.1f} / {max(stream_fps):.1f}")
+    print(f"Stream latency p50/p90/p99:  {latency_str(results['stream_latencies'])} ms")
+    # Slowest clients first, a single stalled client is hidden by the averages
+    clients = sorted(enumerate(zip(results['stream_fps'], results['stream_errors'])), key=lambda client: client[1][0])
+    for number, (fps, errors) in clients:
+        print(f"  Stream client {number + 1:<3}        {fps:.1f} fps, {errors} errors")
+    print(f"Snapshots:                   {results['snapshots']}")
+    print(f"Snapshot latency p50/p90/p99: {latency_str(results['snapshot_latencies'])} ms")
+    for number, errors in enumerate(results['snapshot_errors']):
+        print(f"  Snapshot client {number + 1:<3}      {errors} errors")
+    print(f"Client errors:               {results['errors']}")
+    print(f"Server processes:            {results['processes']}")
+    print(f"Server CPU:                  {results['cpu_percent']:.1f} %")
+    print(f"Server RSS:                  {results['rss'] / 1024 / 1024:.1f} MiB")
+    print(f"Context switches/s:          {results['context_switches_per_second']:.0f}")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='spyglass.benchmark',
+        description='Load test the spyglass server with a synthetic camera.')
+    parser.add_argument('-c', '--stream_clients', type=int, default=10, help='Number of concurrent stream clients')
+    parser.add_argument('-s', '--snapshot_clients', type=int, default=2,
+                        help='Number of concurrent snapshot clients')
+    parser.add_argument('-si', '--snapshot_interval', type=float, default=0.5,
+                        help='Seconds between requests of a snapshot client')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='Duration of the test in seconds')
+    parser.add_argument('-r', '--resolution', type=str, default='640x480', help='Resolution of generated frames')
+    parser.add_argument('-f', '--fps', type=int, default=30, help='Frames per second of the synthetic camera')
+    parser.add_argument('-sm', '--server_mode', type=str, default='threaded', choices=['threaded', 'asyncio'],
+                        help='Server mode to test')
+    parser.add_argument('-cp', '--capture_process', action='store_true',
+                        help='Produce frames in a separate process like spyglass --capture_process')
+    parser.add_argument('-i', '--images', type=str, nargs='*', default=None,
+                        help='JPEG files to stream instead of generated frames')
+    parsed_args = parser.parse_args(args)
+    width, height = [int(v) for v in parsed_args.resolution.split('x')]
+    print_report(run_benchmark(
+        stream_clients=parsed_args.stream_clients,
+        snapshot_clients=parsed_args.snapshot_clients,
+        duration=parsed_args.duration,
+        snapshot_interval=parsed_args.snapshot_interval,
+        width=width,
+        height=height,
+        fps=parsed_args.fps,
+        server_mode=parsed_args.server_mode,
+        image_files=parsed_args.images,
+        capture_process=parsed_args.capture_process))
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,5 +1,3 @@
-from picamera2 import Picamera2
-
 from spyglass.camera.camera import Camera
 from spyglass.camera.csi import CSI
 from spyglass.camera.usb import USB
@@ -9,6 +7,8 @@ def init_camera(
         tuning_filter=None,
         tuning_filter_dir=None
         ) -> Camera:
+    from picamera2 import Picamera2
+
     tuning = None
 
     if tuning_filter:
@@ -1,18 +1,42 @@
-import libcamera
-
 from abc import ABC, abstractmethod
-from picamera2 import Picamera2
+from contextlib import nullcontext
+from threading import Lock, Thread
 
 from spyglass import logger
-from spyglass.exif import create_exif_header
-from spyglass.camera_options import process_controls
-from spyglass.server import StreamingServer, StreamingHandler
+from spyglass.camera.on_demand import OnDemand
+from spyglass.camera_options import CameraControls
+from spyglass.exif import option_to_exif_orientation
+from spyglass.frame_buffer import FrameBuffer
+from spyglass.h264 import H264FrameBuffer
+from spyglass.motion import MotionDetector, get_motion_size
+from spyglass.recording import ClipRecorder
+from spyglass.timelapse import Timelapse
+from spyglass.server import CameraEndpoints, StreamingServer, StreamingHandler, UnixStreamingServer, create_routes
+
+# Settings of a running camera that can be changed with Camera.reconfigure
+SIZE_SETTINGS = ('width', 'height', 'fps')
+TRANSFORM_SETTINGS = ('upsidedown', 'flip_horizontal', 'flip_vertical')
 
 class Camera(ABC):
-    def __init__(self, picam2: Picamera2):
+    def __init__(self, picam2):
         self.picam2 = picam2
+        self.frame_buffer = FrameBuffer()
+        self.lores_frame_buffer = None
+        self.h264_frame_buffer = None
+        self.recorder = None
+        self.timelapse = None
+        self.motion_detector = None
+        # Size of the luma frames of the motion detector
+        self.motion_size = None
+        self.controls = CameraControls(picam2)
+        # Arguments of the last configure call, see reconfigure
+        self.settings = {}
+        self.orientation_exif = 0
+        self.reconfigure_lock = Lock()
 
     def create_controls(self, fps: int, autofocus: str, lens_position: float, autofocus_speed: str):
+        import libcamera
+
         controls = {}
 
         if 'FrameRate' in self.picam2.camera_controls:
@@ -38,57 +62,295 @@ class Camera(ABC):
                   control_list: list[list[str]]=[],
                   upsidedown=False,
                   flip_horizontal=False,
-                  flip_vertical=False):
+                  flip_vertical=False,
+                  lores_size=None,
+                  h264=False,
+                  h264_bitrate=None):
+        import libcamera
+
+        self.settings = {
+            'width': width,
+            'height': height,
+            'fps': fps,
+            'autofocus': autofocus,
+            'lens_position': lens_position,
+            'autofocus_speed': autofocus_speed,
+            'control_list': control_list,
+            'upsidedown': upsidedown,
+            'flip_horizontal': flip_horizontal,
+            'flip_vertical': flip_vertical,
+            'lores_size': lores_size,
+            'h264': h264,
+            'h264_bitrate': h264_bitrate
+        }
         controls = self.create_controls(fps, autofocus, lens_position, autofocus_speed)
-        c = process_controls(self.picam2, [tuple(ctrl) for ctrl in control_list])
-        controls.update(c)
+        controls.update(self.controls.schema.convert(
+            [tuple(ctrl) for ctrl in control_list], ignore_unknown=True))
+        self.controls.set_initial_values(controls)
 
         transform = libcamera.Transform(
             hflip=int(flip_horizontal or upsidedown),
             vflip=int(flip_vertical or upsidedown)
         )
 
+        lores = None
+        if lores_size:
+            lores = {'size': lores_size}
+            if self.lores_frame_buffer is None:
+                self.lores_frame_buffer = FrameBuffer()
+                self.lores_frame_buffer.motion = self.motion_detector
+        if self.motion_detector is not None:
+            # The motion detector reads the Y plane of the YUV420 lores stream
+            self.motion_size = lores_size or get_motion_size(width, height)
+            lores = {'size': self.motion_size}
+        if h264 and self.h264_frame_buffer is None:
+            self.h264_frame_buffer = H264FrameBuffer()
+
         self.picam2.configure(
             self.picam2.create_video_configuration(
                 main={'size': (width, height)},
+                lores=lores,
                 controls=controls,
                 transform=transform
             )
         )
 
-    def _run_server(self,
-                    bind_address,
-                    port,
-                    streaming_handler: StreamingHandler,
-                    get_frame,
-                    stream_url='/stream',
-                    snapshot_url='/snapshot',
-                    orientation_exif=0):
-        logger.info('Server listening on %s:%d', bind_address, port)
-        logger.info('Streaming endpoint: %s', stream_url)
-        logger.info('Snapshot endpoint: %s', snapshot_url)
-        logger.info('Controls endpoint: %s', '/controls')
-        address = (bind_address, port)
-        streaming_handler.picam2 = self.picam2
-        streaming_handler.get_frame = get_frame
-        streaming_handler.stream_url = stream_url
-        streaming_handler.snapshot_url = snapshot_url
-        if orientation_exif > 0:
-            streaming_handler.exif_header = create_exif_header(orientation_exif)
-        else:
-            streaming_handler.exif_header = None
-        current_server = StreamingServer(address, streaming_handler)
-        current_server.serve_forever()
-
-    @abstractmethod
     def start_and_run_server(self,
             bind_address,
             port,
             stream_url='/stream',
             snapshot_url='/snapshot',
-            orientation_exif=0):
+            orientation_exif=0,
+            snapshot_max_age=1.0,
+            server_mode='threaded',
+            lores_stream_url='/lores/stream',
+            lores_snapshot_url='/lores/snapshot',
+            idle_timeout=None,
+            unix_socket=None,
+            tcp=True,
+            h264_stream_url='/stream.mp4'):
+        if idle_timeout is None:
+            self.start(orientation_exif)
+        else:
+            self.start_on_demand(orientation_exif, idle_timeout)
+        run_server(
+            {'': self},
+            bind_address,
+            port,
+            stream_url=stream_url,
+            snapshot_url=snapshot_url,
+            snapshot_max_age=snapshot_max_age,
+            server_mode=server_mode,
+            lores_stream_url=lores_stream_url,
+            lores_snapshot_url=lores_snapshot_url,
+            unix_socket=unix_socket,
+            tcp=tcp,
+            h264_stream_url=h264_stream_url
+        )
+
+    def enable_motion_detection(self, fps, threshold):
+        """Detect motion in the lores stream at ``fps``, must be called before ``configure``."""
+        if self.motion_detector is None:
+            self.motion_detector = MotionDetector(fps, threshold)
+            self.frame_buffer.motion = self.motion_detector
+
+    def enable_recording(self, directory, seconds, max_bytes):
+        """Keep the last ``seconds`` of the stream in memory to save them as clip into ``directory`` on request."""
+        if self.recorder is None:
+            self.recorder = ClipRecorder(self.frame_buffer, directory, seconds, max_bytes)
+
+    def enable_timelapse(self, directory):
+        """Allow timelapse jobs writing their frames into subdirectories of ``directory``."""
+        if self.timelapse is None:
+            self.timelapse = Timelapse(self.frame_buffer, directory)
+
+    def start_on_demand(self, orientation_exif=0, idle_timeout=30.0):
+        """Start the camera with its first client and stop it ``idle_timeout`` seconds after the last one."""
+        self.orientation_exif = orientation_exif
+        on_demand = OnDemand(
+            lambda: self.start(self.orientation_exif),
+            self._stop_idle,
+            idle_timeout,
+            self.frame_buffer.metrics
+        )
+        for frame_buffer in self.frame_buffers():
+            frame_buffer.on_demand = on_demand
+
+    def reconfigure(self, changes):
+        """Change resolution, framerate, transform or EXIF orientation while the server keeps running.
+
+        The camera is stopped, configured with the changed settings and started again, its frame
+        buffers and their clients stay and resume with the next frame. A camera started on demand
+        that is not running is only configured. Returns the changed settings, raises ``ValueError``
+        for invalid settings.
+        """
+        changes = parse_settings(changes)
+        with self.reconfigure_lock:
+            current = {**self.settings, 'orientation_exif': self.orientation_exif}
+            changed = {k: v for k, v in changes.items() if current.get(k) != v}
+            if not changed:
+                return changed
+            settings = {k: v for k, v in changed.items() if k != 'orientation_exif'}
+            on_demand = self.frame_buffer.on_demand
+            with on_demand.lock if on_demand is not None else nullcontext():
+                running = on_demand is None or on_demand.running
+                if running:
+                    self._stop_idle()
+                previous_settings = self.settings
+                error = None
+                try:
+                    if settings:
+                        self._configure_keeping_controls({**previous_settings, **settings})
+                        if self.recorder is not None:
+                            # A clip holds frames of a single size
+                            self.recorder.ring.clear()
+                    self.orientation_exif = changed.get('orientation_exif', self.orientation_exif)
+                except Exception as e:
+                    logger.error('Failed to reconfigure camera, restoring previous configuration: %s', e)
+                    error = e
+                try:
+                    if error is not None:
+                        self._configure_keeping_controls(previous_settings)
+                    if running:
+                        self.start(self.orientation_exif)
+                except Exception as e:
+                    logger.error('Failed to restart camera, it stays stopped: %s', e)
+                    if on_demand is not None:
+                        on_demand.mark_stopped()
+                    for frame_buffer in self.frame_buffers():
+                        frame_buffer.clear()
+                    raise ValueError(f'Camera stopped, failed to restart it: {e}') from e
+                if error is not None:
+                    raise ValueError(f'Unsupported configuration: {error}') from error
+            logger.info('Reconfigured camera: %s', changed)
+            return changed
+
+    def _configure_keeping_controls(self, settings):
+        # Controls changed while running stay, the framerate is part of the configuration
+        runtime_values = {k: v for k, v in self.controls.values.items() if k != 'FrameRate'}
+        self.configure(**settings)
+        if runtime_values:
+            self.picam2.set_controls(runtime_values)
+            self.controls.set_initial_values(runtime_values)
+
+    def _stop_idle(self):
+        self.stop()
+        if self.motion_detector is not None:
+            self.motion_detector.reset()
+        for frame_buffer in self.frame_buffers():
+            frame_buffer.clear()
+
+    def frame_buffers(self):
+        return [fb for fb in (self.frame_buffer, self.lores_frame_buffer, self.h264_frame_buffer) if fb is not None]
+
+    @abstractmethod
+    def start(self, orientation_exif=0):
         pass
 
     @abstractmethod
     def stop(self):
         pass
+
+
+def run_server(cameras,
+               bind_address,
+               port,
+               stream_url='/stream',
+               snapshot_url='/snapshot',
+               snapshot_max_age=1.0,
+               server_mode='threaded',
+               lores_stream_url='/lores/stream',
+               lores_snapshot_url='/lores/snapshot',
+               unix_socket=None,
+               tcp=True,
+               h264_stream_url='/stream.mp4'):
+    """Serve started cameras, given as mapping of URL prefix to camera, from a single server.
+
+    The server listens on ``bind_address`` and ``port`` unless ``tcp`` is false, and on the
+    Unix domain socket ``unix_socket`` if given.
+    """
+    if tcp:
+        logger.info('Server listening on %s:%d', bind_address, port)
+    if unix_socket is not None:
+        logger.info('Server listening on Unix socket %s', unix_socket)
+    endpoints = []
+    for url_prefix, cam in cameras.items():
+        camera_endpoints = CameraEndpoints(
+            cam.picam2,
+            cam.frame_buffer,
+            url_prefix=url_prefix,
+            stream_url=stream_url,
+            snapshot_url=snapshot_url,
+            lores_frame_buffer=cam.lores_frame_buffer,
+            controls=cam.controls,
+            lores_stream_url=lores_stream_url,
+            lores_snapshot_url=lores_snapshot_url,
+            reconfigure=cam.reconfigure,
+            h264_frame_buffer=cam.h264_frame_buffer,
+            h264_stream_url=h264_stream_url,
+            recorder=cam.recorder,
+            timelapse=cam.timelapse,
+            motion=cam.motion_detector
+        )
+        logger.info('Streaming endpoint: %s', camera_endpoints.stream_url)
+        logger.info('Snapshot endpoint: %s', camera_endpoints.snapshot_url)
+        if camera_endpoints.lores_frame_buffer is not None:
+            logger.info('Lores streaming endpoint: %s', camera_endpoints.lores_stream_url)
+            logger.info('Lores snapshot endpoint: %s', camera_endpoints.lores_snapshot_url)
+        if camera_endpoints.h264_frame_buffer is not None:
+            logger.info('H.264 fMP4 streaming endpoint: %s', camera_endpoints.h264_stream_url)
+        logger.info('Controls endpoint: %s', camera_endpoints.controls_url)
+        logger.info('Controls API endpoint: %s', camera_endpoints.controls_api_url)
+        logger.info('Metrics endpoint: %s', camera_endpoints.metrics_url)
+        logger.info('Configuration API endpoint: %s', camera_endpoints.config_api_url)
+        if camera_endpoints.recorder is not None:
+            logger.info('Clip API endpoint: %s', camera_endpoints.clip_api_url)
+        if camera_endpoints.motion is not None:
+            logger.info('Motion endpoint: %s', camera_endpoints.motion_url)
+        if camera_endpoints.timelapse is not None:
+            logger.info('Timelapse API endpoint: %s', camera_endpoints.timelapse_api_url)
+        endpoints.append(camera_endpoints)
+    address = (bind_address, port) if tcp else None
+    if server_mode == 'asyncio':
+        from spyglass.async_server import AsyncStreamingServer
+        AsyncStreamingServer(address, endpoints, snapshot_max_age=snapshot_max_age,
+                             unix_socket=unix_socket).serve_forever()
+        return
+    StreamingHandler.routes = create_routes(endpoints)
+    StreamingHandler.snapshot_max_age = snapshot_max_age
+    servers = []
+    if unix_socket is not None:
+        servers.append(UnixStreamingServer(unix_socket, StreamingHandler))
+    if address is not None:
+        servers.append(StreamingServer(address, StreamingHandler))
+    try:
+        for current_server in servers[:-1]:
+            Thread(target=current_server.serve_forever, daemon=True).start()
+        servers[-1].serve_forever()
+    finally:
+        for current_server in servers:
+            current_server.server_close()
+
+
+def parse_settings(settings):
+    """Check the settings given to ``Camera.reconfigure``, EXIF orientations may be given by option name."""
+    if not isinstance(settings, dict):
+        raise ValueError('Expected settings as object')
+    parsed = {}
+    for name, value in settings.items():
+        if name in SIZE_SETTINGS:
+            if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                raise ValueError(f'{name} must be a positive integer, got {value!r}')
+        elif name in TRANSFORM_SETTINGS:
+            if not isinstance(value, bool):
+                raise ValueError(f'{name} must be a boolean, got {value!r}')
+        elif name == 'orientation_exif':
+            if isinstance(value, str):
+                value = option_to_exif_orientation.get(value, value)
+            if isinstance(value, bool) or value not in option_to_exif_orientation.values():
+                raise ValueError(f'Unknown orientation {value!r}')
+        else:
+            raise ValueError(f'{name} can not be changed while running')
+        parsed[name] = value
+    return parsed
+
@@ -1,46 +1,35 @@
-import io
-
-from picamera2.encoders import MJPEGEncoder
-from picamera2.outputs import FileOutput
-from threading import Condition
+import time
 
 from spyglass import camera
-from spyglass.server import StreamingHandler
+from spyglass.exif import create_exif_header
 
 class CSI(camera.Camera):
-    def start_and_run_server(self,
-            bind_address,
-            port,
-            stream_url='/stream',
-            snapshot_url='/snapshot',
-            orientation_exif=0):
-
-        class StreamingOutput(io.BufferedIOBase):
-            def __init__(self):
-                self.frame = None
-                self.condition = Condition()
-
-            def write(self, buf):
-                with self.condition:
-                    self.frame = buf
-                    self.condition.notify_all()
-        output = StreamingOutput()
-        def get_frame(inner_self):
-            with output.condition:
-                output.condition.wait()
-                return output.frame
-
-        self.picam2.start_recording(MJPEGEncoder(), FileOutput(output))
-
-        self._run_server(
-            bind_address,
-            port,
-            StreamingHandler,
-            get_frame,
-            stream_url=stream_url,
-            snapshot_url=snapshot_url,
-            orientation_exif=orientation_exif
-        )
+    def start(self, orientation_exif=0):
+        from picamera2.encoders import MJPEGEncoder
+        from picamera2.outputs import FileOutput
+
+        self.orientation_exif = orientation_exif
+        self.frame_buffer.exif_header = create_exif_header(orientation_exif)
+        self.picam2.start_recording(MJPEGEncoder(), FileOutput(self.frame_buffer))
+        if self.lores_frame_buffer is not None:
+            # The ISP scales the lores stream, only its encoding costs CPU
+            self.lores_frame_buffer.exif_header = self.frame_buffer.exif_header
+            self.picam2.start_encoder(MJPEGEncoder(), FileOutput(self.lores_frame_buffer), name='lores')
+        if self.h264_frame_buffer is not None:
+            from picamera2.encoders import H264Encoder
+
+            # Parameter sets with every keyframe, new clients start at the next one within a second
+            encoder = H264Encoder(bitrate=self.settings.get('h264_bitrate'), repeat=True,
+                                  iperiod=self.settings.get('fps'))
+            self.picam2.start_encoder(encoder, FileOutput(self.h264_frame_buffer), name='main')
+        if self.motion_detector is not None:
+            self.picam2.post_callback = self._detect_motion
+
+    def _detect_motion(self, request):
+        # Runs for every frame in the camera thread, the lores buffer is only mapped for analyzed frames
+        if self.motion_detector.due(time.time()):
+            width, height = self.motion_size
+            self.motion_detector.update(request.make_array('lores')[:height, :width])
 
     def stop(self):
         self.picam2.stop_recording()
@@ -0,0 +1,67 @@
+from threading import Lock, Timer, current_thread
+
+from spyglass import logger
+
+
+class OnDemand:
+    """Starts a camera for its first client and stops it after ``idle_timeout`` seconds without clients.
+
+    Clients arriving while the camera is started wait in the frame buffer for its first frame.
+    """
+    def __init__(self, start, stop, idle_timeout, metrics):
+        self.start = start
+        self.stop = stop
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics
+        self.lock = Lock()
+        self.clients = 0
+        self.running = False
+        self.stop_timer = None
+
+    def acquire(self):
+        with self.lock:
+            self.clients += 1
+            if self.stop_timer is not None:
+                self.stop_timer.cancel()
+                self.stop_timer = None
+            if not self.running:
+                logger.info('Starting camera for first client')
+                self.metrics.record_camera_start()
+                try:
+                    self.start()
+                except Exception:
+                    self.clients -= 1
+                    self.metrics.record_camera_stop()
+                    raise
+                self.running = True
+
+    def release(self):
+        with self.lock:
+            self.clients -= 1
+            if self.clients == 0 and self.running:
+                self.stop_timer = Timer(self.idle_timeout, self._stop_idle_camera)
+                self.stop_timer.daemon = True
+                self.stop_timer.start()
+
+    def mark_stopped(self):
+        """Record that the camera stopped without ``stop``, e.g. failing to restart, call with ``lock`` held.
+
+        The next client starts the camera again.
+        """
+        if self.stop_timer is not None:
+            self.stop_timer.cancel()
+            self.stop_timer = None
+        if self.running:
+            self.running = False
+            self.metrics.record_camera_stop()
+
+    def _stop_idle_camera(self):
+        with self.lock:
+            # A timer cancelled after it fired must not stop the camera
+            if current_thread() is not self.stop_timer:
+                return
+            logger.info('Stopping camera after %.1fs without clients', self.idle_timeout)
+            self.stop()
+            self.stop_timer = None
+            self.running = False
+            self.metrics.record_camera_stop()
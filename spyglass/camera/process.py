@@ -0,0 +1,243 @@
+import multiprocessing
+import numbers
+
+from threading import Thread
+
+from spyglass import camera, logger
+from spyglass.exif import create_exif_header
+from spyglass.shared_frames import ANNOUNCEMENT, SharedFrameRing, SharedFrameWriter
+
+# Frames in the shared memory ring, the server process skips to the newest announced frame
+SHARED_FRAME_SLOTS = 4
+# Smallest slot, slots hold at least one byte per pixel
+MIN_SLOT_SIZE = 256 * 1024
+# Seconds to wait for the capture process to open and start the camera
+START_TIMEOUT = 30.0
+STOP_TIMEOUT = 5.0
+
+
+class RemotePicamera2:
+    """Stands in for the ``Picamera2`` of the capture process, forwarding controls to it.
+
+    Controls set while the capture process is not running are sent once it started.
+    """
+    def __init__(self):
+        self.camera_controls = {}
+        self.connection = None
+        self.pending_controls = {}
+
+    def set_controls(self, controls):
+        if self.connection is None:
+            self.pending_controls.update(controls)
+        else:
+            self.connection.send(('controls', controls))
+
+    def connect(self, connection):
+        self.connection = connection
+        if self.pending_controls:
+            connection.send(('controls', self.pending_controls))
+            self.pending_controls = {}
+
+
+class ProcessCamera(camera.Camera):
+    """Camera captured and encoded in a child process, so frame timing does not depend on the load of the server.
+
+    Encoded frames are handed over through a ``SharedFrameRing``, only their sequence numbers
+    are sent through a pipe. ``fake`` produces frames with the synthetic camera instead, from
+    ``image_files`` if given.
+    Autofocus mode and speed are passed to ``configure`` as option names.
+    """
+    def __init__(self, camera_num=0, tuning_filter=None, tuning_filter_dir=None, fake=False, image_files=None):
+        super().__init__(RemotePicamera2())
+        self.camera_num = camera_num
+        self.tuning_filter = tuning_filter
+        self.tuning_filter_dir = tuning_filter_dir
+        self.fake = fake
+        self.image_files = image_files
+        self.process = None
+        self.ring = None
+        self.command_connection = None
+        self.reader_thread = None
+
+    def configure(self,
+                  width: int,
+                  height: int,
+                  fps: int,
+                  autofocus: str,
+                  lens_position: float,
+                  autofocus_speed: str,
+                  control_list: list[list[str]]=[],
+                  upsidedown=False,
+                  flip_horizontal=False,
+                  flip_vertical=False,
+                  lores_size=None,
+                  h264=False,
+                  h264_bitrate=None):
+        # Only the main stream is handed over to the server process
+        if lores_size:
+            logger.warning('Lores stream is not supported with a capture process')
+        if h264:
+            logger.warning('H.264 stream is not supported with a capture process')
+        self.settings = {
+            'width': width,
+            'height': height,
+            'fps': fps,
+            'autofocus': autofocus,
+            'lens_position': lens_position,
+            'autofocus_speed': autofocus_speed,
+            'control_list': control_list,
+            'upsidedown': upsidedown,
+            'flip_horizontal': flip_horizontal,
+            'flip_vertical': flip_vertical
+        }
+
+    def enable_motion_detection(self, fps, threshold):
+        logger.warning('Motion detection is not supported with a capture process')
+
+    def start(self, orientation_exif=0):
+        self.orientation_exif = orientation_exif
+        self.frame_buffer.exif_header = create_exif_header(orientation_exif)
+        slot_size = max(MIN_SLOT_SIZE, self.settings['width'] * self.settings['height'])
+        self.ring = SharedFrameRing.create(SHARED_FRAME_SLOTS, slot_size)
+        # A fresh interpreter does not inherit the threads and locks of the server
+        context = multiprocessing.get_context('spawn')
+        frame_receiver, frame_sender = context.Pipe(duplex=False)
+        command_receiver, command_sender = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=run_capture,
+            args=(self.camera_num, self.tuning_filter, self.tuning_filter_dir, self.fake, self.image_files,
+                  self.settings, orientation_exif, self.ring.name, SHARED_FRAME_SLOTS, slot_size, frame_sender,
+                  command_receiver),
+            name=f'spyglass-capture-{self.camera_num}',
+            daemon=True)
+        self.process.start()
+        frame_sender.close()
+        command_receiver.close()
+        self.command_connection = command_sender
+        try:
+            if not frame_receiver.poll(START_TIMEOUT):
+                raise RuntimeError(f'Capture process did not start within {START_TIMEOUT}s')
+            status, *details = frame_receiver.recv()
+            if status != 'ready':
+                raise RuntimeError(f'Capture process failed: {details[0]}')
+        except (EOFError, RuntimeError) as e:
+            frame_receiver.close()
+            self.stop()
+            raise RuntimeError(f'Failed to start camera {self.camera_num}: {e}') from e
+        camera_controls, controls = details
+        self.picam2.camera_controls = camera_controls
+        # Requests before the start may have compiled the schema without controls
+        self.controls.reload()
+        self.controls.set_initial_values({**controls, **self.picam2.pending_controls})
+        self.picam2.connect(command_sender)
+        self.reader_thread = Thread(target=self._read_frames, args=(frame_receiver,), daemon=True)
+        self.reader_thread.start()
+
+    def _read_frames(self, connection):
+        last_sequence = 0
+        last_dropped = 0
+        with connection:
+            while True:
+                try:
+                    sequence, dropped = ANNOUNCEMENT.unpack(connection.recv_bytes())
+                    # Skip frames announced while the previous one was published
+                    while connection.poll():
+                        sequence, dropped = ANNOUNCEMENT.unpack(connection.recv_bytes())
+                except (EOFError, OSError):
+                    break
+                if dropped != last_dropped:
+                    self.frame_buffer.metrics.record_dropped_frames(dropped - last_dropped)
+                    last_dropped = dropped
+                # Announcements of dropped frames repeat the sequence number of the last frame
+                if sequence == last_sequence:
+                    continue
+                last_sequence = sequence
+                data = self.ring.read(sequence)
+                if data is not None:
+                    self.frame_buffer.write(data)
+        if self.process is not None and self.process.exitcode not in (None, 0):
+            logger.error('Capture process of camera %s exited with code %s', self.camera_num, self.process.exitcode)
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.picam2.connection = None
+        try:
+            self.command_connection.send(None)
+        except OSError:
+            pass
+        self.command_connection.close()
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            logger.warning('Terminating capture process of camera %s', self.camera_num)
+            self.process.terminate()
+            self.process.join()
+        if self.reader_thread is not None:
+            self.reader_thread.join()
+            self.reader_thread = None
+        self.process = None
+        self.ring.close()
+        self.ring.unlink()
+        self.ring = None
+
+
+def run_capture(camera_num, tuning_filter, tuning_filter_dir, fake, image_files, settings, orientation_exif,
+                ring_name, slots, slot_size, frame_connection, command_connection):
+    """Entry point of the capture process, runs the camera until the server process stops it."""
+    from spyglass.cli import install_terminate_handler
+    # Stops the camera when terminated together with the server process
+    install_terminate_handler()
+    ring = SharedFrameRing.attach(ring_name, slots, slot_size)
+    writer = SharedFrameWriter(ring, frame_connection)
+    try:
+        if fake:
+            from spyglass.camera.synthetic import Synthetic
+            cam = Synthetic(image_files)
+        else:
+            from spyglass.camera import init_camera
+            from spyglass.cli import parse_autofocus, parse_autofocus_speed
+            cam = init_camera(camera_num, tuning_filter, tuning_filter_dir)
+            settings = {
+                **settings,
+                'autofocus': parse_autofocus(settings['autofocus']),
+                'autofocus_speed': parse_autofocus_speed(settings['autofocus_speed'])
+            }
+        cam.frame_buffer = writer
+        cam.configure(**settings)
+        cam.start(orientation_exif)
+    except Exception as e:
+        logger.exception('Failed to start camera %s', camera_num)
+        frame_connection.send(('error', str(e)))
+        ring.close()
+        return
+    try:
+        writer.announce(('ready', to_plain_values(cam.picam2.camera_controls), to_plain_values(cam.controls.values)))
+        while True:
+            try:
+                command = command_connection.recv()
+            except EOFError:
+                # The server process is gone
+                break
+            if command is None:
+                break
+            name, value = command
+            if name == 'controls':
+                cam.picam2.set_controls(value)
+    finally:
+        cam.stop()
+        ring.close()
+
+
+def to_plain_values(value):
+    """Convert libcamera types in controls to numbers and strings that can be sent to the server process."""
+    if isinstance(value, dict):
+        return {k: to_plain_values(v) for k, v in value.items()}
+    if isinstance(value, (tuple, list)):
+        return tuple(to_plain_values(v) for v in value)
+    if value is None or isinstance(value, (str, bool, numbers.Number)):
+        return value
+    try:
+        # libcamera enums
+        return int(value)
+    except (TypeError, ValueError):
+        return str(value)
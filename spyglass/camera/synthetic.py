@@ -0,0 +1,135 @@
+import io
+import struct
+import time
+
+from threading import Event, Thread
+
+from spyglass import camera, logger
+from spyglass.exif import create_exif_header
+from spyglass.frame_buffer import FrameBuffer
+from spyglass.motion import get_motion_size, jpeg_to_luma
+
+# Prefix of the JPEG comment carrying the time a synthetic frame was produced
+TIMESTAMP_COMMENT = b'spyglass-timestamp:'
+
+
+class NoControls:
+    """Stands in for ``Picamera2`` of a camera without controls."""
+    def __init__(self):
+        self.camera_controls = {}
+
+    def set_controls(self, controls):
+        pass
+
+
+class Synthetic(camera.Camera):
+    """Camera without hardware, producing JPEG frames at a fixed framerate.
+
+    Frames are read from the given JPEG files or generated with Pillow. Every frame
+    carries the time it was produced in a JPEG comment, see ``read_timestamp``.
+    """
+    def __init__(self, image_files=None):
+        super().__init__(NoControls())
+        self.image_files = image_files or []
+        self.images = []
+        self.lores_images = []
+        self.motion_frames = []
+        self.fps = 15
+        self.stop_event = Event()
+        self.producer_thread = None
+
+    def configure(self,
+                  width: int,
+                  height: int,
+                  fps: int,
+                  *args,
+                  lores_size=None,
+                  h264=False,
+                  **kwargs):
+        if h264:
+            logger.warning('H.264 stream is not supported by the synthetic camera')
+        self.fps = fps
+        self.settings = {'width': width, 'height': height, 'fps': fps, 'lores_size': lores_size}
+        if self.image_files:
+            self.images = [read_file(f) for f in self.image_files]
+        else:
+            self.images = generate_images(width, height, fps)
+        if lores_size:
+            self.lores_images = generate_images(*lores_size, fps)
+            if self.lores_frame_buffer is None:
+                self.lores_frame_buffer = FrameBuffer()
+                self.lores_frame_buffer.motion = self.motion_detector
+        if self.motion_detector is not None:
+            # Luma frames are decoded once, like the Y plane of the lores stream of a CSI camera
+            self.motion_size = lores_size or get_motion_size(width, height)
+            self.motion_frames = [jpeg_to_luma(image, self.motion_size) for image in self.images]
+
+    def start(self, orientation_exif=0):
+        self.orientation_exif = orientation_exif
+        self.frame_buffer.exif_header = create_exif_header(orientation_exif)
+        if self.lores_frame_buffer is not None:
+            self.lores_frame_buffer.exif_header = self.frame_buffer.exif_header
+        self.stop_event.clear()
+        self.producer_thread = Thread(target=self._produce_frames, daemon=True)
+        self.producer_thread.start()
+
+    def _produce_frames(self):
+        interval = 1 / self.fps
+        next_time = time.monotonic()
+        index = 0
+        while not self.stop_event.wait(max(0.0, next_time - time.monotonic())):
+            timestamp = time.time()
+            if self.motion_detector is not None and self.motion_detector.due(timestamp):
+                self.motion_detector.update(self.motion_frames[index % len(self.motion_frames)], timestamp)
+            image = self.images[index % len(self.images)]
+            self.frame_buffer.write(insert_timestamp(image, timestamp))
+            if self.lores_frame_buffer is not None:
+                lores_image = self.lores_images[index % len(self.lores_images)]
+                self.lores_frame_buffer.write(insert_timestamp(lores_image, timestamp))
+            index += 1
+            # Do not try to catch up after falling behind by more than one frame
+            next_time = max(next_time + interval, time.monotonic() - interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.producer_thread is not None:
+            self.producer_thread.join()
+            self.producer_thread = None
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def generate_images(width, height, count):
+    """Generate ``count`` distinct JPEG images with a bar moving across a gradient."""
+    from PIL import Image, ImageDraw
+
+    gradient = Image.linear_gradient('L')
+    background = Image.merge('RGB', (gradient, gradient.rotate(90), gradient)).resize((width, height))
+    images = []
+    for i in range(count):
+        image = background.copy()
+        draw = ImageDraw.Draw(image)
+        x = i * width // count
+        draw.rectangle((x, 0, x + width // 16, height), fill=(255, 255, 255))
+        draw.text((10, 10), f'spyglass {i}', fill=(255, 0, 0))
+        buf = io.BytesIO()
+        image.save(buf, format='JPEG', quality=85)
+        images.append(buf.getvalue())
+    return images
+
+
+def insert_timestamp(jpeg, timestamp):
+    comment = TIMESTAMP_COMMENT + repr(timestamp).encode('ascii')
+    return b''.join([jpeg[:2], b'\xFF\xFE', struct.pack('>H', len(comment) + 2), comment, jpeg[2:]])
+
+
+def read_timestamp(jpeg):
+    """Return the time a synthetic frame was produced, or ``None`` for other frames."""
+    start = jpeg.find(TIMESTAMP_COMMENT, 0, 512)
+    if start < 0:
+        return None
+    length = struct.unpack('>H', jpeg[start - 2:start])[0]
+    return float(jpeg[start + len(TIMESTAMP_COMMENT):start + length - 2])
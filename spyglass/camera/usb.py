@@ -1,28 +1,45 @@
-from spyglass import camera
-from spyglass.server import StreamingHandler
+from threading import Event, Thread
+
+from spyglass import camera, logger
+from spyglass.exif import create_exif_header
 
 class USB(camera.Camera):
-    def start_and_run_server(self,
-            bind_address,
-            port,
-            stream_url='/stream',
-            snapshot_url='/snapshot',
-            orientation_exif=0):
-        def get_frame(inner_self):
-            #TODO: Cuts framerate in 1/n with n streams open, add some kind of buffer
-            return self.picam2.capture_buffer()
+    def __init__(self, picam2):
+        super().__init__(picam2)
+        self.stop_event = Event()
+        self.capture_thread = None
+
+    def configure(self, *args, lores_size=None, h264=False, h264_bitrate=None, **kwargs):
+        # USB cameras deliver encoded frames, there is no ISP to scale a lores stream or hardware encoder
+        if lores_size:
+            logger.warning('Lores stream is not supported by USB cameras')
+        if h264:
+            logger.warning('H.264 stream is not supported by USB cameras')
+        super().configure(*args, **kwargs)
+
+    def enable_motion_detection(self, fps, threshold):
+        logger.warning('Motion detection is not supported by USB cameras')
 
+    def start(self, orientation_exif=0):
+        self.orientation_exif = orientation_exif
+        self.frame_buffer.exif_header = create_exif_header(orientation_exif)
         self.picam2.start()
+        self.stop_event.clear()
+        self.capture_thread = Thread(target=self._capture_frames, daemon=True)
+        self.capture_thread.start()
 
-        self._run_server(
-            bind_address,
-            port,
-            StreamingHandler,
-            get_frame,
-            stream_url=stream_url,
-            snapshot_url=snapshot_url,
-            orientation_exif=orientation_exif
-        )
+    def _capture_frames(self):
+        # Single capture loop per camera, every client reads from the frame buffer
+        while not self.stop_event.is_set():
+            try:
+                self.frame_buffer.write(self.picam2.capture_buffer())
+            except Exception as e:
+                logger.error('Failed to capture frame: %s', str(e))
+                self.stop_event.wait(1)
 
     def stop(self):
+        self.stop_event.set()
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+            self.capture_thread = None
         self.picam2.stop()
@@ -1,7 +1,218 @@
-import libcamera
 import ast
+import functools
+import glob
+import hashlib
+import json
+import math
+import numbers
+import os
 
-def parse_dictionary_to_html_page(camera, parsed_controls='None', processed_controls='None'):
+from collections.abc import Mapping
+from threading import Lock
+
+from spyglass import logger
+
+STYLE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', 'controls_style.css')
+# Formatted controls listings, see get_libcamera_controls_string
+CONTROLS_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'spyglass')
+# Names of the video devices and sensors of the attached cameras
+VIDEO4LINUX_DIR = '/sys/class/video4linux'
+
+
+class CameraControls:
+    """Controls of a camera with the values applied by spyglass.
+
+    Keeps the rendered controls page until the controls change and only passes
+    changed values on to the camera.
+    """
+    def __init__(self, picam2):
+        self.picam2 = picam2
+        self.values = {}
+        self.lock = Lock()
+        self.page = None
+        self._schema = None
+
+    @property
+    def schema(self):
+        if self._schema is None:
+            self._schema = ControlSchema(self.picam2.camera_controls)
+        return self._schema
+
+    def reload(self):
+        """Compile the schema and render the page again, e.g. once a capture process reported its controls."""
+        with self.lock:
+            self._schema = None
+            self.page = None
+
+    def set_initial_values(self, controls):
+        with self.lock:
+            self.values.update(controls)
+            self.page = None
+
+    def apply(self, controls):
+        """Set the values that differ from the applied ones on the camera, returns the changed values."""
+        with self.lock:
+            changed = {k: v for k, v in controls.items() if k not in self.values or self.values[k] != v}
+            if changed:
+                self.picam2.set_controls(changed)
+                self.values.update(changed)
+                self.page = None
+            return changed
+
+    def get_page(self, parsed_controls=None, processed_controls=None):
+        """Return the controls page, the page of a request without controls is rendered once."""
+        with self.lock:
+            if parsed_controls is not None:
+                return parse_dictionary_to_html_page(
+                    self.picam2, parsed_controls, processed_controls, self.values).encode('utf-8')
+            if self.page is None:
+                self.page = parse_dictionary_to_html_page(self.picam2, None, {}, self.values).encode('utf-8')
+            return self.page
+
+    def to_dict(self):
+        with self.lock:
+            values = dict(self.values)
+        return {
+            control: {
+                'min': limits[0],
+                'max': limits[1],
+                'default': limits[2],
+                'value': values.get(control, limits[2])
+            }
+            for control, limits in self.picam2.camera_controls.items()
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), default=str).encode('utf-8')
+
+
+class ControlSpec:
+    """Canonical name, value type, range and enum values of a camera control."""
+    def __init__(self, name, minimum, maximum, default, enum_values=None):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.default = default
+        self.value_type = get_value_type(minimum, maximum, default)
+        # Lower case enum names mapped to their values
+        self.enum_values = enum_values or {}
+        self.check_range = (
+            self.value_type in (int, float)
+            and is_number(minimum) and is_number(maximum)
+            and minimum < maximum
+        )
+
+    def convert(self, value):
+        """Convert a value given as string, number or list, raises ``ValueError`` for invalid values."""
+        if self.value_type is None:
+            return parse_from_string(value) if isinstance(value, str) else value
+        if isinstance(value, str):
+            value = value.strip()
+            if value.lower() in self.enum_values:
+                return self.enum_values[value.lower()]
+            if ',' in value:
+                value = value.strip('()[]').split(',')
+        if isinstance(value, (list, tuple)):
+            return tuple(self.convert_scalar(v) for v in value)
+        return self.convert_scalar(value)
+
+    def convert_scalar(self, value):
+        if isinstance(value, str):
+            value = value.strip()
+            if self.value_type is bool:
+                if value.lower() not in BOOL_STRINGS:
+                    raise ValueError(f'{self.name} expects a boolean, got {value}')
+                return BOOL_STRINGS[value.lower()]
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError(f'{self.name} expects a number, got {value}') from None
+        elif not isinstance(value, numbers.Real):
+            raise ValueError(f'{self.name} expects a {self.value_type.__name__}, got {value!r}')
+        if not math.isfinite(value):
+            raise ValueError(f'{self.name} expects a finite number, got {value}')
+        if self.value_type is bool:
+            return bool(value)
+        if self.value_type is int:
+            if value != int(value):
+                raise ValueError(f'{self.name} expects an integer, got {value}')
+            value = int(value)
+        else:
+            value = float(value)
+        if self.check_range and not self.minimum <= value <= self.maximum:
+            raise ValueError(f'{self.name} must be between {self.minimum} and {self.maximum}, got {value}')
+        return value
+
+
+class ControlSchema:
+    """Specs of all controls of a camera, compiled once from ``camera_controls``."""
+    def __init__(self, camera_controls):
+        # Cameras without controls, e.g. the synthetic camera, do not need libcamera
+        enums = get_libcamera_enums() if camera_controls else {}
+        self.specs = {
+            name: ControlSpec(name, *limits[:3], enum_values=enums.get(name))
+            for name, limits in camera_controls.items()
+        }
+        self.specs_lower = {name.lower(): spec for name, spec in self.specs.items()}
+
+    def convert(self, controls, ignore_unknown=False):
+        """Validate and convert controls, given as dict or ``(name, value)`` pairs, to their canonical names and types.
+
+        Raises ``ValueError`` listing every invalid control. Unknown controls are an error
+        too, unless ``ignore_unknown`` is set.
+        """
+        if isinstance(controls, dict):
+            controls = controls.items()
+        converted = {}
+        errors = []
+        for name, value in controls:
+            spec = self.specs_lower.get(name.lower().strip())
+            if spec is None:
+                if ignore_unknown:
+                    logger.warning('Ignoring unknown control %s', name)
+                else:
+                    errors.append(f'Unknown control {name}')
+                continue
+            try:
+                converted[spec.name] = spec.convert(value)
+            except ValueError as e:
+                errors.append(str(e))
+        if errors:
+            raise ValueError('; '.join(errors))
+        return converted
+
+
+BOOL_STRINGS = {'true': True, 'false': False, '1': True, '0': False, 'on': True, 'off': False}
+
+
+def get_value_type(minimum, maximum, default):
+    values = [v for v in (minimum, maximum, default) if v is not None]
+    if values and all(isinstance(v, bool) for v in values):
+        return bool
+    if values and all(is_number(v) for v in values):
+        return float if any(isinstance(v, float) for v in values) else int
+    return None
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def get_libcamera_enums():
+    """Return the lower case names and values of the libcamera enum controls by control name."""
+    import libcamera
+
+    enums = {}
+    for attribute in dir(libcamera.controls):
+        if not attribute.endswith('Enum'):
+            continue
+        members = getattr(getattr(libcamera.controls, attribute), '__members__', None)
+        if isinstance(members, Mapping):
+            enums[attribute[:-len('Enum')]] = {k.lower(): int(v) for k, v in members.items()}
+    return enums
+
+
+def parse_dictionary_to_html_page(camera, parsed_controls='None', processed_controls='None', values={}):
     html =  """
             <!DOCTYPE html>
             <html lang="en">
@@ -20,7 +231,7 @@ def parse_dictionary_to_html_page(camera, parsed_controls='None', processed_cont
                     <h3>Parsed Controls: {parsed_controls}</h3>
                     <h3>Processed Controls: {processed_controls}</h3>
             """
-    for control, values in camera.camera_controls.items():
+    for control, limits in camera.camera_controls.items():
         html += f"""
                     <div class="card-container">
                         <div class="card">
@@ -28,15 +239,19 @@ def parse_dictionary_to_html_page(camera, parsed_controls='None', processed_cont
                             <div class="card-content">
                             <div class="setting">
                                 <span class="label">Min:</span>
-                                <span class="value">{values[0]}</span>
+                                <span class="value">{limits[0]}</span>
                             </div>
                             <div class="setting">
                                 <span class="label">Max:</span>
-                                <span class="value">{values[1]}</span>
+                                <span class="value">{limits[1]}</span>
                             </div>
                             <div class="setting">
                                 <span class="label">Default:</span>
-                                <span class="value">{values[2]}</span>
+                                <span class="value">{limits[2]}</span>
+                            </div>
+                            <div class="setting">
+                                <span class="label">Value:</span>
+                                <span class="value">{values.get(control, limits[2])}</span>
                             </div>
                             </div>
                         </div>
@@ -48,24 +263,11 @@ def parse_dictionary_to_html_page(camera, parsed_controls='None', processed_cont
             """
     return html
 
+@functools.lru_cache(maxsize=None)
 def get_style():
-    with (open('resources/controls_style.css', 'r')) as f:
+    with (open(STYLE_FILE, 'r')) as f:
         return f.read()
 
-def process_controls(camera, controls: list[tuple[str, str]]) -> dict[str, any]:
-    controls_dict_lower = { k.lower(): k for k in camera.camera_controls.keys() }
-    if controls == None:
-        return {}
-    processed_controls = {}
-    for key, value in controls:
-        key = key.lower().strip()
-        if key.lower() in controls_dict_lower.keys():
-            value = value.lower().strip()
-            k = controls_dict_lower[key]
-            v = parse_from_string(value)
-            processed_controls[k] = v
-    return processed_controls
-
 def parse_from_string(input_string: str) -> any:
     try:
         return ast.literal_eval(input_string)
@@ -81,16 +283,70 @@ def get_type_str(obj) -> str:
     return str(type(obj)).split('\'')[1]
 
 def get_libcamera_controls_string(camera_num: str) -> str:
-    ctrls_str = ""
+    """Return the formatted controls of a camera.
+
+    Listings are cached on disk by the models of the attached cameras and the libcamera build,
+    so listing them again skips starting the libcamera camera manager.
+    """
+    import libcamera
+
+    cache_file = None
+    cache_key = get_controls_cache_key(camera_num, libcamera)
+    if cache_key is not None:
+        cache_file = os.path.join(CONTROLS_CACHE_DIR, f'controls-{cache_key}.txt')
+        try:
+            with open(cache_file, 'r') as f:
+                return f.read()
+        except OSError:
+            pass
+
     libcam_cm = libcamera.CameraManager.singleton()
     if camera_num > len(libcam_cm.cameras) - 1:
-        return ctrls_str
-    cam = libcam_cm.cameras[camera_num]
+        return ""
+    ctrls_str = format_libcamera_controls(libcam_cm.cameras[camera_num].controls)
+    if cache_file is not None:
+        try:
+            os.makedirs(CONTROLS_CACHE_DIR, exist_ok=True)
+            with open(cache_file + '.tmp', 'w') as f:
+                f.write(ctrls_str)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError as e:
+            logger.warning('Could not cache the controls listing in %s: %s', cache_file, e)
+    return ctrls_str
+
+
+def get_controls_cache_key(camera_num, libcamera):
+    """Identify the controls listing of a camera without starting the camera manager.
+
+    Returns ``None`` if the attached cameras or the libcamera build are unknown.
+    """
+    names = []
+    for path in sorted(glob.glob(os.path.join(VIDEO4LINUX_DIR, '*', 'name'))):
+        try:
+            with open(path, 'r') as f:
+                names.append(f.read().strip())
+        except OSError:
+            pass
+    libcamera_file = getattr(libcamera, '__file__', None)
+    if not names or libcamera_file is None:
+        return None
+    try:
+        libcamera_stat = os.stat(libcamera_file)
+    except OSError:
+        return None
+    key = json.dumps([camera_num, names, libcamera_file, libcamera_stat.st_size, libcamera_stat.st_mtime_ns])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def format_libcamera_controls(camera_controls) -> str:
+    import libcamera
+
+    ctrls_str = ""
 
     def rectangle_to_tuple(rectangle):
         return (rectangle.x, rectangle.y, rectangle.width, rectangle.height)
 
-    for k, v in cam.controls.items():
+    for k, v in camera_controls.items():
         if isinstance(v.min, libcamera.Rectangle):
             min = rectangle_to_tuple(v.min)
             max = rectangle_to_tuple(v.max)
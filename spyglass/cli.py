@@ -4,14 +4,18 @@ Parse command line arguments in, invoke server.
 """
 
 import argparse
+import os
 import re
+import signal
 import sys
-import libcamera
+import tempfile
 
-from spyglass import camera_options, logger
+from threading import Thread
+
+from spyglass import camera_options, config, logger
 from spyglass.exif import option_to_exif_orientation
 from spyglass.__version__ import __version__
-from spyglass.camera import init_camera
+from spyglass.metrics import StartupTimer
 
 
 MAX_WIDTH = 1920
@@ -26,48 +30,196 @@ def main(args=None):
     The __main__ entry point similarly wraps sys.exit().
     """
     logger.info(f"Spyglass {__version__}")
+    startup_timer = StartupTimer()
 
     if args is None:
         args = sys.argv[1:]
 
     parsed_args = get_args(args)
+    if parsed_args.no_tcp and parsed_args.unix_socket is None:
+        get_parser().error('--no_tcp requires --unix_socket')
 
     if parsed_args.list_controls:
-        controls_str = camera_options.get_libcamera_controls_string(parsed_args.camera_num)
-        if not controls_str:
-            print(f"Camera {parsed_args.camera_num} not found")
-        else:
-            print('Available controls:\n'+controls_str)
+        for camera_num in parsed_args.camera_num:
+            controls_str = camera_options.get_libcamera_controls_string(camera_num)
+            if not controls_str:
+                print(f"Camera {camera_num} not found")
+            else:
+                print('Available controls:\n'+controls_str)
         return
 
+    # The camera backends and servers are only needed to stream, not for --help or --list-controls
+    with startup_timer.phase('import'):
+        from spyglass.camera import init_camera
+        from spyglass.camera.camera import run_server
+        from spyglass.camera.process import ProcessCamera
+
     width, height = split_resolution(parsed_args.resolution)
-    controls = parsed_args.controls
+    lores_size = None
+    if parsed_args.lores_resolution:
+        lores_size = split_lores_resolution(parsed_args.lores_resolution, width, height)
+    controls = get_controls(parsed_args)
+
+    cameras = {}
+    for camera_num in parsed_args.camera_num:
+        with startup_timer.phase('camera_init'):
+            if parsed_args.capture_process:
+                # The camera is opened by the capture process when it starts
+                cam = ProcessCamera(camera_num, parsed_args.tuning_filter, parsed_args.tuning_filter_dir)
+            else:
+                cam = init_camera(
+                    camera_num,
+                    parsed_args.tuning_filter,
+                    parsed_args.tuning_filter_dir)
+            if parsed_args.motion_detection:
+                cam.enable_motion_detection(parsed_args.motion_fps, parsed_args.motion_threshold)
+
+        with startup_timer.phase('configure'):
+            if parsed_args.capture_process:
+                autofocus, autofocus_speed = parsed_args.autofocus, parsed_args.autofocusspeed
+            else:
+                autofocus = parse_autofocus(parsed_args.autofocus)
+                autofocus_speed = parse_autofocus_speed(parsed_args.autofocusspeed)
+            cam.configure(width,
+                          height,
+                          parsed_args.fps,
+                          autofocus,
+                          parsed_args.lensposition,
+                          autofocus_speed,
+                          controls,
+                          parsed_args.upsidedown,
+                          parsed_args.flip_horizontal,
+                          parsed_args.flip_vertical,
+                          lores_size=lores_size,
+                          h264=parsed_args.h264,
+                          h264_bitrate=parsed_args.h264_bitrate)
+        if parsed_args.record_seconds:
+            cam.enable_recording(os.path.join(parsed_args.record_dir, f'camera{camera_num}'),
+                                 parsed_args.record_seconds,
+                                 parsed_args.record_max_mb * 1024 * 1024)
+        if parsed_args.timelapse:
+            cam.enable_timelapse(os.path.join(parsed_args.timelapse_dir, f'camera{camera_num}'))
+        cameras[camera_num] = cam
+    install_reload_handler(args, cameras)
+    previous_sigterm_handler = install_terminate_handler()
+    if parsed_args.idle_timeout is None:
+        startup_timer.report_on_first_frame(get_frame_buffers(cameras))
+    else:
+        # The first frame waits for the first client, see the cold start metrics instead
+        startup_timer.report(get_frame_buffers(cameras))
+    try:
+        if len(cameras) == 1:
+            cam.start_and_run_server(parsed_args.bindaddress,
+                                     parsed_args.port,
+                                     parsed_args.stream_url,
+                                     parsed_args.snapshot_url,
+                                     parsed_args.orientation_exif,
+                                     parsed_args.snapshot_max_age,
+                                     parsed_args.server_mode,
+                                     parsed_args.lores_stream_url,
+                                     parsed_args.lores_snapshot_url,
+                                     parsed_args.idle_timeout,
+                                     unix_socket=parsed_args.unix_socket,
+                                     tcp=not parsed_args.no_tcp,
+                                     h264_stream_url=parsed_args.h264_stream_url)
+        else:
+            for cam in cameras.values():
+                if parsed_args.idle_timeout is None:
+                    cam.start(parsed_args.orientation_exif)
+                else:
+                    cam.start_on_demand(parsed_args.orientation_exif, parsed_args.idle_timeout)
+            run_server(get_camera_url_prefixes(cameras),
+                       parsed_args.bindaddress,
+                       parsed_args.port,
+                       parsed_args.stream_url,
+                       parsed_args.snapshot_url,
+                       parsed_args.snapshot_max_age,
+                       parsed_args.server_mode,
+                       parsed_args.lores_stream_url,
+                       parsed_args.lores_snapshot_url,
+                       unix_socket=parsed_args.unix_socket,
+                       tcp=not parsed_args.no_tcp,
+                       h264_stream_url=parsed_args.h264_stream_url)
+    finally:
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+        for cam in cameras.values():
+            cam.stop()
+
+
+def install_reload_handler(args, cameras):
+    """Reconfigure the cameras from the arguments and configuration file on SIGHUP."""
+    if not hasattr(signal, 'SIGHUP'):
+        return
+
+    def handle_sighup(signum, frame):
+        # Restarting the cameras takes a while, the server keeps serving meanwhile
+        Thread(target=reload_config, args=(args, cameras), daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handle_sighup)
+
+
+def install_terminate_handler():
+    """Stop like on Ctrl+C when terminated, e.g. by systemd, so the cameras are stopped and shared memory is freed.
+
+    Returns the previous handler.
+    """
+    def handle_sigterm(signum, frame):
+        raise SystemExit(128 + signum)
+
+    return signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def reload_config(args, cameras):
+    """Apply resolution, framerate, transform, orientation and controls of the configuration to running cameras.
+
+    Other options only take effect after a restart.
+    """
+    try:
+        parsed_args = get_args(args)
+        width, height = split_resolution(parsed_args.resolution)
+    except (argparse.ArgumentTypeError, OSError, ValueError, SystemExit) as e:
+        logger.error('Failed to reload configuration: %s', e)
+        return
+    settings = {
+        'width': width,
+        'height': height,
+        'fps': parsed_args.fps,
+        'upsidedown': parsed_args.upsidedown,
+        'flip_horizontal': parsed_args.flip_horizontal,
+        'flip_vertical': parsed_args.flip_vertical,
+        'orientation_exif': parsed_args.orientation_exif
+    }
+    controls = get_controls(parsed_args)
+    for camera_num, cam in cameras.items():
+        try:
+            cam.reconfigure(settings)
+            cam.controls.apply(cam.controls.schema.convert(controls, ignore_unknown=True))
+        except (RuntimeError, ValueError) as e:
+            # RuntimeError: the capture process of a ProcessCamera failed to start
+            logger.error('Failed to reconfigure camera %s: %s', camera_num, e)
+
+
+def get_controls(parsed_args):
+    controls = list(parsed_args.controls)
     if parsed_args.controls_string:
         controls += [c.split('=') for c in parsed_args.controls_string.split(',')]
+    return controls
+
+
+def get_frame_buffers(cameras):
+    return [frame_buffer for cam in cameras.values() for frame_buffer in cam.frame_buffers()]
 
-    cam = init_camera(
-        parsed_args.camera_num,
-        parsed_args.tuning_filter,
-        parsed_args.tuning_filter_dir)
-
-    cam.configure(width,
-                  height,
-                  parsed_args.fps,
-                  parse_autofocus(parsed_args.autofocus),
-                  parsed_args.lensposition,
-                  parse_autofocus_speed(parsed_args.autofocusspeed),
-                  controls,
-                  parsed_args.upsidedown,
-                  parsed_args.flip_horizontal,
-                  parsed_args.flip_vertical,)
-    try:
-        cam.start_and_run_server(parsed_args.bindaddress,
-                                 parsed_args.port,
-                                 parsed_args.stream_url,
-                                 parsed_args.snapshot_url,
-                                 parsed_args.orientation_exif)
-    finally:
-        cam.stop()
+
+def get_camera_url_prefixes(cameras):
+    """Map every camera to the URL prefix /camera<num>, the first camera is also served without prefix."""
+    url_prefixes = {}
+    for index, (camera_num, cam) in enumerate(cameras.items()):
+        if index == 0:
+            url_prefixes[''] = cam
+        url_prefixes[f'/camera{camera_num}'] = cam
+    return url_prefixes
 
 # region args parsers
 
@@ -92,6 +244,8 @@ def orientation_type(arg_value):
 
 
 def parse_autofocus(arg_value):
+    import libcamera
+
     if arg_value == 'manual':
         return libcamera.controls.AfModeEnum.Manual
     elif arg_value == 'continuous':
@@ -101,6 +255,8 @@ def parse_autofocus(arg_value):
 
 
 def parse_autofocus_speed(arg_value):
+    import libcamera
+
     if arg_value == 'normal':
         return libcamera.controls.AfSpeedEnum.Normal
     elif arg_value == 'fast':
@@ -117,14 +273,28 @@ def split_resolution(res):
         raise argparse.ArgumentTypeError("Maximum supported resolution is 1920x1920")
     return w, h
 
+
+def split_lores_resolution(res, width, height):
+    w, h = split_resolution(res)
+    if w > width or h > height:
+        raise argparse.ArgumentTypeError("Lores resolution must not be larger than the resolution")
+    return w, h
+
 # endregion args parsers
 
 
 # region cli args
 
 def get_args(args):
-    """Parse arguments passed in from shell."""
-    return get_parser().parse_args(args)
+    """Parse arguments passed in from shell.
+
+    Options of a ``--config`` file come first, so options passed in from shell override them.
+    """
+    parsed_args = get_parser().parse_args(args)
+    if parsed_args.config:
+        config_args = config.config_to_args(config.read_config(parsed_args.config))
+        parsed_args = get_parser().parse_args(config_args + list(args))
+    return parsed_args
 
 
 def get_parser():
@@ -137,6 +307,10 @@ def get_parser():
     parser.add_argument('-b', '--bindaddress', type=str, default='0.0.0.0', help='Bind to address for incoming '
                                                                                  'connections')
     parser.add_argument('-p', '--port', type=int, default=8080, help='Bind to port for incoming connections')
+    parser.add_argument('-us', '--unix_socket', type=str, default=None,
+                        help='Also listen on this Unix domain socket, e.g. for a local nginx proxy')
+    parser.add_argument('-nt', '--no_tcp', action='store_true',
+                        help='Only listen on the Unix domain socket, not on the bind address and port')
     parser.add_argument('-r', '--resolution', type=resolution_type, default='640x480',
                         help='Resolution of the images width x height. Maximum is 1920x1920.')
     parser.add_argument('-f', '--fps', type=int, default=15, help='Frames per second to capture')
@@ -144,6 +318,52 @@ def get_parser():
                         help='Sets the URL for the mjpeg stream')
     parser.add_argument('-sn', '--snapshot_url', type=str, default='/snapshot',
                         help='Sets the URL for snapshots (single frame of stream)')
+    parser.add_argument('-lr', '--lores_resolution', type=resolution_type, default=None,
+                        help='Resolution of an additional low resolution stream width x height. '
+                             'Disabled by default')
+    parser.add_argument('-lst', '--lores_stream_url', type=str, default='/lores/stream',
+                        help='Sets the URL for the low resolution mjpeg stream')
+    parser.add_argument('-lsn', '--lores_snapshot_url', type=str, default='/lores/snapshot',
+                        help='Sets the URL for low resolution snapshots')
+    parser.add_argument('--h264', action='store_true',
+                        help='Also encode the stream with the hardware H.264 encoder and serve it as fragmented MP4, '
+                             'which needs a fraction of the bandwidth of MJPEG. CSI cameras only')
+    parser.add_argument('-hst', '--h264_stream_url', type=str, default='/stream.mp4',
+                        help='Sets the URL for the H.264 fragmented MP4 stream')
+    parser.add_argument('-hb', '--h264_bitrate', type=int, default=None,
+                        help='Bitrate of the H.264 stream in bits per second. Chosen by the encoder by default')
+    parser.add_argument('-md', '--motion_detection', action='store_true',
+                        help='Detect motion in the lores stream and publish it at /motion and as headers of the '
+                             'stream. CSI cameras only')
+    parser.add_argument('-mf', '--motion_fps', type=float, default=2.0,
+                        help='Frames per second analyzed by the motion detection')
+    parser.add_argument('-mt', '--motion_threshold', type=int, default=25,
+                        help='Minimum change of the luma (0-255) of a pixel counted as motion')
+    parser.add_argument('-rs', '--record_seconds', type=float, default=None,
+                        help='Keep the last seconds of the stream in memory to save them as clip with POST /api/clip. '
+                             'Disabled by default')
+    parser.add_argument('-rm', '--record_max_mb', type=float, default=100,
+                        help='Maximum memory in MiB used for the recorded frames of every camera')
+    parser.add_argument('-rd', '--record_dir', type=str, default=os.path.join(tempfile.gettempdir(), 'spyglass'),
+                        help='Directory to save clips to, every camera uses its subdirectory camera<num>')
+    parser.add_argument('-tl', '--timelapse', action='store_true',
+                        help='Take timelapse frames started, triggered and stopped with /api/timelapse. '
+                             'Disabled by default')
+    parser.add_argument('-td', '--timelapse_dir', type=str,
+                        default=os.path.join(tempfile.gettempdir(), 'spyglass', 'timelapse'),
+                        help='Directory of the frames of timelapses started with /api/timelapse, every camera uses '
+                             'its subdirectory camera<num>')
+    parser.add_argument('-cp', '--capture_process', action='store_true',
+                        help='Capture and encode in a separate process, so serving many clients does not delay '
+                             'frames. Lores, H.264 and motion detection are not supported')
+    parser.add_argument('-sa', '--snapshot_max_age', type=float, default=1.0,
+                        help='Maximum age in seconds of a frame to be served as snapshot. '
+                             'Older frames make the snapshot wait for the next frame')
+    parser.add_argument('-sm', '--server_mode', type=str, default='threaded', choices=['threaded', 'asyncio'],
+                        help='Serve clients with one thread per connection or from a single asyncio event loop')
+    parser.add_argument('-it', '--idle_timeout', type=float, default=None,
+                        help='Start the camera with the first client and stop it after this many seconds without '
+                             'clients. By default the camera runs all the time')
     parser.add_argument('-af', '--autofocus', type=str, default='continuous', choices=['manual', 'continuous'],
                         help='Autofocus mode')
     parser.add_argument('-l', '--lensposition', type=float, default=0.0,
@@ -180,8 +400,13 @@ def get_parser():
                         help='Set a tuning filter file name.')
     parser.add_argument('-tfd', '--tuning_filter_dir', type=str, default=None, nargs='?',const="",
                         help='Set the directory to look for tuning filters.')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Read options from a spyglass.conf file. Sending SIGHUP reads it again and applies\n'
+                             'resolution, framerate, transform, orientation and controls without a restart')
     parser.add_argument('--list-controls', action='store_true', help='List available camera controls and exits.')
-    parser.add_argument('-n', '--camera_num', type=int, default=0, help='Camera number to be used (Works with --list-controls)')
+    parser.add_argument('-n', '--camera_num', type=int, default=[0], nargs='+',
+                        help='Camera number to be used (Works with --list-controls). '
+                             'Several cameras are served from one server under /camera<num>/<url>')
     return parser
 
 # endregion cli args
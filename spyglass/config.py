@@ -0,0 +1,55 @@
+"""Reads the ``spyglass.conf`` file of the service installation."""
+
+import shlex
+
+# Command line options of the configuration file keys, see resources/spyglass.conf
+CONFIG_OPTIONS = {
+    'CAMERA_NUM': '--camera_num',
+    'HTTP_PORT': '--port',
+    'RESOLUTION': '--resolution',
+    'FPS': '--fps',
+    'STREAM_URL': '--stream_url',
+    'SNAPSHOT_URL': '--snapshot_url',
+    'AUTO_FOCUS': '--autofocus',
+    'FOCAL_DIST': '--lensposition',
+    'AF_SPEED': '--autofocusspeed',
+    'ORIENTATION_EXIF': '--orientation_exif',
+    'TUNING_FILTER': '--tuning_filter',
+    'TUNING_FILTER_DIR': '--tuning_filter_dir',
+    'CONTROLS': '--controls-string',
+}
+
+
+def read_config(path):
+    """Return the ``KEY="value"`` assignments of a configuration file, ignoring comments."""
+    config = {}
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            tokens = shlex.split(line, comments=True)
+            if not tokens:
+                continue
+            if len(tokens) != 1 or '=' not in tokens[0]:
+                raise ValueError(f'{path}:{line_number}: expected KEY="value"')
+            key, value = tokens[0].split('=', 1)
+            config[key.strip()] = value
+    return config
+
+
+def config_to_args(config):
+    """Convert a configuration to command line arguments, empty values are left out."""
+    args = []
+    # Standalone spyglass listens on all interfaces, behind a proxy only on localhost
+    if config.get('NO_PROXY', 'true') == 'true':
+        args += ['--bindaddress', '0.0.0.0']
+    else:
+        args += ['--bindaddress', '127.0.0.1']
+    for key, option in CONFIG_OPTIONS.items():
+        value = config.get(key)
+        if not value:
+            continue
+        if key == 'CAMERA_NUM':
+            # Several cameras are separated by spaces
+            args += [option, *value.split()]
+        else:
+            args += [option, value]
+    return args
@@ -0,0 +1,166 @@
+"""Fragmented MP4 muxer for H.264 streams, playable by browsers over plain HTTP.
+
+A client receives an initialization segment with the decoder configuration
+followed by one fragment per access unit, starting at a keyframe.
+"""
+
+import struct
+
+from spyglass.h264 import HIGH_PROFILES, SequenceParameterSet
+
+# Units per second of the decode times and sample durations
+TIMESCALE = 90000
+# Sample duration until the interval between two frames is known
+DEFAULT_SAMPLE_DURATION = TIMESCALE // 30
+TRACK_ID = 1
+# Sample flags of keyframes and of frames depending on others, see ISO/IEC 14496-12 8.8.3.1
+KEYFRAME_FLAGS = 0x02000000
+NON_KEYFRAME_FLAGS = 0x01010000
+UNITY_MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def box(box_type, *payloads):
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+
+def full_box(box_type, version, flags, *payloads):
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def avc_configuration(sps, pps):
+    """Return the avcC box describing the decoder configuration of the parameter sets."""
+    sps_info = SequenceParameterSet(sps)
+    payload = [
+        struct.pack('>5B', 1, sps[1], sps[2], sps[3], 0xFF),
+        struct.pack('>BH', 0xE1, len(sps)), sps,
+        struct.pack('>BH', 1, len(pps)), pps,
+    ]
+    if sps_info.profile_idc in HIGH_PROFILES:
+        payload.append(struct.pack('>4B',
+                                   0xFC | sps_info.chroma_format_idc,
+                                   0xF8 | sps_info.bit_depth_luma_minus8,
+                                   0xF8 | sps_info.bit_depth_chroma_minus8,
+                                   0))
+    return box(b'avcC', *payload)
+
+
+def init_segment(sps, pps):
+    """Return the ``ftyp`` and ``moov`` boxes of a stream with the given parameter sets."""
+    sps_info = SequenceParameterSet(sps)
+    width, height = sps_info.width, sps_info.height
+    avc1 = box(
+        b'avc1',
+        b'\x00' * 6, struct.pack('>H', 1),  # data_reference_index
+        b'\x00' * 16,
+        struct.pack('>HHIIIH', width, height, 0x00480000, 0x00480000, 0, 1),
+        b'\x00' * 32,  # compressorname
+        struct.pack('>Hh', 0x18, -1),
+        avc_configuration(sps, pps)
+    )
+    stbl = box(
+        b'stbl',
+        full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+        full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+        full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+        full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+        full_box(b'stco', 0, 0, struct.pack('>I', 0))
+    )
+    minf = box(
+        b'minf',
+        full_box(b'vmhd', 0, 1, struct.pack('>4H', 0, 0, 0, 0)),
+        box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+        stbl
+    )
+    mdia = box(
+        b'mdia',
+        full_box(b'mdhd', 0, 0, struct.pack('>4I2H', 0, 0, TIMESCALE, 0, 0x55C4, 0)),  # language und
+        full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'vide'), b'VideoHandler\x00'),
+        minf
+    )
+    trak = box(
+        b'trak',
+        full_box(b'tkhd', 0, 3, struct.pack('>5I8x4H', 0, 0, TRACK_ID, 0, 0, 0, 0, 0, 0),
+                 UNITY_MATRIX, struct.pack('>II', width << 16, height << 16)),
+        mdia
+    )
+    moov = box(
+        b'moov',
+        full_box(b'mvhd', 0, 0, struct.pack('>4IIH10x', 0, 0, TIMESCALE, 0, 0x00010000, 0x0100),
+                 UNITY_MATRIX, b'\x00' * 24, struct.pack('>I', TRACK_ID + 1)),
+        trak,
+        box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>5I', TRACK_ID, 1, 0, 0, 0)))
+    )
+    ftyp = box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso5', b'iso6', b'avc1', b'mp41')
+    return ftyp + moov
+
+
+def fragment(sequence_number, decode_time, duration, keyframe, nal_units):
+    """Return the buffers of the ``moof`` and ``mdat`` boxes of a single sample.
+
+    The NAL units are sent as they are, only their length prefixes are created.
+    """
+    sample_size = sum(len(nal_unit) + 4 for nal_unit in nal_units)
+    # Size of the moof box of a single sample, the data offset points behind the following mdat header
+    moof_size = 100
+    moof = box(
+        b'moof',
+        full_box(b'mfhd', 0, 0, struct.pack('>I', sequence_number)),
+        box(
+            b'traf',
+            full_box(b'tfhd', 0, 0x020000, struct.pack('>I', TRACK_ID)),  # default-base-is-moof
+            full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+            # data-offset, sample-duration, sample-size and sample-flags present
+            full_box(b'trun', 0, 0x000701, struct.pack('>Ii3I', 1, moof_size + 8, duration, sample_size,
+                                                        KEYFRAME_FLAGS if keyframe else NON_KEYFRAME_FLAGS))
+        )
+    )
+    buffers = [moof, struct.pack('>I4s', sample_size + 8, b'mdat')]
+    for nal_unit in nal_units:
+        buffers.append(struct.pack('>I', len(nal_unit)))
+        buffers.append(nal_unit)
+    return buffers
+
+
+class Fmp4Stream:
+    """Fragmented MP4 stream of a single client.
+
+    Starts with the first keyframe and sends a new initialization segment whenever the
+    parameter sets change. After frames were dropped, ``resync`` skips frames until the
+    next keyframe, as the following frames reference the dropped ones.
+    """
+    def __init__(self):
+        self.sequence_number = 0
+        self.sps = None
+        self.pps = None
+        self.start_timestamp = None
+        self.last_timestamp = None
+        self.decode_time = 0
+        self.duration = DEFAULT_SAMPLE_DURATION
+        self.synchronized = False
+
+    def resync(self):
+        self.synchronized = False
+
+    def get_buffers(self, frame):
+        """Return the buffers to send for an ``H264Frame``, or an empty list while waiting for a keyframe."""
+        if not self.synchronized:
+            if not frame.keyframe or (frame.sps or self.sps) is None or (frame.pps or self.pps) is None:
+                return []
+            self.synchronized = True
+        buffers = []
+        sps = frame.sps or self.sps
+        pps = frame.pps or self.pps
+        if sps != self.sps or pps != self.pps:
+            self.sps, self.pps = sps, pps
+            buffers.append(init_segment(sps, pps))
+        if self.start_timestamp is None:
+            self.start_timestamp = frame.timestamp
+        else:
+            self.duration = max(1, round((frame.timestamp - self.last_timestamp) * TIMESCALE))
+            # Decode times must increase even if the frame timestamps jitter
+            self.decode_time = max(self.decode_time + 1, round((frame.timestamp - self.start_timestamp) * TIMESCALE))
+        self.last_timestamp = frame.timestamp
+        self.sequence_number += 1
+        buffers += fragment(self.sequence_number, self.decode_time, self.duration, frame.keyframe, frame.nal_units)
+        return buffers
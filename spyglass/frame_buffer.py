@@ -0,0 +1,274 @@
+import io
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+
+from spyglass.metrics import Metrics
+from spyglass.snapshot_variants import VariantCache
+
+# Completed by the length of the image and further headers of the part, e.g. motion detection results
+FRAME_PART_HEADER = (
+    b'--FRAME\r\n'
+    b'Content-Type: image/jpeg\r\n'
+    b'Content-Length: %d\r\n%b\r\n'
+)
+
+
+class Frame:
+    """Encoded frame, prepared once for sending to every client.
+
+    ``jpeg`` holds the buffers of the image with the EXIF header spliced in,
+    ``part`` the buffers of a complete part of the multipart stream.
+    """
+    def __init__(self, data, sequence, exif_header=None, part_headers=b''):
+        self.data = data
+        self.sequence = sequence
+        self.exif_header = exif_header
+        self.part_headers = part_headers
+        self.timestamp = time.time()
+        if exif_header is None:
+            self.jpeg = (data,)
+        else:
+            # The EXIF header replaces the SOI marker of the frame
+            self.jpeg = (exif_header, memoryview(data)[2:])
+        self.length = sum(len(b) for b in self.jpeg)
+        self.part = (FRAME_PART_HEADER % (self.length, part_headers), *self.jpeg, b'\r\n')
+
+    def replace_data(self, data):
+        """Return a frame with the same sequence number and timestamp holding other image data."""
+        frame = Frame(data, self.sequence, self.exif_header, self.part_headers)
+        frame.timestamp = self.timestamp
+        return frame
+
+
+class FrameBuffer(io.BufferedIOBase):
+    """Holds the most recent frame of a camera together with its sequence number.
+
+    A single producer (encoder output or capture thread) publishes every frame once,
+    any number of consumers read from it without touching the camera.
+    """
+    def __init__(self, exif_header=None):
+        self.exif_header = exif_header
+        self.frame = None
+        self.sequence = 0
+        self.condition = Condition()
+        self.queues = set()
+        # Futures of asyncio tasks waiting for the next frame, see wait_frame
+        self.futures = set()
+        self.metrics = Metrics()
+        self.variants = VariantCache(self.metrics)
+        # Starts and stops the camera with its clients, see spyglass.camera.on_demand
+        self.on_demand = None
+        # Adds its latest result to the frames of the stream, see spyglass.motion
+        self.motion = None
+
+    def write(self, buf):
+        with self.condition:
+            self.sequence += 1
+            frame = self.create_frame(buf, self.sequence)
+            self.frame = frame
+            self.condition.notify_all()
+            queues = tuple(self.queues)
+            futures, self.futures = self.futures, set()
+        wake_futures(futures, frame)
+        self.metrics.record_frame(frame)
+        for queue in queues:
+            queue.put(frame)
+
+    def create_frame(self, buf, sequence):
+        part_headers = self.motion.part_headers if self.motion is not None else b''
+        return Frame(buf, sequence, self.exif_header, part_headers)
+
+    def get_frame(self, sequence=0, timeout=None):
+        """Return the newest frame once it is newer than ``sequence``.
+
+        Returns immediately if such a frame already exists, otherwise waits for it.
+        Returns ``None`` if ``timeout`` expires first.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.is_newer(sequence), timeout):
+                return None
+            return self.frame
+
+    async def wait_frame(self, sequence=0, timeout=None):
+        """Like ``get_frame``, but waits on the running event loop instead of blocking a thread."""
+        with self.condition:
+            if self.is_newer(sequence):
+                return self.frame
+            future = add_future(self.futures)
+        return await wait_future(self, future, timeout)
+
+    def is_newer(self, sequence):
+        return self.frame is not None and self.sequence > sequence
+
+    def get_latest_frame(self, timeout=None):
+        return self.get_frame(0, timeout)
+
+    def get_fresh_frame(self, max_age, timeout=None):
+        """Return the newest frame if it is at most ``max_age`` seconds old, otherwise wait for the next one."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.is_fresh(max_age), timeout):
+                return None
+            return self.frame
+
+    async def wait_fresh_frame(self, max_age, timeout=None):
+        """Like ``get_fresh_frame``, but waits on the running event loop instead of blocking a thread."""
+        with self.condition:
+            if self.is_fresh(max_age):
+                return self.frame
+            future = add_future(self.futures)
+        # Every new frame is fresh
+        return await wait_future(self, future, timeout)
+
+    def is_fresh(self, max_age):
+        return self.frame is not None and time.time() - self.frame.timestamp <= max_age
+
+    def clear(self):
+        """Forget the current frame of a stopped camera, clients wait for the next frame instead."""
+        with self.condition:
+            self.frame = None
+
+    def acquire(self):
+        if self.on_demand is not None:
+            self.on_demand.acquire()
+
+    def release(self):
+        if self.on_demand is not None:
+            self.on_demand.release()
+
+    @contextmanager
+    def client(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def add_queue(self, queue):
+        with self.condition:
+            self.queues.add(queue)
+            if self.frame is not None:
+                queue.put(self.frame)
+
+    def remove_queue(self, queue):
+        with self.condition:
+            self.queues.discard(queue)
+
+
+class FrameRateLimiter:
+    """Selects evenly spaced frames for a lower framerate than the camera delivers.
+
+    Frames are accepted on a fixed grid of ``1 / fps`` seconds. A frame is accepted when
+    it is closer to the next grid time than the frame after it, so jitter of the frame
+    timestamps neither lowers the framerate nor makes the spacing uneven.
+    """
+    def __init__(self, fps):
+        self.interval = 1 / fps
+        self.next_time = 0.0
+        self.last_timestamp = 0.0
+
+    def accept(self, frame):
+        frame_interval = frame.timestamp - self.last_timestamp
+        self.last_timestamp = frame.timestamp
+        if frame.timestamp + frame_interval / 2 < self.next_time:
+            return False
+        self.next_time += self.interval
+        if self.next_time <= frame.timestamp:
+            # First frame or after a pause, start a new grid
+            self.next_time = frame.timestamp + self.interval
+        return True
+
+
+class FrameQueue:
+    """Bounded frame queue of a single client.
+
+    When the client does not keep up, the oldest queued frame is dropped so the
+    newest frame always wins. Use as context manager to subscribe to a frame buffer.
+    With ``fps`` set, only frames accepted by a ``FrameRateLimiter`` are queued.
+    """
+    def __init__(self, frame_buffer, maxlen=1, fps=None):
+        self.frame_buffer = frame_buffer
+        self.frames = deque(maxlen=maxlen)
+        self.condition = Condition()
+        self.futures = set()
+        self.dropped = 0
+        self.rate_limiter = FrameRateLimiter(fps) if fps else None
+
+    def __enter__(self):
+        self.frame_buffer.add_queue(self)
+        return self
+
+    def __exit__(self, *args):
+        self.frame_buffer.remove_queue(self)
+
+    def put(self, frame):
+        if self.rate_limiter is not None and not self.rate_limiter.accept(frame):
+            return
+        with self.condition:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self.condition.notify()
+            futures, self.futures = self.futures, set()
+        wake_futures(futures, None)
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frames, timeout):
+                return None
+            return self.frames.popleft()
+
+
+    async def wait(self, timeout=None):
+        """Like ``get``, but waits on the running event loop instead of blocking a thread."""
+        with self.condition:
+            if self.frames:
+                return self.frames.popleft()
+            future = add_future(self.futures)
+        await wait_future(self, future, timeout)
+        with self.condition:
+            return self.frames.popleft() if self.frames else None
+
+
+def add_future(futures):
+    """Add a future of the running event loop to ``futures``, call with the lock guarding them held."""
+    # Only the asyncio server waits for futures, the threaded server does not pay for the import
+    import asyncio
+
+    future = asyncio.get_running_loop().create_future()
+    futures.add(future)
+    return future
+
+
+async def wait_future(owner, future, timeout):
+    """Wait for a future added by ``add_future`` to the futures of ``owner``.
+
+    Returns ``None`` if ``timeout`` expires first.
+    """
+    import asyncio
+
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        # Woken futures are already replaced by a new set
+        with owner.condition:
+            owner.futures.discard(future)
+
+
+def wake_futures(futures, result):
+    """Resolve futures of event loops from the thread publishing a frame."""
+    for future in futures:
+        try:
+            future.get_loop().call_soon_threadsafe(set_future_result, future, result)
+        except RuntimeError:
+            # The event loop is closed
+            pass
+
+
+def set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
@@ -0,0 +1,181 @@
+import re
+import time
+
+from spyglass.frame_buffer import FrameBuffer
+
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# Profiles with chroma format and bit depth in their sequence parameter set
+HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+START_CODE = re.compile(b'\x00\x00\x01')
+
+
+class H264Frame:
+    """Access unit of an H.264 stream, split into its NAL units once for all clients.
+
+    ``nal_units`` holds the NAL units of the picture, the parameter sets are kept in
+    ``sps`` and ``pps`` for the initialization segment of new clients instead.
+    """
+    def __init__(self, data, sequence):
+        self.data = data
+        self.sequence = sequence
+        self.timestamp = time.time()
+        self.length = len(data)
+        self.sps = None
+        self.pps = None
+        self.keyframe = False
+        self.nal_units = []
+        for nal_unit in split_nal_units(data):
+            nal_type = nal_unit[0] & 0x1F
+            if nal_type == NAL_SPS:
+                self.sps = nal_unit
+            elif nal_type == NAL_PPS:
+                self.pps = nal_unit
+            elif nal_type != NAL_AUD:
+                self.nal_units.append(nal_unit)
+                if nal_type == NAL_IDR_SLICE:
+                    self.keyframe = True
+
+
+class H264FrameBuffer(FrameBuffer):
+    """Holds the most recent access unit of a hardware H.264 encoder, see ``spyglass.fmp4``."""
+    def create_frame(self, buf, sequence):
+        return H264Frame(bytes(buf), sequence)
+
+
+class BitReader:
+    """Reads the bits and Exp-Golomb codes of a NAL unit payload."""
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read_bit(self):
+        if self.position >= len(self.data) * 8:
+            raise ValueError('Unexpected end of NAL unit')
+        bit = (self.data[self.position // 8] >> (7 - self.position % 8)) & 1
+        self.position += 1
+        return bit
+
+    def read_bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.read_bit()
+        return value
+
+    def read_ue(self):
+        leading_zeros = 0
+        while self.read_bit() == 0:
+            leading_zeros += 1
+        return (1 << leading_zeros) - 1 + self.read_bits(leading_zeros)
+
+    def read_se(self):
+        value = self.read_ue()
+        return (value + 1) // 2 if value % 2 else -(value // 2)
+
+
+class SequenceParameterSet:
+    """Profile, level, chroma format and picture size parsed from an SPS NAL unit."""
+    def __init__(self, nal_unit):
+        reader = BitReader(remove_emulation_prevention(nal_unit[1:]))
+        self.profile_idc = reader.read_bits(8)
+        self.constraint_flags = reader.read_bits(8)
+        self.level_idc = reader.read_bits(8)
+        reader.read_ue()  # seq_parameter_set_id
+        self.chroma_format_idc = 1
+        self.bit_depth_luma_minus8 = 0
+        self.bit_depth_chroma_minus8 = 0
+        separate_colour_plane = 0
+        if self.profile_idc in HIGH_PROFILES:
+            self.chroma_format_idc = reader.read_ue()
+            if self.chroma_format_idc == 3:
+                separate_colour_plane = reader.read_bit()
+            self.bit_depth_luma_minus8 = reader.read_ue()
+            self.bit_depth_chroma_minus8 = reader.read_ue()
+            reader.read_bit()  # qpprime_y_zero_transform_bypass_flag
+            if reader.read_bit():
+                for i in range(8 if self.chroma_format_idc != 3 else 12):
+                    if reader.read_bit():
+                        skip_scaling_list(reader, 16 if i < 6 else 64)
+        reader.read_ue()  # log2_max_frame_num_minus4
+        pic_order_cnt_type = reader.read_ue()
+        if pic_order_cnt_type == 0:
+            reader.read_ue()  # log2_max_pic_order_cnt_lsb_minus4
+        elif pic_order_cnt_type == 1:
+            reader.read_bit()  # delta_pic_order_always_zero_flag
+            reader.read_se()  # offset_for_non_ref_pic
+            reader.read_se()  # offset_for_top_to_bottom_field
+            for _ in range(reader.read_ue()):
+                reader.read_se()  # offset_for_ref_frame
+        reader.read_ue()  # max_num_ref_frames
+        reader.read_bit()  # gaps_in_frame_num_value_allowed_flag
+        width_in_mbs = reader.read_ue() + 1
+        height_in_map_units = reader.read_ue() + 1
+        frame_mbs_only = reader.read_bit()
+        if not frame_mbs_only:
+            reader.read_bit()  # mb_adaptive_frame_field_flag
+        reader.read_bit()  # direct_8x8_inference_flag
+        crop_left = crop_right = crop_top = crop_bottom = 0
+        if reader.read_bit():
+            crop_left, crop_right, crop_top, crop_bottom = (reader.read_ue() for _ in range(4))
+
+        if self.chroma_format_idc == 0 or separate_colour_plane:
+            crop_unit_x, crop_unit_y = 1, 2 - frame_mbs_only
+        else:
+            sub_width = 1 if self.chroma_format_idc == 3 else 2
+            sub_height = 2 if self.chroma_format_idc == 1 else 1
+            crop_unit_x, crop_unit_y = sub_width, sub_height * (2 - frame_mbs_only)
+        self.width = width_in_mbs * 16 - crop_unit_x * (crop_left + crop_right)
+        self.height = (2 - frame_mbs_only) * height_in_map_units * 16 - crop_unit_y * (crop_top + crop_bottom)
+
+
+def skip_scaling_list(reader, size):
+    last_scale = next_scale = 8
+    for _ in range(size):
+        if next_scale != 0:
+            next_scale = (last_scale + reader.read_se() + 256) % 256
+        last_scale = next_scale if next_scale != 0 else last_scale
+
+
+def remove_emulation_prevention(data):
+    """Return the raw payload of a NAL unit without its emulation prevention bytes."""
+    return bytes(data).replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+def split_nal_units(data):
+    """Split an Annex B byte stream into its NAL units, without start codes."""
+    data = bytes(data)
+    starts = [m.end() for m in START_CODE.finditer(data)]
+    nal_units = []
+    for start, end in zip(starts, starts[1:] + [len(data) + 3]):
+        # Trailing zero bytes belong to the four byte start code of the next NAL unit
+        nal_unit = data[start:end - 3].rstrip(b'\x00')
+        if nal_unit:
+            nal_units.append(nal_unit)
+    return nal_units
+
+
+def split_access_units(data):
+    """Split an Annex B byte stream into access units, e.g. to replay a recorded stream."""
+    access_units = []
+    current = []
+    has_slice = False
+    for nal_unit in split_nal_units(data):
+        nal_type = nal_unit[0] & 0x1F
+        is_slice = nal_type in (NAL_SLICE, NAL_IDR_SLICE)
+        # A new picture starts with parameter sets, an SEI, a delimiter or its first slice
+        first_slice = is_slice and len(nal_unit) > 1 and nal_unit[1] & 0x80
+        if has_slice and (first_slice or nal_type in (NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD)):
+            access_units.append(b''.join(b'\x00\x00\x00\x01' + n for n in current))
+            current = []
+            has_slice = False
+        current.append(nal_unit)
+        has_slice = has_slice or is_slice
+    if current:
+        access_units.append(b''.join(b'\x00\x00\x00\x01' + n for n in current))
+    return access_units
@@ -0,0 +1,285 @@
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread
+
+from spyglass import logger
+
+# Upper bounds in seconds of the encode-to-send latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Upper bounds in seconds of the histogram of camera starts until the first frame
+COLD_START_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Number of recent frames used to calculate the current framerate
+FPS_WINDOW = 64
+# Phases of the startup report in their order
+STARTUP_PHASES = ('import', 'camera_init', 'configure', 'first_frame')
+# Prometheus metrics of the camera instead of a single stream, recorded in the metrics of its main frame buffer
+CAMERA_METRICS = ('camera_running', 'camera_starts_total', 'cold_start_seconds', 'startup_seconds')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class ClientMetrics:
+    def __init__(self, address):
+        self.address = address
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+
+class Metrics:
+    """Counters of the streaming pipeline of a single camera.
+
+    Every value is written by one thread only or tolerates the rare lost update of
+    an unsynchronized increment, so recording a frame does not take any lock.
+    """
+    def __init__(self):
+        self.frames_encoded = 0
+        # Encoded frames lost before the frame buffer, e.g. too large for the shared memory of a capture process
+        self.frames_dropped = 0
+        self.frame_bytes = 0
+        self.frame_times = deque(maxlen=FPS_WINDOW)
+        self.send_latency = Histogram(LATENCY_BUCKETS)
+        self.stream_connections = 0
+        self.snapshot_connections = 0
+        self.variant_hits = 0
+        self.variant_misses = 0
+        self.camera_running = 0
+        self.camera_starts = 0
+        self.cold_start_time = None
+        self.cold_start_latency = Histogram(COLD_START_BUCKETS)
+        self.startup_seconds = {}
+        self.clients = {}
+
+    def record_frame(self, frame):
+        self.frames_encoded += 1
+        self.frame_bytes += frame.length
+        self.frame_times.append(frame.timestamp)
+        cold_start_time = self.cold_start_time
+        if cold_start_time is not None:
+            self.cold_start_time = None
+            self.cold_start_latency.observe(frame.timestamp - cold_start_time)
+
+    def record_dropped_frames(self, count):
+        self.frames_dropped += count
+
+    def record_camera_start(self):
+        self.camera_starts += 1
+        self.camera_running = 1
+        self.cold_start_time = time.time()
+
+    def record_camera_stop(self):
+        self.camera_running = 0
+        self.cold_start_time = None
+
+    def record_sent_frame(self, client, frame, length, frames_dropped=0):
+        client.frames_sent += 1
+        client.bytes_sent += length
+        client.frames_dropped = frames_dropped
+        self.send_latency.observe(time.time() - frame.timestamp)
+
+    @contextmanager
+    def stream_client(self, address):
+        # Clients of a Unix domain socket have no address
+        client = ClientMetrics('%s:%s' % address[:2] if isinstance(address, tuple) else str(address or 'unix'))
+        self.clients[id(client)] = client
+        self.stream_connections += 1
+        try:
+            yield client
+        finally:
+            self.stream_connections -= 1
+            del self.clients[id(client)]
+
+    @contextmanager
+    def snapshot_client(self):
+        self.snapshot_connections += 1
+        try:
+            yield
+        finally:
+            self.snapshot_connections -= 1
+
+    def get_fps(self):
+        frame_times = tuple(self.frame_times)
+        if len(frame_times) < 2 or frame_times[-1] <= frame_times[0]:
+            return 0.0
+        return (len(frame_times) - 1) / (frame_times[-1] - frame_times[0])
+
+    def get_average_frame_size(self):
+        return self.frame_bytes / self.frames_encoded if self.frames_encoded else 0.0
+
+    def to_dict(self, camera=True):
+        """Return the metrics as dict, without the camera-wide ones for the further streams of a camera."""
+        content = {
+            'frames_encoded': self.frames_encoded,
+            'frames_dropped': self.frames_dropped,
+            'frames_per_second': self.get_fps(),
+            'average_frame_bytes': self.get_average_frame_size(),
+            'stream_connections': self.stream_connections,
+            'snapshot_connections': self.snapshot_connections,
+            'snapshot_variant_cache': {
+                'hits': self.variant_hits,
+                'misses': self.variant_misses
+            },
+            'send_latency_seconds': {
+                'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'],
+                                    self.send_latency.cumulative_counts())),
+                'sum': self.send_latency.sum,
+                'count': self.send_latency.count
+            }
+        }
+        if camera:
+            content.update({
+                'camera_running': self.camera_running,
+                'camera_starts': self.camera_starts,
+                'cold_start_seconds': {
+                    'buckets': dict(zip([str(b) for b in COLD_START_BUCKETS] + ['+Inf'],
+                                        self.cold_start_latency.cumulative_counts())),
+                    'sum': self.cold_start_latency.sum,
+                    'count': self.cold_start_latency.count
+                },
+                'startup_seconds': dict(self.startup_seconds)
+            })
+        content['clients'] = [
+            {
+                'address': client.address,
+                'bytes_sent': client.bytes_sent,
+                'frames_sent': client.frames_sent,
+                'frames_dropped': client.frames_dropped
+            }
+            for client in list(self.clients.values())
+        ]
+        return content
+
+    def to_prometheus(self):
+        return streams_to_prometheus({None: self})
+
+    def prometheus_families(self):
+        """Yield name, type, description and samples of every metric."""
+        clients = list(self.clients.values())
+        yield ('frames_encoded_total', 'counter', 'Frames received from the encoder',
+               [('', {}, self.frames_encoded)])
+        yield ('frames_dropped_total', 'counter', 'Encoded frames lost before reaching the frame buffer',
+               [('', {}, self.frames_dropped)])
+        yield ('frames_per_second', 'gauge', 'Current rate of encoded frames',
+               [('', {}, round(self.get_fps(), 3))])
+        yield ('frame_bytes_average', 'gauge', 'Average size of an encoded frame in bytes',
+               [('', {}, round(self.get_average_frame_size(), 1))])
+        yield ('stream_connections', 'gauge', 'Active stream connections',
+               [('', {}, self.stream_connections)])
+        yield ('snapshot_connections', 'gauge', 'Active snapshot connections',
+               [('', {}, self.snapshot_connections)])
+        yield ('snapshot_variant_cache_hits_total', 'counter', 'Resized or cropped snapshots served from the cache',
+               [('', {}, self.variant_hits)])
+        yield ('snapshot_variant_cache_misses_total', 'counter', 'Resized or cropped snapshots computed',
+               [('', {}, self.variant_misses)])
+        yield ('send_latency_seconds', 'histogram', 'Time from encoded frame to sent frame',
+               [('_bucket', {'le': le}, count) for le, count in
+                zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], self.send_latency.cumulative_counts())]
+               + [('_sum', {}, self.send_latency.sum), ('_count', {}, self.send_latency.count)])
+        yield ('camera_running', 'gauge', 'Camera started on demand is running',
+               [('', {}, self.camera_running)])
+        yield ('camera_starts_total', 'counter', 'Starts of the camera on demand',
+               [('', {}, self.camera_starts)])
+        yield ('cold_start_seconds', 'histogram', 'Time from starting the camera on demand to its first frame',
+               [('_bucket', {'le': le}, count) for le, count in
+                zip([str(b) for b in COLD_START_BUCKETS] + ['+Inf'], self.cold_start_latency.cumulative_counts())]
+               + [('_sum', {}, self.cold_start_latency.sum), ('_count', {}, self.cold_start_latency.count)])
+        yield ('startup_seconds', 'gauge', 'Duration of a phase of the spyglass startup',
+               [('', {'phase': phase}, round(seconds, 4)) for phase, seconds in self.startup_seconds.items()])
+        yield ('client_bytes_sent_total', 'counter', 'Bytes sent to a stream client',
+               [('', {'client': c.address}, c.bytes_sent) for c in clients])
+        yield ('client_frames_dropped_total', 'counter', 'Frames skipped for a slow stream client',
+               [('', {'client': c.address}, c.frames_dropped) for c in clients])
+
+
+def streams_to_dict(streams):
+    """Return the metrics of the first stream of a camera with the metrics of the further ``streams``."""
+    (_, metrics), *others = streams.items()
+    content = metrics.to_dict()
+    if others:
+        content['streams'] = {stream: metrics.to_dict(camera=False) for stream, metrics in others}
+    return content
+
+
+def streams_to_prometheus(streams):
+    """Return the metrics of the frame buffers of a camera in the Prometheus text format.
+
+    ``streams`` maps the name of every stream to its metrics, the samples get the name as ``stream``
+    label unless it is ``None``. The camera-wide metrics are taken from the first stream without label.
+    """
+    families = {}
+    for index, (stream, metrics) in enumerate(streams.items()):
+        for name, metric_type, description, samples in metrics.prometheus_families():
+            if name in CAMERA_METRICS and index > 0:
+                continue
+            stream_labels = {'stream': stream} if stream is not None and name not in CAMERA_METRICS else {}
+            family = families.setdefault(name, (metric_type, description, []))
+            family[2].extend((suffix, {**stream_labels, **labels}, value) for suffix, labels, value in samples)
+    lines = []
+    for name, (metric_type, description, samples) in families.items():
+        lines.append(f'# HELP spyglass_{name} {description}')
+        lines.append(f'# TYPE spyglass_{name} {metric_type}')
+        for suffix, labels, value in samples:
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            label_str = f'{{{label_str}}}' if label_str else ''
+            lines.append(f'spyglass_{name}{suffix}{label_str} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class StartupTimer:
+    """Measures the phases from starting spyglass to the first frame of its cameras.
+
+    The report is logged and published in the metrics of the cameras once their first frame arrived.
+    """
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def report_on_first_frame(self, frame_buffers):
+        """Wait in a background thread for the first frame of every frame buffer, then report."""
+        start = time.perf_counter()
+
+        def wait_for_frames():
+            for frame_buffer in frame_buffers:
+                frame_buffer.get_frame()
+            self.phases['first_frame'] = time.perf_counter() - start
+            self.report(frame_buffers)
+
+        thread = Thread(target=wait_for_frames, daemon=True)
+        thread.start()
+        return thread
+
+    def report(self, frame_buffers=()):
+        phases = {phase: self.phases[phase] for phase in STARTUP_PHASES if phase in self.phases}
+        for frame_buffer in frame_buffers:
+            frame_buffer.metrics.startup_seconds = phases
+        logger.info('Startup took %.3fs: %s', sum(phases.values()),
+                    ', '.join(f'{phase} {seconds:.3f}s' for phase, seconds in phases.items()))
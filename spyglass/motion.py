@@ -0,0 +1,122 @@
+"""Motion detection on small luma (Y plane) frames with NumPy.
+
+The detector compares every frame with the previous one for activity and with a running
+average background model for changes that persist, e.g. a part detached from the bed.
+Frames are only analyzed at a low rate, see ``MotionDetector.due``.
+"""
+
+import json
+import time
+
+from threading import Lock
+
+# Maximum size of the luma frames, the lores stream is configured at most this large for motion detection
+MOTION_SIZE = (320, 240)
+# Pixels of the analyzed frames are every n-th pixel of every n-th row of the luma frames
+MOTION_DECIMATION = 2
+# Fraction of changed pixels counted as motion
+MOTION_MIN_AREA = 0.002
+# Weight of a new frame in the background model
+BACKGROUND_LEARNING_RATE = 0.05
+
+
+class MotionDetector:
+    """Detects motion in luma frames analyzed at ``fps``.
+
+    A pixel changed when its luma differs by more than ``threshold`` from the previous frame
+    (``area``) or from the background model (``foreground``). The latest result is published
+    as JSON and as headers of the frames of a stream.
+    """
+    def __init__(self, fps=2.0, threshold=25, min_area=MOTION_MIN_AREA):
+        self.interval = 1 / fps
+        self.threshold = threshold
+        self.min_area = min_area
+        self.next_time = 0.0
+        self.lock = Lock()
+        self.previous = None
+        self.background = None
+        self.frames = 0
+        self.last_motion = None
+        self.result = {'motion': False, 'area': 0.0, 'foreground': 0.0, 'box': None, 'timestamp': None}
+        self.part_headers = b''
+
+    def due(self, timestamp):
+        """Return whether the frame of ``timestamp`` should be analyzed, skipping frames above the rate."""
+        if timestamp < self.next_time:
+            return False
+        self.next_time = timestamp + self.interval
+        return True
+
+    def update(self, luma, timestamp=None):
+        """Analyze a luma frame given as 2D array, returns the result."""
+        import numpy as np
+
+        timestamp = time.time() if timestamp is None else timestamp
+        frame = np.asarray(luma)[::MOTION_DECIMATION, ::MOTION_DECIMATION].astype(np.float32)
+        with self.lock:
+            if self.previous is None or self.previous.shape != frame.shape:
+                # First frame or new resolution
+                self.previous = frame
+                self.background = frame.copy()
+                return self.publish(False, 0.0, 0.0, None, timestamp)
+            changed = np.abs(frame - self.previous) > self.threshold
+            foreground = np.abs(frame - self.background) > self.threshold
+            self.background += BACKGROUND_LEARNING_RATE * (frame - self.background)
+            self.previous = frame
+            area = float(changed.mean())
+            motion = area >= self.min_area
+            return self.publish(motion, area, float(foreground.mean()), get_box(changed) if motion else None,
+                                timestamp)
+
+    def publish(self, motion, area, foreground, box, timestamp):
+        self.frames += 1
+        if motion:
+            self.last_motion = timestamp
+        self.result = {
+            'motion': motion,
+            'area': round(area, 5),
+            'foreground': round(foreground, 5),
+            'box': box,
+            'timestamp': timestamp
+        }
+        self.part_headers = b'X-Motion: %d\r\nX-Motion-Area: %.5f\r\n' % (motion, area)
+        return self.result
+
+    def reset(self):
+        """Forget the background, e.g. after the camera was stopped."""
+        with self.lock:
+            self.previous = None
+            self.background = None
+
+    def to_json(self):
+        with self.lock:
+            content = {**self.result, 'last_motion': self.last_motion, 'frames': self.frames,
+                       'fps': 1 / self.interval, 'threshold': self.threshold}
+        return json.dumps(content).encode('utf-8')
+
+
+def get_box(changed):
+    """Return the bounding box ``[x, y, width, height]`` of the changed pixels in luma frame coordinates."""
+    import numpy as np
+
+    rows = np.flatnonzero(changed.any(axis=1))
+    columns = np.flatnonzero(changed.any(axis=0))
+    x, y = int(columns[0]), int(rows[0])
+    width, height = int(columns[-1]) - x + 1, int(rows[-1]) - y + 1
+    return [v * MOTION_DECIMATION for v in (x, y, width, height)]
+
+
+def get_motion_size(width, height):
+    """Return the size of the luma frames of a ``width`` x ``height`` image keeping its aspect ratio."""
+    scale = min(1.0, MOTION_SIZE[0] / width, MOTION_SIZE[1] / height)
+    # The ISP needs even sizes
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+def jpeg_to_luma(jpeg, size):
+    """Decode a JPEG image into a luma array of the given size, e.g. for recorded frames."""
+    import io
+    import numpy as np
+    from PIL import Image
+
+    return np.asarray(Image.open(io.BytesIO(jpeg)).convert('L').resize(size))
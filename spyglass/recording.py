@@ -0,0 +1,159 @@
+"""Pre-event recording: keeps the last seconds of a stream in memory and saves them as clip on request.
+
+The encoder only appends a reference to every frame to the ring, clips are written to disk
+by a background thread so neither the encoder nor request handlers wait for the disk.
+"""
+
+import os
+import struct
+import time
+
+from collections import deque
+from queue import Queue
+from threading import Lock, Thread
+
+from spyglass import logger
+
+# Index flag of frames that can be decoded on their own, which every JPEG is
+AVIIF_KEYFRAME = 0x10
+AVIF_HASINDEX = 0x10
+# JPEG markers of the frame headers holding the image size
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class FrameRing:
+    """Frames of the last ``seconds``, using at most ``max_bytes`` of encoded frame data.
+
+    Subscribed to a frame buffer like a ``FrameQueue``, the oldest frames are evicted as new ones arrive.
+    """
+    def __init__(self, seconds, max_bytes):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.size = 0
+        self.lock = Lock()
+
+    def put(self, frame):
+        with self.lock:
+            self.frames.append(frame)
+            self.size += frame.length
+            while len(self.frames) > 1 and (self.size > self.max_bytes
+                                            or frame.timestamp - self.frames[0].timestamp > self.seconds):
+                self.size -= self.frames.popleft().length
+
+    def get_frames(self, seconds=None):
+        """Return the frames of the last ``seconds``, or all frames in the ring."""
+        with self.lock:
+            frames = list(self.frames)
+        if seconds is not None and frames:
+            start = frames[-1].timestamp - seconds
+            frames = [frame for frame in frames if frame.timestamp >= start]
+        return frames
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.size = 0
+
+
+class ClipRecorder:
+    """Records the frames of a frame buffer into a ``FrameRing`` and saves clips as MJPEG AVI files."""
+    def __init__(self, frame_buffer, directory, seconds, max_bytes):
+        self.directory = directory
+        self.ring = FrameRing(seconds, max_bytes)
+        self.jobs = Queue()
+        # Held from queueing a clip until it is written, the frames of a clip stay in memory until then
+        self.saving = Lock()
+        frame_buffer.add_queue(self.ring)
+        Thread(target=self._write_clips, daemon=True).start()
+
+    def save_clip(self, seconds=None):
+        """Queue the frames of the last ``seconds`` for writing and return a description of the clip.
+
+        Raises ``ValueError`` if there are no frames to save or the previous clip is not written yet.
+        """
+        frames = self.ring.get_frames(seconds)
+        if not frames:
+            raise ValueError('No frames recorded yet')
+        if not self.saving.acquire(blocking=False):
+            raise ValueError('Still saving the previous clip')
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(frames[-1].timestamp))
+        # Clips of different lengths may end with the same frame
+        path = os.path.join(self.directory, f'clip-{stamp}-{frames[0].sequence}-{frames[-1].sequence}.avi')
+        self.jobs.put((path, frames))
+        return {
+            'path': path,
+            'frames': len(frames),
+            'seconds': round(frames[-1].timestamp - frames[0].timestamp, 3)
+        }
+
+    def _write_clips(self):
+        while True:
+            path, frames = self.jobs.get()
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                # Clips appear under their name only once complete
+                with open(path + '.part', 'wb') as f:
+                    write_avi(f, frames)
+                os.replace(path + '.part', path)
+                logger.info('Saved clip %s with %d frames', path, len(frames))
+            except Exception as e:
+                logger.error('Failed to save clip %s: %s', path, e)
+            finally:
+                self.saving.release()
+                self.jobs.task_done()
+
+
+def write_avi(f, frames):
+    """Write JPEG frames to a file object as MJPEG AVI, the framerate is taken from the frame timestamps."""
+    width, height = get_jpeg_size(b''.join(frames[0].jpeg))
+    duration = frames[-1].timestamp - frames[0].timestamp
+    fps = (len(frames) - 1) / duration if len(frames) > 1 and duration > 0 else 1.0
+    max_length = max(frame.length for frame in frames)
+
+    avih = struct.pack('<10I16x', round(1000000 / fps), round(max_length * fps), 0, AVIF_HASINDEX,
+                       len(frames), 0, 1, max_length, width, height)
+    strh = struct.pack('<4s4sI2H8I4h', b'vids', b'MJPG', 0, 0, 0, 0, 1000, round(fps * 1000), 0,
+                       len(frames), max_length, 0xFFFFFFFF, 0, 0, 0, width, height)
+    strf = struct.pack('<IiiHH4sIiiII', 40, width, height, 1, 24, b'MJPG', width * height * 3, 0, 0, 0, 0)
+    hdrl = list_chunk(b'hdrl', chunk(b'avih', avih), list_chunk(b'strl', chunk(b'strh', strh), chunk(b'strf', strf)))
+
+    movi_size = 4 + sum(8 + frame.length + frame.length % 2 for frame in frames)
+    idx1_size = 8 + 16 * len(frames)
+    f.write(struct.pack('<4sI4s', b'RIFF', 4 + len(hdrl) + 8 + movi_size + idx1_size, b'AVI '))
+    f.write(hdrl)
+    f.write(struct.pack('<4sI4s', b'LIST', movi_size, b'movi'))
+    index = []
+    # Index offsets are relative to the movi fourcc
+    offset = 4
+    for frame in frames:
+        f.write(struct.pack('<4sI', b'00dc', frame.length))
+        for buf in frame.jpeg:
+            f.write(buf)
+        if frame.length % 2:
+            f.write(b'\x00')
+        index.append(struct.pack('<4s3I', b'00dc', AVIIF_KEYFRAME, offset, frame.length))
+        offset += 8 + frame.length + frame.length % 2
+    f.write(chunk(b'idx1', b''.join(index)))
+
+
+def chunk(fourcc, data):
+    return struct.pack('<4sI', fourcc, len(data)) + data + b'\x00' * (len(data) % 2)
+
+
+def list_chunk(list_type, *chunks):
+    return chunk(b'LIST', list_type + b''.join(chunks))
+
+
+def get_jpeg_size(data):
+    """Return width and height from the frame header of a JPEG image, raises ``ValueError`` if there is none."""
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            raise ValueError('Invalid JPEG marker')
+        marker = data[position + 1]
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[position + 5:position + 9])
+            return width, height
+        position += 2 + struct.unpack('>H', data[position + 2:position + 4])[0]
+    raise ValueError('No JPEG frame header found')
@@ -1,94 +1,534 @@
 #!/usr/bin/python3
 
+import json
+import os
 import socketserver
+import stat
+import time
 
+from email.utils import formatdate, parsedate_to_datetime
 from http import server
 
 from spyglass import logger
-from spyglass.url_parsing import check_urls_match, get_url_params
-from spyglass.exif import create_exif_header
-from spyglass.camera_options import parse_dictionary_to_html_page, process_controls
+from spyglass.url_parsing import RouteTable, get_url_params
+from spyglass.fmp4 import Fmp4Stream
+from spyglass.frame_buffer import FrameQueue
+from spyglass.metrics import streams_to_dict, streams_to_prometheus
+from spyglass.snapshot_variants import parse_variant
+from spyglass.camera_options import CameraControls
+
+# Distinguishes ETags of frames with the same sequence number across restarts
+ETAG_PREFIX = '%x' % int(time.time())
+# Seconds a persistent connection may stay idle between requests
+KEEP_ALIVE_TIMEOUT = 60
+# H.264 frames queued for a slow fMP4 client, dropping one makes it wait for the next keyframe
+FMP4_QUEUE_LENGTH = 30
+# Permissions of the Unix domain socket, connecting needs write access, e.g. for nginx in the group of the spyglass user
+UNIX_SOCKET_MODE = 0o660
+# Seconds a snapshot or new stream client waits for a frame before getting 503 Service Unavailable
+FRAME_TIMEOUT = 10
+# Largest accepted body of a POST request, the JSON APIs only take small objects
+MAX_CONTENT_LENGTH = 64 * 1024
+
+class CameraEndpoints:
+    """URLs and frame source of a single camera served by the streaming server."""
+    def __init__(self,
+                 picam2,
+                 frame_buffer,
+                 url_prefix='',
+                 stream_url='/stream',
+                 snapshot_url='/snapshot',
+                 lores_frame_buffer=None,
+                 lores_stream_url='/lores/stream',
+                 lores_snapshot_url='/lores/snapshot',
+                 controls=None,
+                 reconfigure=None,
+                 h264_frame_buffer=None,
+                 h264_stream_url='/stream.mp4',
+                 recorder=None,
+                 timelapse=None,
+                 motion=None):
+        self.picam2 = picam2
+        # Applies changed camera settings, see Camera.reconfigure
+        self.reconfigure = reconfigure
+        # Saves the last seconds of the stream, see spyglass.recording
+        self.recorder = recorder
+        # Timelapse jobs of the camera, see spyglass.timelapse
+        self.timelapse = timelapse
+        # Motion detector of the camera, see spyglass.motion
+        self.motion = motion
+        self.controls = controls if controls is not None else CameraControls(picam2)
+        self.frame_buffer = frame_buffer
+        self.lores_frame_buffer = lores_frame_buffer
+        self.h264_frame_buffer = h264_frame_buffer
+        self.stream_url = join_url(url_prefix, stream_url)
+        self.snapshot_url = join_url(url_prefix, snapshot_url)
+        self.lores_stream_url = join_url(url_prefix, lores_stream_url)
+        self.lores_snapshot_url = join_url(url_prefix, lores_snapshot_url)
+        self.h264_stream_url = join_url(url_prefix, h264_stream_url)
+        self.controls_url = join_url(url_prefix, '/controls')
+        self.controls_api_url = join_url(url_prefix, '/api/controls')
+        self.metrics_url = join_url(url_prefix, '/metrics')
+        self.config_api_url = join_url(url_prefix, '/api/config')
+        self.clip_api_url = join_url(url_prefix, '/api/clip')
+        self.timelapse_api_url = join_url(url_prefix, '/api/timelapse')
+        self.motion_url = join_url(url_prefix, '/motion')
+
+    def frame_buffers(self):
+        return [fb for fb in (self.frame_buffer, self.lores_frame_buffer, self.h264_frame_buffer) if fb is not None]
+
+    def stream_metrics(self):
+        """Map the name of every stream of the camera to the metrics of its frame buffer, the main stream first."""
+        streams = {'main': self.frame_buffer, 'lores': self.lores_frame_buffer, 'h264': self.h264_frame_buffer}
+        return {stream: fb.metrics for stream, fb in streams.items() if fb is not None}
+
+    def add_routes(self, routes):
+        """Add the URLs of the camera to a ``RouteTable`` as ``(kind, camera, frame buffer)`` routes."""
+        routes.add(self.stream_url, ('stream', self, self.frame_buffer))
+        routes.add(self.snapshot_url, ('snapshot', self, self.frame_buffer))
+        if self.lores_frame_buffer is not None:
+            routes.add(self.lores_stream_url, ('stream', self, self.lores_frame_buffer))
+            routes.add(self.lores_snapshot_url, ('snapshot', self, self.lores_frame_buffer))
+        if self.h264_frame_buffer is not None:
+            routes.add(self.h264_stream_url, ('fmp4', self, self.h264_frame_buffer))
+        routes.add(self.metrics_url, ('metrics', self, self.frame_buffer))
+        routes.add(self.controls_url, ('controls', self, self.frame_buffer))
+        routes.add(self.controls_api_url, ('controls_api', self, self.frame_buffer))
+        if self.reconfigure is not None:
+            routes.add(self.config_api_url, ('config_api', self, self.frame_buffer))
+        if self.recorder is not None:
+            routes.add(self.clip_api_url, ('clip_api', self, self.frame_buffer))
+        if self.motion is not None:
+            routes.add(self.motion_url, ('motion', self, self.frame_buffer))
+        if self.timelapse is not None:
+            routes.add(self.timelapse_api_url, ('timelapse_api', self, self.frame_buffer))
+
 
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
+    # The default of 5 makes connection bursts wait for SYN retransmits
+    request_queue_size = 64
+
+
+class UnixStreamingServer(socketserver.ThreadingUnixStreamServer):
+    """Serves the same routes as ``StreamingServer`` on a Unix domain socket for local clients."""
+    daemon_threads = True
+    request_queue_size = 64
+
+    def server_bind(self):
+        remove_stale_socket(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, UNIX_SOCKET_MODE)
+
+    def server_close(self):
+        super().server_close()
+        remove_stale_socket(self.server_address)
+
+
+def remove_stale_socket(path):
+    """Remove the socket file left by a previous server, other files are kept."""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.picam2 = None
-        self.exif_header = None
-        self.stream_url = None
-        self.snapshot_url = None
-        self.get_frame = None
+    # Keeps connections of snapshot and controls clients open for further requests
+    protocol_version = 'HTTP/1.1'
+    # Closes idle persistent connections and connections of stalled clients
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def address_string(self):
+        # Clients of a Unix domain socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
 
     def do_GET(self):
-        if check_urls_match(self.stream_url, self.path):
-            self.start_streaming()
-        elif check_urls_match(self.snapshot_url, self.path):
-            self.send_snapshot()
-        elif check_urls_match('/controls', self.path):
-            parsed_controls = get_url_params(self.path)
-            parsed_controls = parsed_controls if parsed_controls else None
-            processed_controls = process_controls(self.picam2, parsed_controls)
-            self.picam2.set_controls(processed_controls)
-            content = parse_dictionary_to_html_page(self.picam2, parsed_controls, processed_controls).encode('utf-8')
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.send_header('Content-Length', len(content))
-            self.end_headers()
-            self.wfile.write(content)
+        route = self.routes.match(self.path)
+        if route is None:
+            self.send_error(404)
+            return
+        kind, camera, frame_buffer = route
+        if kind == 'stream':
+            self.start_streaming(frame_buffer)
+        elif kind == 'fmp4':
+            self.start_fmp4_streaming(frame_buffer)
+        elif kind == 'snapshot':
+            self.send_snapshot(frame_buffer)
+        elif kind == 'metrics':
+            self.send_metrics(camera)
+        elif kind == 'timelapse_api':
+            self.send_json(get_timelapse_json(camera))
+        elif kind == 'motion':
+            self.send_json(camera.motion.to_json())
+        elif kind in ('controls', 'controls_api'):
+            try:
+                if kind == 'controls':
+                    self.send_controls(camera)
+                else:
+                    self.send_json(get_controls_json(camera, self.path))
+            except ValueError as e:
+                self.send_error(400, str(e))
         else:
+            self.send_error(405)
+
+    def do_POST(self):
+        route = self.routes.match(self.path)
+        if route is None:
             self.send_error(404)
-            self.end_headers()
+            return
+        kind, camera, _ = route
+        if kind not in POST_HANDLERS:
+            self.send_error(405)
+            return
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.send_error(411)
+            return
+        try:
+            length = get_content_length(length)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            content = POST_HANDLERS[kind](camera, self.rfile.read(length))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_json(content)
 
-    def start_streaming(self):
+    def start_streaming(self, frame_buffer):
         try:
-            self.send_response(200)
-            self.send_default_headers()
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
-            self.end_headers()
-            while True:
-                frame = self.get_frame()
-                self.wfile.write(b'--FRAME\r\n')
-                if self.exif_header is None:
-                    self.send_jpeg_content_headers(frame)
+            fps = get_stream_fps(self.path)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        metrics = frame_buffer.metrics
+        if not self.acquire_camera(frame_buffer):
+            return
+        try:
+            with FrameQueue(frame_buffer, fps=fps) as frame_queue, metrics.stream_client(self.client_address) as client:
+                frame = frame_queue.get(FRAME_TIMEOUT)
+                if frame is None:
+                    self.send_error(503, 'No frame from the camera')
+                    return
+                try:
+                    self.send_response(200)
+                    self.send_default_headers()
+                    self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+                    self.send_header('Connection', 'close')
                     self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-                else:
-                    self.send_jpeg_content_headers(frame, len(self.exif_header) - 2)
+                    while True:
+                        length = send_buffers(self.connection, frame.part)
+                        metrics.record_sent_frame(client, frame, length, frame_queue.dropped)
+                        frame = frame_queue.get()
+                except Exception as e:
+                    logger.warning(
+                        'Removed streaming client %s (%d frames dropped): %s',
+                        self.client_address, frame_queue.dropped, str(e))
+        finally:
+            frame_buffer.release()
+
+    def start_fmp4_streaming(self, frame_buffer):
+        metrics = frame_buffer.metrics
+        if not self.acquire_camera(frame_buffer):
+            return
+        try:
+            with FrameQueue(frame_buffer, maxlen=FMP4_QUEUE_LENGTH) as frame_queue, \
+                    metrics.stream_client(self.client_address) as client:
+                frame = frame_queue.get(FRAME_TIMEOUT)
+                if frame is None:
+                    self.send_error(503, 'No frame from the camera')
+                    return
+                try:
+                    self.send_response(200)
+                    self.send_default_headers()
+                    self.send_header('Content-Type', 'video/mp4')
+                    self.send_header('Connection', 'close')
                     self.end_headers()
-                    self.wfile.write(self.exif_header)
-                    self.wfile.write(frame[2:])
-                    self.wfile.write(b'\r\n')
-        except Exception as e:
-            logger.warning('Removed streaming client %s: %s', self.client_address, str(e))
+                    stream = Fmp4Stream()
+                    dropped = 0
+                    while True:
+                        if frame_queue.dropped != dropped:
+                            dropped = frame_queue.dropped
+                            stream.resync()
+                        buffers = stream.get_buffers(frame)
+                        if buffers:
+                            length = send_buffers(self.connection, buffers)
+                            metrics.record_sent_frame(client, frame, length, frame_queue.dropped)
+                        frame = frame_queue.get()
+                except Exception as e:
+                    logger.warning(
+                        'Removed fMP4 streaming client %s (%d frames dropped): %s',
+                        self.client_address, frame_queue.dropped, str(e))
+        finally:
+            frame_buffer.release()
+
+    def send_snapshot(self, frame_buffer):
+        try:
+            variant = parse_variant(self.path)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if not self.acquire_camera(frame_buffer):
+            return
+        try:
+            with frame_buffer.metrics.snapshot_client():
+                try:
+                    frame = frame_buffer.get_fresh_frame(self.snapshot_max_age, FRAME_TIMEOUT)
+                    if frame is None:
+                        self.send_error(503, 'No frame from the camera')
+                        return
+                    if is_not_modified(self.headers, frame, variant):
+                        self.send_response(304)
+                        self.send_snapshot_headers(frame, variant)
+                        self.end_headers()
+                        return
+                    if variant is not None:
+                        try:
+                            frame = frame_buffer.variants.get(frame, variant)
+                        except ValueError as e:
+                            self.send_error(400, str(e))
+                            return
+                    self.send_response(200)
+                    self.send_snapshot_headers(frame, variant)
+                    self.send_jpeg_content_headers(frame)
+                    self.end_headers()
+                    send_buffers(self.connection, frame.jpeg)
+                except Exception as e:
+                    self.close_connection = True
+                    logger.warning(
+                        'Removed client %s: %s',
+                        self.client_address, str(e))
+        finally:
+            frame_buffer.release()
 
-    def send_snapshot(self):
+    def acquire_camera(self, frame_buffer):
+        """Start a camera started on demand, answers with 503 and returns ``False`` if it fails to start."""
         try:
-            self.send_response(200)
-            self.send_default_headers()
-            frame = self.get_frame()
-            if self.exif_header is None:
-                self.send_jpeg_content_headers(frame)
-                self.end_headers()
-                self.wfile.write(frame)
-            else:
-                self.send_jpeg_content_headers(frame, len(self.exif_header) - 2)
-                self.end_headers()
-                self.wfile.write(self.exif_header)
-                self.wfile.write(frame[2:])
+            frame_buffer.acquire()
         except Exception as e:
-            logger.warning(
-                'Removed client %s: %s',
-                self.client_address, str(e))
+            logger.error('Failed to start camera: %s', e)
+            self.send_error(503, 'Failed to start the camera')
+            return False
+        return True
+
+    def send_metrics(self, camera):
+        content_type, content = get_metrics_content(camera, self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_controls(self, camera):
+        content = get_controls_content(camera, self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_json(self, content):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_snapshot_headers(self, frame, variant=None):
+        for key, value in get_snapshot_headers(frame, variant):
+            self.send_header(key, value)
 
     def send_default_headers(self):
         self.send_header('Age', 0)
         self.send_header('Cache-Control', 'no-cache, private')
         self.send_header('Pragma', 'no-cache')
 
-    def send_jpeg_content_headers(self, frame, extra_len=0):
+    def send_jpeg_content_headers(self, frame):
         self.send_header('Content-Type', 'image/jpeg')
-        self.send_header('Content-Length', str(len(frame) + extra_len))
+        self.send_header('Content-Length', str(frame.length))
+
+
+def create_routes(cameras):
+    routes = RouteTable()
+    for camera in cameras:
+        camera.add_routes(routes)
+    return routes
+
+
+def join_url(url_prefix, url):
+    if not url_prefix:
+        return url
+    return url_prefix.rstrip('/') + '/' + url.lstrip('/')
+
+
+def get_etag(frame, variant=None):
+    """Return the entity tag of a frame, every snapshot variant of the frame has its own."""
+    if variant is None:
+        return f'"{ETAG_PREFIX}-{frame.sequence:x}"'
+    return f'"{ETAG_PREFIX}-{frame.sequence:x}-{variant.tag()}"'
+
+
+def get_snapshot_headers(frame, variant=None):
+    return [
+        ('Age', int(time.time() - frame.timestamp)),
+        ('Cache-Control', 'no-cache, private'),
+        ('ETag', get_etag(frame, variant)),
+        ('Last-Modified', formatdate(frame.timestamp, usegmt=True))
+    ]
+
+
+def is_not_modified(headers, frame, variant=None):
+    """Check the conditional request headers of a client against a frame or a snapshot variant of it."""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        etags = [etag.strip() for etag in if_none_match.split(',')]
+        etags = [etag[2:] if etag.startswith('W/') else etag for etag in etags]
+        return '*' in etags or get_etag(frame, variant) in etags
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return int(frame.timestamp) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def get_stream_fps(path):
+    """Return the framerate requested by a stream client with the ``fps`` URL parameter, or ``None``."""
+    fps = dict(get_url_params(path)).get('fps')
+    if fps is None:
+        return None
+    fps = float(fps)
+    if not fps > 0:
+        raise ValueError(f'Invalid fps: {fps}')
+    return fps
+
+
+def get_controls_content(camera, path):
+    """Apply the controls given as URL params and return the controls page, raises ``ValueError`` for invalid controls."""
+    parsed_controls = get_url_params(path)
+    parsed_controls = parsed_controls if parsed_controls else None
+    processed_controls = camera.controls.schema.convert(parsed_controls or [], ignore_unknown=True)
+    camera.controls.apply(processed_controls)
+    return camera.controls.get_page(parsed_controls, processed_controls)
+
+
+def get_controls_json(camera, path):
+    """Apply the controls given as URL params and return the controls with their values as JSON.
+
+    Raises ``ValueError`` for invalid controls.
+    """
+    parsed_controls = get_url_params(path)
+    if parsed_controls:
+        camera.controls.apply(camera.controls.schema.convert(parsed_controls, ignore_unknown=True))
+    return camera.controls.to_json()
+
+
+def update_controls_json(camera, body):
+    """Apply a batch of controls given as JSON object, raises ``ValueError`` for invalid controls."""
+    controls = json.loads(body)
+    if not isinstance(controls, dict):
+        raise ValueError('Expected a JSON object of controls')
+    changed = camera.controls.apply(camera.controls.schema.convert(controls))
+    return json.dumps({'changed': changed, 'controls': camera.controls.to_dict()}, default=str).encode('utf-8')
+
+
+def update_config_json(camera, body):
+    """Reconfigure a camera with the settings given as JSON object, raises ``ValueError`` for invalid settings."""
+    changed = camera.reconfigure(json.loads(body))
+    return json.dumps({'changed': changed}).encode('utf-8')
+
+
+def save_clip_json(camera, body):
+    """Save the recorded frames of the last ``seconds``, or all of them, as clip in the background.
+
+    Raises ``ValueError`` for invalid parameters or without recorded frames.
+    """
+    params = json.loads(body) if body.strip() else {}
+    if not isinstance(params, dict):
+        raise ValueError('Expected a JSON object')
+    seconds = params.get('seconds')
+    if seconds is not None and (isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0):
+        raise ValueError(f'seconds must be a positive number, got {seconds!r}')
+    return json.dumps(camera.recorder.save_clip(seconds)).encode('utf-8')
+
+
+def get_timelapse_json(camera):
+    return json.dumps(camera.timelapse.status()).encode('utf-8')
+
+
+def update_timelapse_json(camera, body):
+    """Start, stop or trigger a timelapse with the ``action`` of a JSON object.
+
+    Raises ``ValueError`` for invalid requests and actions not possible in the current state.
+    """
+    params = json.loads(body)
+    if not isinstance(params, dict):
+        raise ValueError('Expected a JSON object')
+    action = params.get('action')
+    if action == 'start':
+        interval = params.get('interval')
+        if interval is not None and (isinstance(interval, bool) or not isinstance(interval, (int, float))
+                                     or interval <= 0):
+            raise ValueError(f'interval must be a positive number, got {interval!r}')
+        name = params.get('name')
+        if name is not None and not isinstance(name, str):
+            raise ValueError(f'name must be a string, got {name!r}')
+        status = camera.timelapse.start(interval, name)
+    elif action == 'stop':
+        status = camera.timelapse.stop()
+    elif action == 'trigger':
+        status = camera.timelapse.trigger()
+    else:
+        raise ValueError(f'Unknown action {action!r}, expected start, stop or trigger')
+    return json.dumps(status).encode('utf-8')
+
+
+def get_content_length(value):
+    """Return the body length of a request, raises ``ValueError`` if it is not a number or too large."""
+    value = value.strip()
+    if not (value.isascii() and value.isdigit()):
+        raise ValueError(f'Invalid Content-Length {value!r}')
+    length = int(value)
+    if length > MAX_CONTENT_LENGTH:
+        raise ValueError(f'Content-Length {length} exceeds {MAX_CONTENT_LENGTH}')
+    return length
+
+
+# Functions creating the response to the body of a POST request by route kind
+POST_HANDLERS = {
+    'controls_api': update_controls_json,
+    'config_api': update_config_json,
+    'clip_api': save_clip_json,
+    'timelapse_api': update_timelapse_json
+}
+
+
+def get_metrics_content(camera, path):
+    """Return content type and content of the metrics of every stream of a camera.
+
+    The metrics are in Prometheus or, with ``?format=json``, JSON format.
+    """
+    streams = camera.stream_metrics()
+    if ('format', 'json') in get_url_params(path):
+        return 'application/json', json.dumps(streams_to_dict(streams)).encode('utf-8')
+    return 'text/plain; version=0.0.4', streams_to_prometheus(streams).encode('utf-8')
+
+
+def send_buffers(connection, buffers):
+    """Send all buffers with vectored writes, resuming after a partial send.
+
+    Returns the number of bytes sent.
+    """
+    buffers = [memoryview(b) for b in buffers]
+    length = sum(b.nbytes for b in buffers)
+    while buffers:
+        sent = connection.sendmsg(buffers)
+        while buffers and sent >= buffers[0].nbytes:
+            sent -= buffers.pop(0).nbytes
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+    return length
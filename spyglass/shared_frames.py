@@ -0,0 +1,121 @@
+"""Ring of encoded frames in shared memory, handing frames from a capture process to the server process.
+
+Every slot holds one frame with its sequence number. The writer marks a slot as being written
+before copying a frame into it, readers check the mark again after copying the frame out, so a
+frame overwritten meanwhile is detected instead of returned. Only the sequence numbers of new
+frames and the number of dropped frames are sent through a pipe.
+"""
+
+import io
+import struct
+
+from multiprocessing import shared_memory
+from threading import Lock
+
+from spyglass import logger
+
+# Sequence number at the start and at the end of writing a frame, and the length of the frame
+SLOT_HEADER = struct.Struct('<QQI4x')
+SEQUENCE = struct.Struct('<Q')
+# Sequence number of the newest frame and the number of frames dropped so far
+ANNOUNCEMENT = struct.Struct('<QQ')
+# Slots are aligned to cache lines
+SLOT_ALIGNMENT = 64
+
+
+class SharedFrameRing:
+    """``slots`` frames of at most ``slot_size`` bytes in a shared memory block."""
+    def __init__(self, shm, slots, slot_size):
+        self.shm = shm
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = get_stride(slot_size)
+        self.buf = shm.buf
+
+    @classmethod
+    def create(cls, slots, slot_size):
+        # New shared memory is zeroed and sequence numbers start at 1, so empty slots never match
+        return cls(shared_memory.SharedMemory(create=True, size=slots * get_stride(slot_size)), slots, slot_size)
+
+    @classmethod
+    def attach(cls, name, slots, slot_size):
+        return cls(shared_memory.SharedMemory(name=name), slots, slot_size)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, sequence, data):
+        """Copy a frame into the slot of its sequence number, ``data`` must fit into a slot."""
+        offset = (sequence % self.slots) * self.stride
+        start = offset + SLOT_HEADER.size
+        SLOT_HEADER.pack_into(self.buf, offset, sequence, 0, len(data))
+        self.buf[start:start + len(data)] = data
+        SEQUENCE.pack_into(self.buf, offset + SEQUENCE.size, sequence)
+
+    def read(self, sequence):
+        """Return a copy of the frame with the given sequence number, or ``None`` if it was overwritten."""
+        offset = (sequence % self.slots) * self.stride
+        begin, end, length = SLOT_HEADER.unpack_from(self.buf, offset)
+        if begin != sequence or end != sequence:
+            return None
+        start = offset + SLOT_HEADER.size
+        data = bytes(self.buf[start:start + length])
+        if SEQUENCE.unpack_from(self.buf, offset)[0] != sequence:
+            return None
+        return data
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class SharedFrameWriter(io.BufferedIOBase):
+    """Output of the encoder in the capture process, takes the place of its ``FrameBuffer``.
+
+    Frames are announced once ``announce`` was called, e.g. after the server process was told the
+    camera is ready.
+    """
+    def __init__(self, ring, connection):
+        self.ring = ring
+        self.connection = connection
+        self.sequence = 0
+        self.dropped = 0
+        self.announcing = False
+        self.lock = Lock()
+        # Set by the cameras, the EXIF header is added by the frame buffer of the server process
+        self.exif_header = None
+
+    def write(self, buf):
+        data = memoryview(buf).cast('B')
+        if data.nbytes > self.ring.slot_size:
+            if not self.dropped:
+                logger.warning('Dropping frames exceeding the shared memory slots of %d bytes, e.g. %d bytes, '
+                               'see spyglass_frames_dropped_total', self.ring.slot_size, data.nbytes)
+            # Announcing the dropped frame only counts it, the sequence number stays the same
+            self.dropped += 1
+        else:
+            self.sequence += 1
+            self.ring.write(self.sequence, data)
+        with self.lock:
+            if self.announcing:
+                try:
+                    self.connection.send_bytes(ANNOUNCEMENT.pack(self.sequence, self.dropped))
+                except OSError:
+                    # The server process stopped reading, the camera is about to be stopped
+                    self.announcing = False
+        return data.nbytes
+
+    def announce(self, message):
+        """Send a message, e.g. that the camera is ready, and announce all frames written from now on."""
+        with self.lock:
+            self.connection.send(message)
+            self.announcing = True
+
+
+def get_stride(slot_size):
+    size = SLOT_HEADER.size + slot_size
+    return (size + SLOT_ALIGNMENT - 1) // SLOT_ALIGNMENT * SLOT_ALIGNMENT
@@ -0,0 +1,158 @@
+import io
+
+from collections import OrderedDict
+from threading import Event, Lock
+
+from spyglass.url_parsing import get_url_params
+
+# Upper bound of the memory used by the cached variants of a frame buffer
+VARIANT_CACHE_BYTES = 4 * 1024 * 1024
+VARIANT_JPEG_QUALITY = 85
+
+
+class Variant:
+    """Crop rectangle ``(x, y, width, height)`` and maximum size of a snapshot variant."""
+    def __init__(self, crop=None, width=None, height=None):
+        self.crop = crop
+        self.width = width
+        self.height = height
+
+    def key(self):
+        return self.crop, self.width, self.height
+
+    def tag(self):
+        """Return the normalized parameters of the variant for its entity tag, e.g. ``c0.0.320.240w160``."""
+        tag = ''
+        if self.crop is not None:
+            tag += 'c' + '.'.join(str(value) for value in self.crop)
+        if self.width is not None:
+            tag += f'w{self.width}'
+        if self.height is not None:
+            tag += f'h{self.height}'
+        return tag
+
+    def __eq__(self, other):
+        return isinstance(other, Variant) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+class VariantCache:
+    """Snapshot variants of the newest frame of a frame buffer.
+
+    Every variant is computed at most once per frame, concurrent requests for the same
+    variant wait for the first one. The cache is cleared when a newer frame is requested
+    and keeps at most ``max_bytes`` of variants, evicting the least recently used ones.
+    """
+    def __init__(self, metrics, max_bytes=VARIANT_CACHE_BYTES):
+        self.metrics = metrics
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.sequence = 0
+        self.variants = OrderedDict()
+        self.pending = {}
+        self.size = 0
+
+    def get(self, frame, variant):
+        """Return ``frame`` as the given variant, raises ``ValueError`` if the variant does not fit the frame."""
+        pending = None
+        while True:
+            with self.lock:
+                if frame.sequence > self.sequence:
+                    self.sequence = frame.sequence
+                    self.variants.clear()
+                    self.pending = {}
+                    self.size = 0
+                elif frame.sequence < self.sequence:
+                    # Old frames are not cached, other requests must not wait for them
+                    self.metrics.variant_misses += 1
+                    break
+                cached = self.variants.get(variant)
+                if cached is not None:
+                    self.variants.move_to_end(variant)
+                    self.metrics.variant_hits += 1
+                    return cached
+                pending = self.pending.get(variant)
+                if pending is None:
+                    pending = self.pending[variant] = Event()
+                    break
+            pending.wait()
+
+        if pending is None:
+            return frame.replace_data(create_variant(frame.data, variant))
+        self.metrics.variant_misses += 1
+        variant_frame = None
+        try:
+            variant_frame = frame.replace_data(create_variant(frame.data, variant))
+            return variant_frame
+        finally:
+            with self.lock:
+                if self.pending.get(variant) is pending:
+                    del self.pending[variant]
+                    if variant_frame is not None:
+                        self._store(variant, variant_frame)
+                pending.set()
+
+    def _store(self, variant, variant_frame):
+        if variant_frame.length > self.max_bytes:
+            return
+        self.variants[variant] = variant_frame
+        self.size += variant_frame.length
+        while self.size > self.max_bytes:
+            _, evicted = self.variants.popitem(last=False)
+            self.size -= evicted.length
+
+
+def parse_variant(path):
+    """Return the snapshot variant requested with the ``crop``, ``width`` and ``height`` URL parameters.
+
+    Returns ``None`` if no variant is requested, raises ``ValueError`` for invalid values.
+    """
+    params = dict(get_url_params(path))
+    crop = params.get('crop')
+    width = params.get('width')
+    height = params.get('height')
+    if crop is None and width is None and height is None:
+        return None
+    if crop is not None:
+        crop = tuple(int(value) for value in crop.split(','))
+        if len(crop) != 4 or crop[0] < 0 or crop[1] < 0 or crop[2] <= 0 or crop[3] <= 0:
+            raise ValueError(f'Invalid crop: {params["crop"]}')
+    if width is not None:
+        width = parse_size(width)
+    if height is not None:
+        height = parse_size(height)
+    return Variant(crop, width, height)
+
+
+def parse_size(value):
+    size = int(value)
+    if size <= 0:
+        raise ValueError(f'Invalid size: {value}')
+    return size
+
+
+def create_variant(data, variant):
+    """Crop and scale down a JPEG image, keeping its aspect ratio.
+
+    Raises ``ValueError`` if the crop exceeds the image or the image can not be decoded.
+    """
+    from PIL import Image
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        if variant.crop is not None:
+            x, y, width, height = variant.crop
+            if x + width > image.width or y + height > image.height:
+                raise ValueError(f'Crop {variant.crop} exceeds image size {image.size}')
+            image = image.crop((x, y, x + width, y + height))
+        if variant.width is not None or variant.height is not None:
+            # Lets the JPEG decoder scale down by a power of two before resizing
+            image.thumbnail((variant.width or image.width, variant.height or image.height))
+        buf = io.BytesIO()
+        image.save(buf, format='JPEG', quality=VARIANT_JPEG_QUALITY)
+    except OSError as e:
+        # Includes PIL.UnidentifiedImageError and truncated images
+        raise ValueError(f'Invalid image: {e}') from e
+    return buf.getvalue()
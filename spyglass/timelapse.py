@@ -0,0 +1,203 @@
+"""Timelapse capture taking frames straight from the frame buffer of a camera.
+
+Frames are taken at a fixed interval or on trigger, e.g. by a Klipper macro after parking the
+print head. The encoder only hands selected frames to a bounded queue, a background thread
+writes them to disk.
+"""
+
+import os
+import re
+import time
+
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+from spyglass import logger
+from spyglass.frame_buffer import FrameRateLimiter
+
+# Frames waiting for the disk, further frames are dropped instead of blocking the encoder
+TIMELAPSE_QUEUE_SIZE = 64
+# Frames written before syncing them to disk together
+SYNC_BATCH_SIZE = 16
+JOB_NAME = re.compile(r'^[\w.-]+$')
+FRAME_FILE = re.compile(r'^frame(\d+)\.jpg$')
+
+
+class TimelapseJob:
+    """Selects the frames of a running timelapse, subscribed to a frame buffer like a ``FrameQueue``."""
+    def __init__(self, writer, directory, interval=None, first_index=0):
+        self.writer = writer
+        self.directory = directory
+        self.interval = interval
+        self.first_index = first_index
+        self.rate_limiter = FrameRateLimiter(1 / interval) if interval else None
+        self.started = time.time()
+        self.lock = Lock()
+        self.triggers = 0
+        self.captured = 0
+        self.written = 0
+        self.dropped = 0
+
+    def trigger(self):
+        """Capture the next frame, e.g. after the print head was parked."""
+        with self.lock:
+            self.triggers += 1
+
+    def put(self, frame):
+        with self.lock:
+            if self.triggers:
+                self.triggers -= 1
+            elif self.rate_limiter is None or not self.rate_limiter.accept(frame):
+                return
+            # Dropped frames leave no gap in the numbering, ffmpeg stops reading at the first missing file
+            if self.writer.put(self, self.first_index + self.captured, frame):
+                self.captured += 1
+            else:
+                self.dropped += 1
+
+    def status(self):
+        return {
+            'running': True,
+            'directory': self.directory,
+            'interval': self.interval,
+            'first_index': self.first_index,
+            'started': self.started,
+            'captured': self.captured,
+            'written': self.written,
+            'dropped': self.dropped
+        }
+
+
+class TimelapseWriter:
+    """Writes the frames of timelapse jobs from a bounded queue, syncing them to disk in batches."""
+    def __init__(self, maxsize=TIMELAPSE_QUEUE_SIZE):
+        self.queue = Queue(maxsize)
+        Thread(target=self._write_frames, daemon=True).start()
+
+    def put(self, job, index, frame):
+        """Queue a frame without waiting, returns ``False`` if the queue is full."""
+        try:
+            self.queue.put_nowait((job, index, frame))
+            return True
+        except Full:
+            return False
+
+    def _write_frames(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < SYNC_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                write_batch(batch)
+            except OSError as e:
+                logger.error('Failed to write timelapse frames: %s', e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+class Timelapse:
+    """Starts, stops and triggers the timelapse jobs of a camera, one at a time.
+
+    Every job writes its frames to its own subdirectory of ``directory``.
+    """
+    def __init__(self, frame_buffer, directory, writer=None):
+        self.frame_buffer = frame_buffer
+        self.directory = directory
+        self.writer = writer if writer is not None else TimelapseWriter()
+        self.lock = Lock()
+        self.job = None
+        self.last_job = None
+
+    def start(self, interval=None, name=None):
+        """Start a job taking a frame every ``interval`` seconds, or only on trigger.
+
+        Starting a job with the name of an earlier one continues its numbering after its last frame.
+        Raises ``ValueError`` if a job is running or its directory can not be created.
+        """
+        if name is None:
+            name = time.strftime('timelapse-%Y%m%d-%H%M%S')
+        elif not JOB_NAME.match(name):
+            raise ValueError(f'Invalid timelapse name {name!r}')
+        directory = os.path.join(self.directory, name)
+        with self.lock:
+            if self.job is not None:
+                raise ValueError('A timelapse is already running')
+            try:
+                os.makedirs(directory, exist_ok=True)
+                first_index = get_next_frame_index(directory)
+            except OSError as e:
+                raise ValueError(f'Failed to create {directory}: {e}') from e
+            if self.last_job is not None and self.last_job.directory == directory:
+                # Frames of the last job may still be waiting for the disk
+                first_index = max(first_index, self.last_job.first_index + self.last_job.captured)
+            job = TimelapseJob(self.writer, directory, interval, first_index)
+            # A running timelapse keeps a camera started on demand running
+            self.frame_buffer.acquire()
+            self.frame_buffer.add_queue(job)
+            self.job = job
+        logger.info('Started timelapse in %s', directory)
+        return job.status()
+
+    def stop(self):
+        """Stop the running job, raises ``ValueError`` without one."""
+        with self.lock:
+            job = self.job
+            if job is None:
+                raise ValueError('No timelapse running')
+            self.frame_buffer.remove_queue(job)
+            self.frame_buffer.release()
+            self.job = None
+            self.last_job = job
+        logger.info('Stopped timelapse in %s after %d frames', job.directory, job.captured)
+        return {**job.status(), 'running': False}
+
+    def trigger(self):
+        with self.lock:
+            if self.job is None:
+                raise ValueError('No timelapse running')
+            self.job.trigger()
+            return self.job.status()
+
+    def status(self):
+        """Return the status of the running job, or of the last one."""
+        with self.lock:
+            if self.job is not None:
+                return self.job.status()
+            if self.last_job is not None:
+                return {**self.last_job.status(), 'running': False}
+            return {'running': False}
+
+
+def get_next_frame_index(directory):
+    """Return the index following the highest numbered frame in ``directory``, 0 if it has none."""
+    indices = [int(match.group(1)) for match in map(FRAME_FILE.match, os.listdir(directory)) if match]
+    return max(indices) + 1 if indices else 0
+
+
+def write_batch(batch):
+    """Write the frames of a batch to their files, then sync the files and their directories at once."""
+    files = []
+    try:
+        for job, index, frame in batch:
+            f = open(os.path.join(job.directory, f'frame{index:06d}.jpg'), 'wb')
+            files.append(f)
+            for buf in frame.jpeg:
+                f.write(buf)
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        for f in files:
+            f.close()
+    for directory in {job.directory for job, _, _ in batch}:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for job, _, _ in batch:
+        job.written += 1
@@ -1,24 +1,18 @@
 from urllib.parse import urlparse, parse_qsl
 
-def check_paths_match(expected_url, incoming_url):
+def split_path(url):
     # Assign paths from URL into list
-    exp_paths = urlparse(expected_url.strip("/")).path.split("/")
-    inc_paths = urlparse(incoming_url.strip("/")).path.split("/")
+    paths = urlparse(url.strip("/")).path.split("/")
 
     # Drop ip/hostname if present in path
-    if '.' in exp_paths[0]: exp_paths.pop(0)
-    if '.' in inc_paths[0]: inc_paths.pop(0)
+    if '.' in paths[0]: paths.pop(0)
 
     # Filter out empty strings
     # This allows e.g. /stream/?action=stream for /stream?action=stream
-    exp_paths = list(filter(None, exp_paths))
-    inc_paths = list(filter(None, inc_paths))
-
-    # Determine if match
-    if len(exp_paths)==len(inc_paths):
-        return all([exp == inc for exp, inc in zip(exp_paths, inc_paths)])
+    return tuple(filter(None, paths))
 
-    return False
+def check_paths_match(expected_url, incoming_url):
+    return split_path(expected_url) == split_path(incoming_url)
 
 def get_url_params(url):
     # Get URL params
@@ -47,3 +41,29 @@ def check_urls_match(expected_url, incoming_url):
     params_match = check_params_match(expected_url, incoming_url)
 
     return paths_match and params_match
+
+
+class RouteTable:
+    """Maps URLs to routes, matching like ``check_urls_match`` with a single lookup per request.
+
+    Routes with the same path are checked for their URL params in the order they were added.
+    """
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, url, route):
+        self.routes.setdefault(split_path(url), []).append((set(get_url_params(url)), route))
+
+    def match(self, url):
+        candidates = self.routes.get(split_path(url))
+        if not candidates:
+            return None
+        params = None
+        for expected_params, route in candidates:
+            if not expected_params:
+                return route
+            if params is None:
+                params = set(get_url_params(url))
+            if expected_params <= params:
+                return route
+        return None
@@ -0,0 +1,338 @@
+import asyncio
+import pytest
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+    })
+
+
+def create_server(exif_header=None):
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints
+    frame_buffer = FrameBuffer(exif_header)
+    frame_buffer.write(b'\xff\xd8frame\xff\xd9')
+    return AsyncStreamingServer(('127.0.0.1', 0), [CameraEndpoints(MagicMock(), frame_buffer)])
+
+
+async def request(server, path, headers={'Connection': 'close'}):
+    reader, writer = await asyncio.open_connection(*server.server_address)
+    header_lines = ''.join(f'{key}: {value}\r\n' for key, value in headers.items())
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n{header_lines}\r\n'.encode())
+    return reader, writer
+
+
+def test_snapshot_returns_latest_frame():
+    async def run():
+        server = create_server()
+        await server.start()
+        reader, writer = await request(server, '/snapshot')
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        return response
+
+    response = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'Content-Length: 9\r\n' in response
+    assert response.endswith(b'\r\n\r\n\xff\xd8frame\xff\xd9')
+
+
+def test_snapshot_with_exif_header():
+    async def run():
+        server = create_server(exif_header=b'\xff\xd8EXIF')
+        await server.start()
+        reader, writer = await request(server, '/snapshot')
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        return response
+
+    response = asyncio.run(run())
+    assert response.endswith(b'\r\n\r\n\xff\xd8EXIFframe\xff\xd9')
+
+
+def test_stream_fans_out_frames_to_all_clients():
+    async def run():
+        server = create_server()
+        await server.start()
+        clients = [await request(server, '/stream') for _ in range(3)]
+        while len(server.stream_writers[server.cameras[0].frame_buffer]) < len(clients):
+            await asyncio.sleep(0.01)
+        server.cameras[0].frame_buffer.write(b'\xff\xd8next\xff\xd9')
+        parts = []
+        for reader, writer in clients:
+            data = await reader.readuntil(b'next\xff\xd9\r\n')
+            parts.append(data[data.rindex(b'--FRAME\r\n'):])
+            writer.close()
+        server.server.close()
+        return parts
+
+    parts = asyncio.run(run())
+    assert parts == [b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: 8\r\n\r\n\xff\xd8next\xff\xd9\r\n'] * 3
+
+
+def test_snapshot_returns_not_modified_for_same_frame():
+    async def run():
+        from spyglass.server import get_etag
+        server = create_server()
+        await server.start()
+        reader, writer = await request(server, '/snapshot', {
+            'If-None-Match': get_etag(server.cameras[0].frame_buffer.frame),
+            'Connection': 'close'
+        })
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        return response
+
+    response = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 304 Not Modified\r\n')
+    assert response.endswith(b'GMT\r\n\r\n')
+
+
+def test_unknown_url_returns_not_found():
+    async def run():
+        server = create_server()
+        await server.start()
+        reader, writer = await request(server, '/unknown')
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        return response
+
+    response = asyncio.run(run())
+    assert response.startswith(b'HTTP/1.1 404 Not Found\r\n')
+
+
+def test_snapshots_of_stalled_camera_do_not_stop_streams(mocker):
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints
+    mocker.patch('spyglass.async_server.FRAME_TIMEOUT', 0.5)
+
+    async def run():
+        live, dead = FrameBuffer(), FrameBuffer()
+        live.write(b'\xff\xd8first\xff\xd9')
+        server = AsyncStreamingServer(('127.0.0.1', 0), [
+            CameraEndpoints(MagicMock(), live, url_prefix='/live'),
+            CameraEndpoints(MagicMock(), dead, url_prefix='/dead'),
+        ])
+        await server.start()
+        snapshots = [await request(server, '/dead/snapshot') for _ in range(40)]
+        reader, writer = await request(server, '/live/stream')
+        while not server.stream_writers[live]:
+            await asyncio.sleep(0.01)
+        live.write(b'\xff\xd8live\xff\xd9')
+        part = await asyncio.wait_for(reader.readuntil(b'live\xff\xd9\r\n'), 1)
+        writer.close()
+        responses = []
+        for snapshot_reader, snapshot_writer in snapshots:
+            responses.append(await snapshot_reader.read())
+            snapshot_writer.close()
+        server.server.close()
+        return part, responses
+
+    part, responses = asyncio.run(run())
+    assert part.endswith(b'\r\n\r\n\xff\xd8live\xff\xd9\r\n')
+    assert all(response.startswith(b'HTTP/1.1 503 Service Unavailable\r\n') for response in responses)
+
+
+def test_cameras_are_served_under_their_url_prefix():
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints
+
+    async def run():
+        frame_buffers = [FrameBuffer(), FrameBuffer()]
+        frame_buffers[0].write(b'\xff\xd8first\xff\xd9')
+        frame_buffers[1].write(b'\xff\xd8second\xff\xd9')
+        server = AsyncStreamingServer(('127.0.0.1', 0), [
+            CameraEndpoints(MagicMock(), frame_buffers[0], url_prefix='/camera0'),
+            CameraEndpoints(MagicMock(), frame_buffers[1], url_prefix='/camera1'),
+        ])
+        await server.start()
+        responses = []
+        for path in ['/camera0/snapshot', '/camera1/snapshot', '/snapshot']:
+            reader, writer = await request(server, path)
+            responses.append(await reader.read())
+            writer.close()
+        server.server.close()
+        return responses
+
+    first, second, unknown = asyncio.run(run())
+    assert first.endswith(b'first\xff\xd9')
+    assert second.endswith(b'second\xff\xd9')
+    assert unknown.startswith(b'HTTP/1.1 404')
+
+
+def test_snapshot_variant():
+    pytest.importorskip('PIL')
+    import io
+    from PIL import Image
+    jpeg = io.BytesIO()
+    Image.new('RGB', (640, 480)).save(jpeg, format='JPEG')
+
+    async def run():
+        server = create_server()
+        server.cameras[0].frame_buffer.write(jpeg.getvalue())
+        await server.start()
+        responses = []
+        for path in ['/snapshot?width=160', '/snapshot?width=160', '/snapshot?width=-1']:
+            reader, writer = await request(server, path)
+            responses.append(await reader.read())
+            writer.close()
+        server.server.close()
+        return server, responses
+
+    server, (first, second, invalid) = asyncio.run(run())
+    assert Image.open(io.BytesIO(first.split(b'\r\n\r\n', 1)[1])).size == (160, 120)
+    assert first == second
+    assert invalid.startswith(b'HTTP/1.1 400')
+    metrics = server.cameras[0].frame_buffer.metrics
+    assert (metrics.variant_hits, metrics.variant_misses) == (1, 1)
+
+
+def test_snapshots_on_persistent_connection():
+    async def run():
+        server = create_server()
+        await server.start()
+        reader, writer = await request(server, '/snapshot', {})
+        responses = [await reader.readuntil(b'frame\xff\xd9')]
+        writer.write(b'GET /snapshot HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        responses.append(await reader.read())
+        writer.close()
+        server.server.close()
+        return responses
+
+    first, second = asyncio.run(run())
+    assert first.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert second.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert second.endswith(b'frame\xff\xd9')
+
+
+@pytest.mark.parametrize("version, connection, expected", [
+    ('HTTP/1.1', None, True),
+    ('HTTP/1.1', 'close', False),
+    ('HTTP/1.0', None, False),
+    ('HTTP/1.0', 'keep-alive', True),
+])
+def test_is_keep_alive(version, connection, expected):
+    from spyglass.async_server import is_keep_alive
+    headers = {'Connection': connection} if connection else {}
+    assert is_keep_alive(version, headers) == expected
+
+
+def test_update_controls_with_json():
+    import json
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints
+    picam2 = MagicMock()
+    picam2.camera_controls = {'Brightness': (-1.0, 1.0, 0.0)}
+
+    async def run():
+        server = AsyncStreamingServer(('127.0.0.1', 0), [CameraEndpoints(picam2, FrameBuffer())])
+        await server.start()
+        reader, writer = await asyncio.open_connection(*server.server_address)
+        body = b'{"brightness": 0.5}'
+        writer.write(b'POST /api/controls HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+        writer.write(b'GET /api/controls HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        return response
+
+    response = asyncio.run(run())
+    post_response, get_response = response.split(b'HTTP/1.1 200 OK\r\n')[1:]
+    assert json.loads(post_response.split(b'\r\n\r\n', 1)[1])['changed'] == {'Brightness': 0.5}
+    assert json.loads(get_response.split(b'\r\n\r\n', 1)[1])['Brightness']['value'] == 0.5
+    picam2.set_controls.assert_called_once_with({'Brightness': 0.5})
+
+
+@pytest.mark.parametrize("length", [b'-1', b'abc'])
+def test_post_with_invalid_content_length(length):
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints
+
+    async def run():
+        server = AsyncStreamingServer(('127.0.0.1', 0), [CameraEndpoints(MagicMock(), FrameBuffer())])
+        await server.start()
+        reader, writer = await asyncio.open_connection(*server.server_address)
+        writer.write(b'POST /api/controls HTTP/1.1\r\nHost: localhost\r\nContent-Length: %s\r\n\r\n{}' % length)
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        server.server.close()
+        return response
+
+    assert asyncio.run(run()).startswith(b'HTTP/1.1 400')
+
+
+def test_stream_on_unix_socket_only(tmp_path):
+    import os
+    import stat
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints
+    path = str(tmp_path / 'spyglass.sock')
+
+    async def run():
+        frame_buffer = FrameBuffer()
+        frame_buffer.write(b'\xff\xd8first\xff\xd9')
+        server = AsyncStreamingServer(None, [CameraEndpoints(MagicMock(), frame_buffer)], unix_socket=path)
+        await server.start()
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o660
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(b'GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        while not server.stream_writers[frame_buffer]:
+            await asyncio.sleep(0.01)
+        frame_buffer.write(b'\xff\xd8next\xff\xd9')
+        data = await reader.readuntil(b'next\xff\xd9\r\n')
+        writer.close()
+        server.unix_server.close()
+        return server, data
+
+    server, data = asyncio.run(run())
+    assert server.server is None
+    assert data.startswith(b'HTTP/1.1 200 OK\r\n')
+
+
+def test_fmp4_stream_starts_at_keyframe():
+    import os
+    import struct
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.h264 import H264FrameBuffer, split_access_units
+    from spyglass.server import CameraEndpoints
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'h264_1080p.h264'), 'rb') as f:
+        access_units = split_access_units(f.read())
+
+    async def run():
+        h264_frame_buffer = H264FrameBuffer()
+        # Streams start once the camera delivers frames
+        h264_frame_buffer.write(access_units[0])
+        server = AsyncStreamingServer(('127.0.0.1', 0), [
+            CameraEndpoints(MagicMock(), FrameBuffer(), h264_frame_buffer=h264_frame_buffer)
+        ])
+        await server.start()
+        reader, writer = await request(server, '/stream.mp4')
+        await reader.readuntil(b'\r\n\r\n')
+        while not server.fmp4_writers[h264_frame_buffer]:
+            await asyncio.sleep(0.01)
+        for access_unit in access_units[3:6]:
+            h264_frame_buffer.write(access_unit)
+        box_types = []
+        while len(box_types) < 6:
+            size, box_type = struct.unpack('>I4s', await reader.readexactly(8))
+            await reader.readexactly(size - 8)
+            box_types.append(box_type)
+        writer.close()
+        server.server.close()
+        return box_types
+
+    assert asyncio.run(run()) == [b'ftyp', b'moov', b'moof', b'mdat', b'moof', b'mdat']
@@ -0,0 +1,64 @@
+import pytest
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+        'picamera2': MagicMock(),
+    })
+
+
+@pytest.mark.parametrize("server_mode, capture_process", [
+    ('threaded', False),
+    ('asyncio', False),
+    ('threaded', True),
+])
+def test_stream_and_snapshot_clients_receive_frames(server_mode, capture_process):
+    pytest.importorskip('PIL')
+    from spyglass.benchmark import run_benchmark
+    results = run_benchmark(
+        stream_clients=3,
+        snapshot_clients=1,
+        duration=1.0,
+        snapshot_interval=0.2,
+        width=64,
+        height=48,
+        fps=20,
+        server_mode=server_mode,
+        capture_process=capture_process)
+    assert results['errors'] == 0
+    assert results['stream_errors'] == [0, 0, 0]
+    assert all(fps > 10 for fps in results['stream_fps'])
+    assert results['snapshots'] > 0
+    assert len(results['stream_latencies']) > 0
+
+
+def test_report_lists_slowest_stream_clients_first(capsys):
+    from spyglass.benchmark import print_report
+    print_report({
+        'server_mode': 'threaded', 'capture_process': False, 'duration': 10.0,
+        'stream_fps': [30.0, 2.5, 29.0], 'stream_errors': [0, 1, 0], 'stream_latencies': [0.01],
+        'snapshots': 20, 'snapshot_errors': [0], 'snapshot_latencies': [0.02], 'errors': 1,
+        'cpu_percent': 12.0, 'rss': 50 * 1024 * 1024, 'processes': 1, 'context_switches_per_second': 100.0,
+    })
+    lines = [line.split() for line in capsys.readouterr().out.splitlines() if 'client' in line and 'fps,' in line]
+    assert [line[2] for line in lines] == ['2', '3', '1']
+    assert lines[0][3:] == ['2.5', 'fps,', '1', 'errors']
+
+
+def test_process_stats_include_child_processes():
+    import os
+    import subprocess
+    import sys
+    from spyglass.benchmark import get_process_tree, read_process_stats
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        assert child.pid in get_process_tree(os.getpid())
+        stats = read_process_stats(os.getpid())
+    finally:
+        child.kill()
+        child.wait()
+    assert stats['processes'] >= 2
+    assert stats['rss'] > 0
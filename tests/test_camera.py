@@ -0,0 +1,142 @@
+import pytest
+from unittest.mock import MagicMock, call
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+        'picamera2': MagicMock(),
+        'picamera2.encoders': MagicMock(),
+        'picamera2.outputs': MagicMock(),
+    })
+
+
+def create_camera():
+    from spyglass.camera.csi import CSI
+    picam2 = MagicMock()
+    picam2.camera_controls = {'FrameRate': (1.0, 120.0, 30.0), 'Brightness': (-1.0, 1.0, 0.0)}
+    cam = CSI(picam2)
+    cam.configure(640, 480, 15, 2, 0.0, 1)
+    cam.start(1)
+    picam2.reset_mock()
+    return cam
+
+
+def test_reconfigure_restarts_camera_with_changed_settings():
+    cam = create_camera()
+    cam.frame_buffer.write(b'\xff\xd8frame\xff\xd9')
+
+    assert cam.reconfigure({'width': 1280, 'height': 720, 'fps': 15, 'orientation_exif': 'r180'}) == {
+        'width': 1280, 'height': 720, 'orientation_exif': 3
+    }
+    assert cam.picam2.method_calls[0] == call.stop_recording()
+    assert cam.picam2.create_video_configuration.call_args.kwargs['main'] == {'size': (1280, 720)}
+    assert cam.picam2.start_recording.called
+    assert cam.frame_buffer.frame is None
+    assert cam.orientation_exif == 3
+    assert cam.settings['width'] == 1280
+
+
+def test_reconfigure_without_changes_keeps_camera_running():
+    cam = create_camera()
+    assert cam.reconfigure({'width': 640, 'fps': 15}) == {}
+    cam.picam2.stop_recording.assert_not_called()
+
+
+def test_reconfigure_keeps_controls_changed_while_running():
+    cam = create_camera()
+    cam.controls.apply({'Brightness': 0.5})
+    cam.reconfigure({'fps': 30})
+    assert cam.picam2.create_video_configuration.call_args.kwargs['controls']['FrameRate'] == 30
+    cam.picam2.set_controls.assert_called_with({'Brightness': 0.5})
+
+
+def test_reconfigure_restores_previous_configuration_on_failure():
+    cam = create_camera()
+    cam.picam2.configure.side_effect = [RuntimeError('unsupported'), None]
+    with pytest.raises(ValueError):
+        cam.reconfigure({'width': 1920, 'height': 1920})
+    assert cam.picam2.create_video_configuration.call_args.kwargs['main'] == {'size': (640, 480)}
+    assert cam.settings['width'] == 640
+    assert cam.picam2.start_recording.called
+
+
+def test_reconfigure_failing_to_restart_camera_started_on_demand():
+    cam = create_camera()
+    cam.stop()
+    cam.start_on_demand(1, 30.0)
+    on_demand = cam.frame_buffer.on_demand
+    on_demand.acquire()
+    cam.picam2.configure.side_effect = RuntimeError('unsupported')
+    with pytest.raises(ValueError, match='failed to restart'):
+        cam.reconfigure({'width': 1920, 'height': 1920})
+    # The next client starts the camera again
+    assert not on_demand.running
+    assert on_demand.metrics.camera_running == 0
+    cam.picam2.configure.side_effect = None
+    on_demand.acquire()
+    assert on_demand.running
+
+
+def test_reconfigure_camera_stopped_on_demand_only_configures():
+    cam = create_camera()
+    cam.stop()
+    cam.start_on_demand(1, 30.0)
+    cam.picam2.reset_mock()
+    cam.reconfigure({'flip_vertical': True})
+    assert cam.picam2.configure.called
+    cam.picam2.start_recording.assert_not_called()
+
+
+@pytest.mark.parametrize("settings", [
+    {'width': 0},
+    {'fps': '30'},
+    {'upsidedown': 1},
+    {'orientation_exif': 'sideways'},
+    {'orientation_exif': []},
+    {'orientation_exif': {}},
+    {'orientation_exif': True},
+    {'port': 8081},
+    ['width', 640],
+])
+def test_reconfigure_rejects_invalid_settings(settings):
+    cam = create_camera()
+    with pytest.raises(ValueError):
+        cam.reconfigure(settings)
+    cam.picam2.stop_recording.assert_not_called()
+
+
+def test_h264_encoder_is_started_with_mjpeg_encoder():
+    import sys
+    from spyglass.camera.csi import CSI
+    picam2 = MagicMock()
+    picam2.camera_controls = {}
+    cam = CSI(picam2)
+    cam.configure(1920, 1080, 30, 2, 0.0, 1, h264=True, h264_bitrate=4000000)
+    cam.start()
+    sys.modules['picamera2.encoders'].H264Encoder.assert_called_once_with(bitrate=4000000, repeat=True, iperiod=30)
+    assert picam2.start_encoder.call_args.kwargs == {'name': 'main'}
+    assert picam2.start_recording.called
+    assert cam.h264_frame_buffer in cam.frame_buffers()
+
+
+def test_motion_detection_reads_lores_luma():
+    pytest.importorskip('numpy')
+    import numpy as np
+    from spyglass.camera.csi import CSI
+    picam2 = MagicMock()
+    picam2.camera_controls = {}
+    cam = CSI(picam2)
+    cam.enable_motion_detection(2.0, 25)
+    cam.configure(1920, 1080, 30, 2, 0.0, 1)
+    cam.start()
+    assert picam2.create_video_configuration.call_args.kwargs['lores'] == {'size': (320, 180)}
+    request = MagicMock()
+    # YUV420 buffer of the lores stream with a row stride of 384
+    request.make_array.return_value = np.zeros((270, 384), dtype=np.uint8)
+    picam2.post_callback(request)
+    picam2.post_callback(request)
+    request.make_array.assert_called_once_with('lores')
+    assert cam.motion_detector.frames == 1
+    assert cam.motion_detector.previous.shape == (90, 160)
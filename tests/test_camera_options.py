@@ -0,0 +1,142 @@
+import pytest
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+    })
+
+
+def create_picam2():
+    picam2 = MagicMock()
+    picam2.camera_controls = {
+        'Brightness': (-1.0, 1.0, 0.0),
+        'ColourGains': (0.0, 32.0, None),
+    }
+    return picam2
+
+
+def test_apply_sets_only_changed_controls():
+    from spyglass.camera_options import CameraControls
+    picam2 = create_picam2()
+    controls = CameraControls(picam2)
+    controls.set_initial_values({'Brightness': 0.5})
+
+    assert controls.apply({'Brightness': 0.5}) == {}
+    picam2.set_controls.assert_not_called()
+    assert controls.apply({'Brightness': 0.2, 'ColourGains': (1.5, 1.2)}) == {'Brightness': 0.2, 'ColourGains': (1.5, 1.2)}
+    picam2.set_controls.assert_called_once_with({'Brightness': 0.2, 'ColourGains': (1.5, 1.2)})
+
+
+def test_page_is_rendered_again_after_controls_change(mocker):
+    from spyglass import camera_options
+    render = mocker.spy(camera_options, 'parse_dictionary_to_html_page')
+    controls = camera_options.CameraControls(create_picam2())
+
+    first = controls.get_page()
+    assert controls.get_page() is first
+    assert render.call_count == 1
+    controls.apply({'Brightness': 0.3})
+    page = controls.get_page()
+    assert render.call_count == 2
+    assert b'0.3' in page
+
+
+def test_schema_is_compiled_again_after_reload():
+    from spyglass.camera_options import CameraControls
+    picam2 = create_picam2()
+    camera_controls = picam2.camera_controls
+    picam2.camera_controls = {}
+    controls = CameraControls(picam2)
+    assert controls.schema.specs == {}
+    picam2.camera_controls = camera_controls
+    controls.reload()
+    assert list(controls.schema.specs) == ['Brightness', 'ColourGains']
+
+
+def test_style_is_read_once():
+    from spyglass import camera_options
+    camera_options.get_style.cache_clear()
+    assert 'body' in camera_options.get_style()
+    camera_options.get_style()
+    assert camera_options.get_style.cache_info().misses == 1
+
+
+def test_to_dict_returns_values_or_defaults():
+    from spyglass.camera_options import CameraControls
+    controls = CameraControls(create_picam2())
+    controls.set_initial_values({'Brightness': 0.5})
+    assert controls.to_dict() == {
+        'Brightness': {'min': -1.0, 'max': 1.0, 'default': 0.0, 'value': 0.5},
+        'ColourGains': {'min': 0.0, 'max': 32.0, 'default': None, 'value': None},
+    }
+
+
+def create_schema():
+    from spyglass.camera_options import ControlSchema
+    return ControlSchema({
+        'Brightness': (-1.0, 1.0, 0.0),
+        'ColourGains': (0.0, 32.0, None),
+        'ExposureTime': (1, 66666, None),
+        'AeEnable': (False, True, None),
+        'ScalerCrop': ((0, 0, 0, 0), (0, 0, 4608, 2592), None),
+    })
+
+
+def test_schema_converts_to_canonical_names_and_types():
+    assert create_schema().convert([
+        ('brightness', '0.1'),
+        ('colourgains', '(1.5, 1.2)'),
+        ('ExposureTime', '10000'),
+        ('aeenable', 'false'),
+    ]) == {
+        'Brightness': 0.1,
+        'ColourGains': (1.5, 1.2),
+        'ExposureTime': 10000,
+        'AeEnable': False,
+    }
+
+
+def test_schema_converts_json_values():
+    assert create_schema().convert({'Brightness': 0, 'ColourGains': [1.5, 1.2], 'ExposureTime': 500.0}) == {
+        'Brightness': 0.0,
+        'ColourGains': (1.5, 1.2),
+        'ExposureTime': 500,
+    }
+
+
+def test_schema_passes_controls_without_numeric_range():
+    assert create_schema().convert({'ScalerCrop': '(0, 0, 640, 480)'}) == {'ScalerCrop': (0, 0, 640, 480)}
+
+
+@pytest.mark.parametrize("controls", [
+    {'Brightness': 1.5},
+    {'Brightness': 'bright'},
+    {'ExposureTime': '0.5'},
+    {'AeEnable': 'maybe'},
+    {'Brightness': 'nan'},
+    {'Sharpness': 1.0},
+])
+def test_schema_rejects_invalid_controls(controls):
+    with pytest.raises(ValueError):
+        create_schema().convert(controls)
+
+
+def test_schema_lists_all_errors():
+    with pytest.raises(ValueError, match='Brightness.*ExposureTime'):
+        create_schema().convert({'Brightness': 2.0, 'ExposureTime': -1})
+
+
+def test_schema_ignores_unknown_controls():
+    assert create_schema().convert([('Sharpness', '1.0'), ('Brightness', '0.5')], ignore_unknown=True) == {
+        'Brightness': 0.5,
+    }
+
+
+def test_schema_converts_enum_names():
+    from spyglass.camera_options import ControlSpec
+    spec = ControlSpec('AeExposureMode', 0, 3, 0, enum_values={'normal': 0, 'short': 1})
+    assert spec.convert('Short') == 1
+    assert spec.convert('2') == 2
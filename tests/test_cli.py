@@ -20,6 +20,15 @@ DEFAULT_CONTROLS = []
 DEFAULT_TUNING_FILTER = None
 DEFAULT_TUNING_FILTER_DIR = None
 DEFAULT_CAMERA_NUM = 0
+DEFAULT_SNAPSHOT_MAX_AGE = 1.0
+DEFAULT_SERVER_MODE = 'threaded'
+DEFAULT_LORES_SIZE = None
+DEFAULT_LORES_STREAM_URL = '/lores/stream'
+DEFAULT_LORES_SNAPSHOT_URL = '/lores/snapshot'
+DEFAULT_IDLE_TIMEOUT = None
+DEFAULT_H264 = False
+DEFAULT_H264_BITRATE = None
+DEFAULT_H264_STREAM_URL = '/stream.mp4'
 
 
 @pytest.fixture(autouse=True)
@@ -105,7 +114,10 @@ def test_configure_with_defaults(mock_init_camera, mock_configure):
         DEFAULT_CONTROLS,
         DEFAULT_UPSIDE_DOWN,
         DEFAULT_FLIP_HORIZONTALLY,
-        DEFAULT_FLIP_VERTICALLY
+        DEFAULT_FLIP_VERTICALLY,
+        lores_size=DEFAULT_LORES_SIZE,
+        h264=DEFAULT_H264,
+        h264_bitrate=DEFAULT_H264_BITRATE
     )
 
 @patch("spyglass.camera.camera.Camera.configure")
@@ -137,10 +149,38 @@ def test_configure_with_parameters(mock_init_camera, mock_configure):
         [['brightness', '-0.4'],['awbenable', 'false']],
         True,
         True,
-        True
+        True,
+        lores_size=DEFAULT_LORES_SIZE,
+        h264=DEFAULT_H264,
+        h264_bitrate=DEFAULT_H264_BITRATE
     )
 
 
+@patch("spyglass.camera.camera.Camera.configure")
+@patch("spyglass.camera.init_camera")
+def test_configure_with_lores_resolution(mock_init_camera, mock_configure):
+    from spyglass import cli
+
+    cli.main(args=[
+        '-lr', '320x240'
+    ])
+    cam_instance = mock_init_camera.return_value
+    assert cam_instance.configure.call_args.kwargs == {
+        'lores_size': (320, 240),
+        'h264': DEFAULT_H264,
+        'h264_bitrate': DEFAULT_H264_BITRATE
+    }
+
+
+def test_raise_error_when_lores_resolution_greater_than_resolution():
+    from spyglass import cli
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.main(args=[
+            '-r', '640x480',
+            '-lr', '800x240'
+        ])
+
+
 def test_raise_error_when_width_greater_than_maximum():
     from spyglass import cli
     with pytest.raises(argparse.ArgumentTypeError):
@@ -177,7 +217,10 @@ def test_configure_camera_af_continuous_speed_fast(mock_init_camera, mock_config
         DEFAULT_CONTROLS,
         DEFAULT_UPSIDE_DOWN,
         DEFAULT_FLIP_HORIZONTALLY,
-        DEFAULT_FLIP_VERTICALLY
+        DEFAULT_FLIP_VERTICALLY,
+        lores_size=DEFAULT_LORES_SIZE,
+        h264=DEFAULT_H264,
+        h264_bitrate=DEFAULT_H264_BITRATE
     )
 
 
@@ -199,10 +242,34 @@ def test_run_server_with_configuration_from_arguments(mock_init_camera, mock_run
         1234,
         'streaming-url',
         'snapshot-url',
-        1
+        1,
+        DEFAULT_SNAPSHOT_MAX_AGE,
+        DEFAULT_SERVER_MODE,
+        DEFAULT_LORES_STREAM_URL,
+        DEFAULT_LORES_SNAPSHOT_URL,
+        DEFAULT_IDLE_TIMEOUT,
+        unix_socket=None,
+        tcp=True,
+        h264_stream_url=DEFAULT_H264_STREAM_URL
     )
 
 
+@patch("spyglass.camera.camera.run_server")
+@patch("spyglass.camera.init_camera")
+def test_start_multiple_cameras_on_demand(mock_init_camera, mock_run_server):
+    from spyglass import cli
+
+    cameras = [MagicMock(), MagicMock()]
+    mock_init_camera.side_effect = cameras
+    cli.main(args=[
+        '-n', '0', '1',
+        '-it', '30'
+    ])
+    for cam in cameras:
+        cam.start.assert_not_called()
+        cam.start_on_demand.assert_called_once_with(1, 30.0)
+
+
 @patch("spyglass.camera.csi.CSI.start_and_run_server")
 @patch("spyglass.camera.init_camera")
 @pytest.mark.parametrize("input_value, expected_output", [
@@ -231,5 +298,205 @@ def test_run_server_with_orientation(mock_init_camera, mock_run_server, input_va
         1234,
         'streaming-url',
         'snapshot-url',
-        expected_output
+        expected_output,
+        DEFAULT_SNAPSHOT_MAX_AGE,
+        DEFAULT_SERVER_MODE,
+        DEFAULT_LORES_STREAM_URL,
+        DEFAULT_LORES_SNAPSHOT_URL,
+        DEFAULT_IDLE_TIMEOUT,
+        unix_socket=None,
+        tcp=True,
+        h264_stream_url=DEFAULT_H264_STREAM_URL
+    )
+
+
+def test_parse_server_mode():
+    from spyglass import cli
+    args = cli.get_args(['-sm', 'asyncio'])
+    assert args.server_mode == 'asyncio'
+
+
+def test_parse_idle_timeout():
+    from spyglass import cli
+    args = cli.get_args(['-it', '60'])
+    assert args.idle_timeout == 60.0
+
+
+def test_parse_snapshot_max_age():
+    from spyglass import cli
+    args = cli.get_args(['-sa', '0.5'])
+    assert args.snapshot_max_age == 0.5
+
+
+@patch("spyglass.camera.camera.run_server")
+@patch("spyglass.camera.init_camera")
+def test_run_server_with_multiple_cameras(mock_init_camera, mock_run_server):
+    from spyglass import cli
+
+    cameras = [MagicMock(), MagicMock()]
+    mock_init_camera.side_effect = cameras
+    cli.main(args=[
+        '-b', '1.2.3.4',
+        '-p', '1234',
+        '-n', '0', '1'
+    ])
+    assert [c.args[0] for c in mock_init_camera.call_args_list] == [0, 1]
+    for cam in cameras:
+        cam.start.assert_called_once_with(1)
+        cam.stop.assert_called_once()
+    mock_run_server.assert_called_once_with(
+        {'': cameras[0], '/camera0': cameras[0], '/camera1': cameras[1]},
+        '1.2.3.4',
+        1234,
+        '/stream',
+        '/snapshot',
+        DEFAULT_SNAPSHOT_MAX_AGE,
+        DEFAULT_SERVER_MODE,
+        DEFAULT_LORES_STREAM_URL,
+        DEFAULT_LORES_SNAPSHOT_URL,
+        unix_socket=None,
+        tcp=True,
+        h264_stream_url=DEFAULT_H264_STREAM_URL
     )
+
+
+def test_list_controls_does_not_import_camera_backends(mocker, capsys):
+    import sys
+    from spyglass import cli
+    sys.modules.pop('spyglass.camera', None)
+    mocker.patch('spyglass.camera_options.get_libcamera_controls_string', return_value='Brightness (float)')
+    cli.main(args=['--list-controls'])
+    assert 'Brightness' in capsys.readouterr().out
+    assert 'spyglass.camera' not in sys.modules
+
+
+def test_list_controls_of_missing_camera(mocker):
+    import libcamera
+    from spyglass import camera_options
+    libcamera.CameraManager.singleton.return_value.cameras = [MagicMock()]
+    assert camera_options.get_libcamera_controls_string(1) == ''
+
+
+def test_list_controls_is_cached_on_disk(mocker, tmp_path):
+    import libcamera
+    from spyglass import camera_options
+    (tmp_path / 'video4linux' / 'v4l-subdev0').mkdir(parents=True)
+    (tmp_path / 'video4linux' / 'v4l-subdev0' / 'name').write_text('imx708 10-001a\n')
+    (tmp_path / 'libcamera.so').write_bytes(b'build')
+    mocker.patch.object(camera_options, 'VIDEO4LINUX_DIR', str(tmp_path / 'video4linux'))
+    mocker.patch.object(camera_options, 'CONTROLS_CACHE_DIR', str(tmp_path / 'cache'))
+    libcamera.__file__ = str(tmp_path / 'libcamera.so')
+    mocker.patch.object(camera_options, 'format_libcamera_controls', return_value='Brightness (float)')
+    libcamera.CameraManager.singleton.reset_mock()
+    libcamera.CameraManager.singleton.return_value.cameras = [MagicMock()]
+    assert camera_options.get_libcamera_controls_string(0) == 'Brightness (float)'
+    assert camera_options.get_libcamera_controls_string(0) == 'Brightness (float)'
+    assert libcamera.CameraManager.singleton.call_count == 1
+    # Another libcamera build lists the controls again
+    (tmp_path / 'libcamera.so').write_bytes(b'other build')
+    camera_options.get_libcamera_controls_string(0)
+    assert libcamera.CameraManager.singleton.call_count == 2
+
+
+def test_parse_config_file(tmp_path):
+    from spyglass import cli
+    config_file = tmp_path / 'spyglass.conf'
+    config_file.write_text('RESOLUTION="1280x720"\nFPS="30"\nNO_PROXY="false"\n')
+    args = cli.get_args(['--config', str(config_file), '-f', '10'])
+    assert args.resolution == '1280x720'
+    assert args.fps == 10
+    assert args.bindaddress == '127.0.0.1'
+
+
+def test_reload_config_continues_after_failed_camera_start(tmp_path):
+    from spyglass import cli
+    config_file = tmp_path / 'spyglass.conf'
+    config_file.write_text('RESOLUTION="1280x720"\n')
+    cameras = {0: MagicMock(), 1: MagicMock()}
+    cameras[0].reconfigure.side_effect = RuntimeError('Capture process did not start')
+    cli.reload_config(['--config', str(config_file)], cameras)
+    assert cameras[1].reconfigure.called
+
+
+def test_reload_config_reconfigures_cameras(tmp_path):
+    from spyglass import cli
+    config_file = tmp_path / 'spyglass.conf'
+    config_file.write_text('RESOLUTION="1280x720"\nORIENTATION_EXIF="r180"\nCONTROLS="brightness=0.5"\n')
+    cam = MagicMock()
+    cli.reload_config(['--config', str(config_file)], {0: cam})
+    cam.reconfigure.assert_called_once_with({
+        'width': 1280,
+        'height': 720,
+        'fps': DEFAULT_FPS,
+        'upsidedown': DEFAULT_UPSIDE_DOWN,
+        'flip_horizontal': DEFAULT_FLIP_HORIZONTALLY,
+        'flip_vertical': DEFAULT_FLIP_VERTICALLY,
+        'orientation_exif': 3
+    })
+    cam.controls.schema.convert.assert_called_once_with([['brightness', '0.5']], ignore_unknown=True)
+
+
+def test_parse_unix_socket():
+    from spyglass import cli
+    args = cli.get_args(['-us', '/run/spyglass.sock', '-nt'])
+    assert args.unix_socket == '/run/spyglass.sock'
+    assert args.no_tcp
+
+
+def test_no_tcp_requires_unix_socket():
+    from spyglass import cli
+    with pytest.raises(SystemExit):
+        cli.main(args=['--no_tcp'])
+
+
+@patch("spyglass.camera.init_camera")
+def test_configure_with_h264(mock_init_camera):
+    from spyglass import cli
+    cli.main(args=['--h264', '-hb', '2000000', '-hst', '/video.mp4'])
+    cam_instance = mock_init_camera.return_value
+    assert cam_instance.configure.call_args.kwargs['h264']
+    assert cam_instance.configure.call_args.kwargs['h264_bitrate'] == 2000000
+    assert cam_instance.start_and_run_server.call_args.kwargs['h264_stream_url'] == '/video.mp4'
+
+
+
+@patch("spyglass.camera.init_camera")
+def test_enable_recording(mock_init_camera):
+    from spyglass import cli
+    cli.main(args=['-rs', '60', '-rm', '50', '-rd', '/var/lib/spyglass'])
+    cam_instance = mock_init_camera.return_value
+    cam_instance.enable_recording.assert_called_once_with('/var/lib/spyglass/camera0', 60.0, 50 * 1024 * 1024)
+
+
+@patch("spyglass.camera.init_camera")
+@pytest.mark.parametrize("timelapse_args, enabled", [
+    (['-tl'], True),
+    ([], False),
+])
+def test_enable_timelapse(mock_init_camera, timelapse_args, enabled):
+    from spyglass import cli
+    cli.main(args=timelapse_args + ['-td', '/var/lib/spyglass/timelapse'])
+    enable_timelapse = mock_init_camera.return_value.enable_timelapse
+    if enabled:
+        enable_timelapse.assert_called_once_with('/var/lib/spyglass/timelapse/camera0')
+    else:
+        enable_timelapse.assert_not_called()
+
+
+@patch("spyglass.camera.init_camera")
+def test_enable_motion_detection(mock_init_camera):
+    from spyglass import cli
+    cli.main(args=['-md', '-mf', '5', '-mt', '30'])
+    cam_instance = mock_init_camera.return_value
+    cam_instance.enable_motion_detection.assert_called_once_with(5.0, 30)
+
+
+@patch("spyglass.camera.process.ProcessCamera")
+@patch("spyglass.camera.init_camera")
+def test_capture_process(mock_init_camera, mock_process_camera):
+    from spyglass import cli
+    cli.main(args=['--capture_process', '-af', 'manual', '-s', 'fast', '-n', '1'])
+    mock_init_camera.assert_not_called()
+    mock_process_camera.assert_called_once_with(1, None, None)
+    configure_args = mock_process_camera.return_value.configure.call_args.args
+    assert (configure_args[3], configure_args[5]) == ('manual', 'fast')
@@ -0,0 +1,36 @@
+def test_read_config(tmp_path):
+    from spyglass.config import read_config
+    config_file = tmp_path / 'spyglass.conf'
+    config_file.write_text(
+        '#### Resolution\n'
+        'RESOLUTION="1280x720"\n'
+        '\n'
+        'STREAM_URL="/?action=stream" # MJPG-Streamer compatible\n'
+        '## SNAPSHOT_URL="/?action=snapshot"\n'
+        'CONTROLS=""\n'
+    )
+    assert read_config(str(config_file)) == {
+        'RESOLUTION': '1280x720',
+        'STREAM_URL': '/?action=stream',
+        'CONTROLS': '',
+    }
+
+
+def test_read_invalid_config(tmp_path):
+    import pytest
+    from spyglass.config import read_config
+    config_file = tmp_path / 'spyglass.conf'
+    config_file.write_text('RESOLUTION 1280x720\n')
+    with pytest.raises(ValueError):
+        read_config(str(config_file))
+
+
+def test_config_to_args():
+    from spyglass.config import config_to_args
+    assert config_to_args({
+        'NO_PROXY': 'false',
+        'CAMERA_NUM': '0 1',
+        'FPS': '30',
+        'CONTROLS': '',
+        'UNKNOWN': 'value',
+    }) == ['--bindaddress', '127.0.0.1', '--camera_num', '0', '1', '--fps', '30']
@@ -0,0 +1,114 @@
+import os
+import struct
+
+H264_FILE = os.path.join(os.path.dirname(__file__), 'data', 'h264_1080p.h264')
+
+
+def read_frames():
+    from spyglass.h264 import H264Frame, split_access_units
+    with open(H264_FILE, 'rb') as f:
+        access_units = split_access_units(f.read())
+    frames = [H264Frame(data, i + 1) for i, data in enumerate(access_units)]
+    for i, frame in enumerate(frames):
+        frame.timestamp = 1700000000.0 + i / 30
+    return frames
+
+
+def parse_boxes(data):
+    """Return the type and payload of the boxes in ``data``."""
+    boxes = []
+    offset = 0
+    while offset < len(data):
+        size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        assert size >= 8 and offset + size <= len(data)
+        boxes.append((box_type, data[offset + 8:offset + size]))
+        offset += size
+    return boxes
+
+
+def find_box(data, *path):
+    # Skips the version, flags and entry count of sample description boxes
+    for box_type in path:
+        boxes = dict(parse_boxes(data))
+        data = boxes[box_type]
+        if box_type == b'stsd':
+            data = data[8:]
+        elif box_type == b'avc1':
+            data = data[78:]
+    return data
+
+
+def test_init_segment():
+    from spyglass.fmp4 import init_segment
+    frame = read_frames()[0]
+    segment = init_segment(frame.sps, frame.pps)
+    assert [box_type for box_type, _ in parse_boxes(segment)] == [b'ftyp', b'moov']
+    tkhd = find_box(segment, b'moov', b'trak', b'tkhd')
+    assert struct.unpack('>II', tkhd[-8:]) == (1920 << 16, 1080 << 16)
+    avc1 = find_box(segment, b'moov', b'trak', b'mdia', b'minf', b'stbl', b'stsd', b'avc1')
+    avcc = dict(parse_boxes(avc1))[b'avcC']
+    assert avcc[:4] == bytes([1, 100, 0, 40])
+    sps_length = struct.unpack('>H', avcc[6:8])[0]
+    assert avcc[8:8 + sps_length] == frame.sps
+    assert b'mvex' in dict(parse_boxes(find_box(segment, b'moov')))
+
+
+def test_fragment_data_offset_points_to_sample():
+    from spyglass.fmp4 import fragment
+    nal_units = [b'\x65\x88\x84', b'\x65\x00']
+    data = b''.join(fragment(7, 3000, 3000, True, nal_units))
+    (moof_type, moof), (mdat_type, mdat) = parse_boxes(data)
+    assert (moof_type, mdat_type) == (b'moof', b'mdat')
+    assert struct.unpack('>I', find_box(data, b'moof', b'mfhd')[4:])[0] == 7
+    assert struct.unpack('>Q', find_box(data, b'moof', b'traf', b'tfdt')[4:])[0] == 3000
+    trun = find_box(data, b'moof', b'traf', b'trun')
+    count, data_offset, duration, size, flags = struct.unpack('>Ii3I', trun[4:])
+    assert (count, duration, size, flags) == (1, 3000, 13, 0x02000000)
+    assert data[data_offset:] == mdat == b'\x00\x00\x00\x03\x65\x88\x84\x00\x00\x00\x02\x65\x00'
+
+
+def test_stream_starts_at_keyframe():
+    from spyglass.fmp4 import Fmp4Stream
+    frames = read_frames()
+    stream = Fmp4Stream()
+    assert stream.get_buffers(frames[2]) == []
+    assert stream.get_buffers(frames[3]) == []
+    first = b''.join(stream.get_buffers(frames[4]))
+    assert [box_type for box_type, _ in parse_boxes(first)] == [b'ftyp', b'moov', b'moof', b'mdat']
+    second = b''.join(stream.get_buffers(frames[5]))
+    assert [box_type for box_type, _ in parse_boxes(second)] == [b'moof', b'mdat']
+
+
+def test_stream_decode_times_follow_frame_timestamps():
+    from spyglass.fmp4 import Fmp4Stream
+    frames = read_frames()
+    for frame, timestamp in zip(frames, [0.0, 0.1, 0.3, 0.29]):
+        frame.timestamp = 1700000000.0 + timestamp
+    stream = Fmp4Stream()
+    decode_times = []
+    for frame in frames[:4]:
+        data = b''.join(stream.get_buffers(frame))
+        decode_times.append(struct.unpack('>Q', find_box(data, b'moof', b'traf', b'tfdt')[4:])[0])
+    assert decode_times == [0, 9000, 27000, 27001]
+
+
+def test_stream_waits_for_keyframe_after_resync():
+    from spyglass.fmp4 import Fmp4Stream
+    frames = read_frames()
+    stream = Fmp4Stream()
+    stream.get_buffers(frames[0])
+    stream.resync()
+    assert stream.get_buffers(frames[1]) == []
+    buffers = stream.get_buffers(frames[4])
+    # The parameter sets did not change, so no new initialization segment is needed
+    assert [box_type for box_type, _ in parse_boxes(b''.join(buffers))] == [b'moof', b'mdat']
+
+
+def test_stream_sends_new_init_segment_when_parameter_sets_change():
+    from spyglass.fmp4 import Fmp4Stream
+    frames = read_frames()
+    stream = Fmp4Stream()
+    stream.get_buffers(frames[0])
+    frames[4].pps = frames[4].pps + b'\x80'
+    buffers = stream.get_buffers(frames[4])
+    assert [box_type for box_type, _ in parse_boxes(b''.join(buffers))] == [b'ftyp', b'moov', b'moof', b'mdat']
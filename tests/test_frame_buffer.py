@@ -0,0 +1,167 @@
+import asyncio
+import pytest
+import threading
+import time
+
+
+def test_write_increments_sequence():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'first')
+    frame_buffer.write(b'second')
+    assert frame_buffer.sequence == 2
+    assert frame_buffer.frame.data == b'second'
+
+
+def test_get_frame_returns_existing_frame_immediately():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'first')
+    frame_buffer.write(b'second')
+    assert frame_buffer.get_frame(1, timeout=0).data == b'second'
+    assert frame_buffer.get_latest_frame(timeout=0).sequence == 2
+
+
+def test_get_frame_times_out_without_new_frame():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'first')
+    assert frame_buffer.get_frame(1, timeout=0) is None
+
+
+def test_get_frame_waits_for_next_published_frame():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'first')
+    frames = []
+    reader = threading.Thread(target=lambda: frames.append(frame_buffer.get_frame(1, timeout=5)))
+    reader.start()
+    end_time = time.monotonic() + 2
+    while not frame_buffer.condition._waiters and time.monotonic() < end_time:
+        time.sleep(0.001)
+    frame_buffer.write(b'second')
+    reader.join(timeout=5)
+    assert not reader.is_alive()
+    assert [frame.data for frame in frames] == [b'second']
+
+
+def test_wait_frame_is_woken_by_frame_of_other_thread():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'first')
+
+    async def run():
+        waiting = asyncio.ensure_future(frame_buffer.wait_frame(1, timeout=5))
+        for _ in range(100):
+            if frame_buffer.futures:
+                break
+            await asyncio.sleep(0)
+        threading.Thread(target=frame_buffer.write, args=(b'second',)).start()
+        return await waiting
+
+    assert asyncio.run(run()).data == b'second'
+    assert not frame_buffer.futures
+
+
+def test_wait_fresh_frame_times_out_without_new_frame():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    assert asyncio.run(frame_buffer.wait_fresh_frame(10, timeout=0.01)) is None
+    assert not frame_buffer.futures
+
+
+def test_frame_queue_starts_with_latest_frame():
+    from spyglass.frame_buffer import FrameBuffer, FrameQueue
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'first')
+    with FrameQueue(frame_buffer) as frame_queue:
+        assert frame_queue.get(timeout=0).data == b'first'
+        assert frame_queue.get(timeout=0) is None
+
+
+def test_frame_queue_drops_oldest_frame_when_full():
+    from spyglass.frame_buffer import FrameBuffer, FrameQueue
+    frame_buffer = FrameBuffer()
+    with FrameQueue(frame_buffer, maxlen=2) as frame_queue:
+        for frame in [b'first', b'second', b'third', b'fourth']:
+            frame_buffer.write(frame)
+        assert frame_queue.dropped == 2
+        assert frame_queue.get(timeout=0).data == b'third'
+        assert frame_queue.get(timeout=0).data == b'fourth'
+
+
+def test_frame_queue_unsubscribes_on_exit():
+    from spyglass.frame_buffer import FrameBuffer, FrameQueue
+    frame_buffer = FrameBuffer()
+    with FrameQueue(frame_buffer) as frame_queue:
+        assert frame_buffer.queues == {frame_queue}
+    frame_buffer.write(b'frame')
+    assert frame_buffer.queues == set()
+    assert frame_queue.get(timeout=0) is None
+
+
+@pytest.mark.parametrize("exif_header, expected_output", [
+    (None, b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: 6\r\n\r\n\xff\xd8data\r\n'),
+    (b'\xff\xd8EXIF', b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: 10\r\n\r\n\xff\xd8EXIFdata\r\n'),
+])
+def test_frame_part(exif_header, expected_output):
+    from spyglass.frame_buffer import Frame
+    frame = Frame(b'\xff\xd8data', 1, exif_header)
+    assert b''.join(frame.part) == expected_output
+    assert frame.length == len(b''.join(frame.jpeg))
+
+
+def test_frame_buffer_shares_prepared_frame_between_clients():
+    from spyglass.frame_buffer import FrameBuffer, FrameQueue
+    frame_buffer = FrameBuffer(b'\xff\xd8EXIF')
+    with FrameQueue(frame_buffer) as first, FrameQueue(frame_buffer) as second:
+        frame_buffer.write(b'\xff\xd8data')
+        assert first.get(timeout=0) is second.get(timeout=0)
+
+
+def test_get_fresh_frame_waits_for_new_frame_when_stale():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'first')
+    assert frame_buffer.get_fresh_frame(10, timeout=0).data == b'first'
+    frame_buffer.frame.timestamp -= 20
+    assert frame_buffer.get_fresh_frame(10, timeout=0) is None
+
+
+def create_frames(fps, count):
+    from spyglass.frame_buffer import Frame
+    frames = []
+    for i in range(count):
+        frame = Frame(b'frame', i + 1)
+        # Timestamps with a little jitter, like the encoder delivers them
+        frame.timestamp = 1000 + i / fps + (0.002 if i % 2 else -0.002)
+        frames.append(frame)
+    return frames
+
+
+@pytest.mark.parametrize("source_fps, fps, expected_frames", [
+    (30, 30, 90),
+    (30, 10, 30),
+    (30, 5, 15),
+    (30, 1, 3),
+    (30, 60, 90),
+])
+def test_frame_rate_limiter_decimates_evenly(source_fps, fps, expected_frames):
+    from spyglass.frame_buffer import FrameRateLimiter
+    rate_limiter = FrameRateLimiter(fps)
+    accepted = [frame for frame in create_frames(source_fps, 90) if rate_limiter.accept(frame)]
+    assert len(accepted) == expected_frames
+    gaps = {b.sequence - a.sequence for a, b in zip(accepted, accepted[1:])}
+    assert len(gaps) <= 1
+
+
+def test_frame_queue_with_fps_skips_frames_without_dropping():
+    from spyglass.frame_buffer import FrameBuffer, FrameQueue
+    frame_buffer = FrameBuffer()
+    with FrameQueue(frame_buffer, fps=10) as frame_queue:
+        for frame in create_frames(30, 6):
+            frame_queue.put(frame)
+            if frame_queue.frames:
+                frame_queue.get(timeout=0)
+        assert frame_queue.dropped == 0
+        assert frame_queue.rate_limiter.next_time == pytest.approx(1000 + 2 / 10 - 0.002)
@@ -0,0 +1,54 @@
+import os
+
+H264_FILE = os.path.join(os.path.dirname(__file__), 'data', 'h264_1080p.h264')
+
+
+def read_h264_file():
+    with open(H264_FILE, 'rb') as f:
+        return f.read()
+
+
+def test_split_nal_units():
+    from spyglass.h264 import split_nal_units
+    assert split_nal_units(b'\x00\x00\x00\x01\x67\x64\x00\x00\x01\x68\xee\x00\x00\x00\x01\x65\x88') == [
+        b'\x67\x64', b'\x68\xee', b'\x65\x88'
+    ]
+
+
+def test_remove_emulation_prevention():
+    from spyglass.h264 import remove_emulation_prevention
+    assert remove_emulation_prevention(b'\x00\x00\x03\x01\x00\x00\x03\x00\x00\x03') == b'\x00\x00\x01\x00\x00\x00\x00'
+
+
+def test_read_exp_golomb_codes():
+    from spyglass.h264 import BitReader
+    # 1, 010, 011, 00100
+    reader = BitReader(bytes([0b10100110, 0b01000000]))
+    assert [reader.read_ue(), reader.read_ue(), reader.read_se(), reader.read_se()] == [0, 1, -1, 2]
+
+
+def test_parse_sequence_parameter_set():
+    from spyglass.h264 import H264Frame, SequenceParameterSet, split_access_units
+    frame = H264Frame(split_access_units(read_h264_file())[0], 1)
+    sps = SequenceParameterSet(frame.sps)
+    assert (sps.profile_idc, sps.level_idc, sps.chroma_format_idc) == (100, 40, 1)
+    assert (sps.width, sps.height) == (1920, 1080)
+
+
+def test_split_access_units():
+    from spyglass.h264 import H264Frame, split_access_units
+    frames = [H264Frame(data, i) for i, data in enumerate(split_access_units(read_h264_file()))]
+    assert [frame.keyframe for frame in frames] == [True, False, False, False] * 2
+    assert [frame.sps is not None for frame in frames] == [True, False, False, False] * 2
+    # Delimiters and parameter sets are not part of the picture
+    assert all(len(frame.nal_units) == 1 for frame in frames)
+    assert b''.join(split_access_units(read_h264_file())) == read_h264_file()
+
+
+def test_h264_frame_buffer_creates_h264_frames():
+    from spyglass.h264 import H264FrameBuffer, split_access_units
+    frame_buffer = H264FrameBuffer()
+    frame_buffer.write(split_access_units(read_h264_file())[0])
+    frame = frame_buffer.get_latest_frame(timeout=1)
+    assert frame.keyframe
+    assert frame_buffer.metrics.frames_encoded == 1
@@ -0,0 +1,93 @@
+def create_frame(length, timestamp):
+    from spyglass.frame_buffer import Frame
+    frame = Frame(b'\xff\xd8' + b'x' * (length - 2), 1)
+    frame.timestamp = timestamp
+    return frame
+
+
+def test_record_frame():
+    from spyglass.metrics import Metrics
+    metrics = Metrics()
+    for i in range(11):
+        metrics.record_frame(create_frame(100 + i * 10, 1000 + i * 0.1))
+    assert metrics.frames_encoded == 11
+    assert metrics.get_average_frame_size() == 150
+    assert round(metrics.get_fps(), 3) == 10.0
+
+
+def test_histogram_buckets():
+    from spyglass.metrics import Histogram
+    histogram = Histogram((0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 5.0]:
+        histogram.observe(value)
+    assert list(histogram.cumulative_counts()) == [2, 3, 4]
+    assert histogram.count == 4
+
+
+def test_stream_client_is_removed_on_exit():
+    from spyglass.metrics import Metrics
+    metrics = Metrics()
+    with metrics.stream_client(('1.2.3.4', 5678)) as client:
+        metrics.record_sent_frame(client, create_frame(100, 0), 150, frames_dropped=2)
+        assert metrics.stream_connections == 1
+        assert metrics.to_dict()['clients'] == [
+            {'address': '1.2.3.4:5678', 'bytes_sent': 150, 'frames_sent': 1, 'frames_dropped': 2}
+        ]
+    assert metrics.stream_connections == 0
+    assert metrics.clients == {}
+
+
+def test_prometheus_format():
+    from spyglass.metrics import Metrics
+    metrics = Metrics()
+    metrics.record_frame(create_frame(100, 0))
+    with metrics.stream_client(('1.2.3.4', 5678)):
+        content = metrics.to_prometheus()
+    assert '# TYPE spyglass_frames_encoded_total counter\nspyglass_frames_encoded_total 1\n' in content
+    assert 'spyglass_stream_connections 1\n' in content
+    assert 'spyglass_send_latency_seconds_bucket{le="+Inf"} 0\n' in content
+    assert 'spyglass_client_bytes_sent_total{client="1.2.3.4:5678"} 0\n' in content
+
+
+def test_prometheus_format_of_camera_streams():
+    from spyglass.metrics import Metrics, streams_to_prometheus
+    main, lores = Metrics(), Metrics()
+    main.record_camera_start()
+    lores.record_frame(create_frame(100, 0))
+    with lores.stream_client(('1.2.3.4', 5678)):
+        content = streams_to_prometheus({'main': main, 'lores': lores})
+    assert content.count('# TYPE spyglass_frames_encoded_total counter\n') == 1
+    assert 'spyglass_frames_encoded_total{stream="main"} 0\n' in content
+    assert 'spyglass_frames_encoded_total{stream="lores"} 1\n' in content
+    assert 'spyglass_stream_connections{stream="lores"} 1\n' in content
+    assert 'spyglass_client_bytes_sent_total{stream="lores",client="1.2.3.4:5678"} 0\n' in content
+    assert 'spyglass_camera_starts_total 1\n' in content
+    assert content.count('\nspyglass_camera_running') == 1
+
+
+def test_json_format_of_camera_streams():
+    from spyglass.metrics import Metrics, streams_to_dict
+    main, lores = Metrics(), Metrics()
+    with lores.stream_client(('1.2.3.4', 5678)):
+        content = streams_to_dict({'main': main, 'lores': lores})
+    assert content['stream_connections'] == 0
+    assert content['streams']['lores']['stream_connections'] == 1
+    assert content['streams']['lores']['clients'][0]['address'] == '1.2.3.4:5678'
+    assert 'camera_starts' in content and 'camera_starts' not in content['streams']['lores']
+
+
+def test_startup_report_after_first_frame():
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.metrics import StartupTimer
+    timer = StartupTimer()
+    with timer.phase('configure'):
+        pass
+    with timer.phase('import'):
+        pass
+    frame_buffer = FrameBuffer()
+    thread = timer.report_on_first_frame([frame_buffer])
+    assert frame_buffer.metrics.startup_seconds == {}
+    frame_buffer.write(b'\xff\xd8\xff\xd9')
+    thread.join(1)
+    assert list(frame_buffer.metrics.startup_seconds) == ['import', 'configure', 'first_frame']
+    assert 'spyglass_startup_seconds{phase="first_frame"}' in frame_buffer.metrics.to_prometheus()
@@ -0,0 +1,94 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+def moving_square_frames(count, size=(160, 120), square=16, step=8, noise=4, seed=0):
+    """Luma frames of a bright square moving over a noisy gray background."""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    frames = []
+    for i in range(count):
+        frame = rng.integers(100 - noise, 100 + noise, (height, width), dtype=np.uint8)
+        x = 20 + i * step
+        frame[40:40 + square, x:x + square] = 250
+        frames.append(frame)
+    return frames
+
+
+def static_frames(count, size=(160, 120), noise=4, seed=0):
+    rng = np.random.default_rng(seed)
+    width, height = size
+    return [rng.integers(100 - noise, 100 + noise, (height, width), dtype=np.uint8) for _ in range(count)]
+
+
+def test_first_frame_has_no_motion():
+    from spyglass.motion import MotionDetector
+    detector = MotionDetector()
+    result = detector.update(static_frames(1)[0], 1000.0)
+    assert not result['motion']
+    assert result['timestamp'] == 1000.0
+
+
+def test_static_noisy_frames_have_no_motion():
+    from spyglass.motion import MotionDetector
+    detector = MotionDetector()
+    results = [detector.update(frame) for frame in static_frames(10)]
+    assert not any(result['motion'] for result in results)
+    assert all(result['area'] == 0.0 for result in results)
+
+
+def test_moving_square_is_detected():
+    from spyglass.motion import MotionDetector
+    detector = MotionDetector()
+    results = [detector.update(frame, 1000.0 + i) for i, frame in enumerate(moving_square_frames(5))]
+    assert not results[0]['motion']
+    assert all(result['motion'] for result in results[1:])
+    # The square left x 20-36 and moved to x 28-44 in the second frame
+    assert results[1]['box'] == [20, 40, 24, 16]
+    assert detector.last_motion == 1004.0
+
+
+def test_stopped_object_stays_in_foreground():
+    from spyglass.motion import MotionDetector
+    detector = MotionDetector()
+    frames = static_frames(3) + [moving_square_frames(1)[0]] * 3
+    results = [detector.update(frame) for frame in frames]
+    assert results[3]['motion']
+    assert not results[5]['motion']
+    assert results[5]['foreground'] > 0
+
+
+def test_frames_are_analyzed_at_decimated_rate():
+    from spyglass.motion import MotionDetector
+    detector = MotionDetector(fps=2)
+    timestamps = [1000 + i / 30 for i in range(60)]
+    assert sum(detector.due(timestamp) for timestamp in timestamps) == 4
+
+
+def test_result_is_published_with_stream_frames():
+    import json
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.motion import MotionDetector
+    detector = MotionDetector()
+    frame_buffer = FrameBuffer()
+    frame_buffer.motion = detector
+    for frame in moving_square_frames(2):
+        detector.update(frame)
+    frame_buffer.write(b'\xff\xd8frame\xff\xd9')
+    assert frame_buffer.frame.part[0] == (b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: 9\r\n'
+                                          b'X-Motion: 1\r\nX-Motion-Area: 0.01333\r\n\r\n')
+    content = json.loads(detector.to_json())
+    assert content['motion']
+    assert content['frames'] == 2
+
+
+@pytest.mark.parametrize("width, height, expected", [
+    (1920, 1080, (320, 180)),
+    (640, 480, (320, 240)),
+    (200, 100, (200, 100)),
+    (1080, 1920, (134, 240)),
+])
+def test_get_motion_size(width, height, expected):
+    from spyglass.motion import get_motion_size
+    assert get_motion_size(width, height) == expected
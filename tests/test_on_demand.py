@@ -0,0 +1,157 @@
+import time
+import pytest
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+        'picamera2': MagicMock(),
+    })
+
+
+def create_on_demand(idle_timeout=0.05):
+    from spyglass.camera.on_demand import OnDemand
+    from spyglass.metrics import Metrics
+    start = MagicMock()
+    stop = MagicMock()
+    return OnDemand(start, stop, idle_timeout, Metrics()), start, stop
+
+
+def wait_until(condition, timeout=2):
+    end_time = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end_time:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_first_client_starts_camera():
+    on_demand, start, stop = create_on_demand()
+    on_demand.acquire()
+    on_demand.acquire()
+    assert start.call_count == 1
+    assert on_demand.running
+    assert on_demand.metrics.camera_starts == 1
+
+
+def test_camera_stops_after_idle_timeout():
+    on_demand, start, stop = create_on_demand()
+    on_demand.acquire()
+    on_demand.release()
+    assert wait_until(lambda: stop.called)
+    assert not on_demand.running
+    assert on_demand.metrics.camera_running == 0
+
+
+def test_client_within_idle_timeout_keeps_camera_running():
+    on_demand, start, stop = create_on_demand(idle_timeout=0.2)
+    on_demand.acquire()
+    on_demand.release()
+    stop_timer = on_demand.stop_timer
+    on_demand.acquire()
+    # The cancelled timer ends without stopping the camera
+    stop_timer.join(timeout=2)
+    assert not stop_timer.is_alive()
+    assert on_demand.stop_timer is None
+    assert not stop.called
+    on_demand.release()
+    assert wait_until(lambda: stop.called)
+    assert start.call_count == 1
+
+
+def test_failed_start_does_not_count_client():
+    on_demand, start, stop = create_on_demand()
+    start.side_effect = RuntimeError('camera busy')
+    with pytest.raises(RuntimeError):
+        on_demand.acquire()
+    assert on_demand.clients == 0
+    assert not on_demand.running
+
+
+def test_snapshot_waits_for_first_frame_of_started_camera():
+    pytest.importorskip('PIL')
+    from spyglass.camera.synthetic import Synthetic
+    cam = Synthetic()
+    cam.configure(64, 48, 30)
+    cam.start_on_demand(idle_timeout=0.05)
+    try:
+        with cam.frame_buffer.client():
+            frame = cam.frame_buffer.get_fresh_frame(1.0, timeout=5)
+        assert frame is not None
+        assert wait_until(lambda: not cam.frame_buffer.on_demand.running)
+        assert cam.frame_buffer.frame is None
+        metrics = cam.frame_buffer.metrics
+        assert metrics.cold_start_latency.count == 1
+        assert 0 <= metrics.cold_start_latency.sum < 5
+    finally:
+        cam.stop()
+
+
+def create_frame_buffer_failing_to_start():
+    from spyglass.frame_buffer import FrameBuffer
+    frame_buffer = FrameBuffer()
+    frame_buffer.on_demand, start, _ = create_on_demand()
+    start.side_effect = RuntimeError('camera busy')
+    return frame_buffer
+
+
+@pytest.mark.parametrize("path", ['/snapshot', '/stream'])
+def test_failed_start_returns_service_unavailable(path):
+    import http.client
+    import threading
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), create_frame_buffer_failing_to_start())])
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*streaming_server.server_address, timeout=5)
+        connection.request('GET', path)
+        assert connection.getresponse().status == 503
+        connection.close()
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+
+
+@pytest.mark.parametrize("path", ['/snapshot', '/stream'])
+def test_failed_start_returns_service_unavailable_in_asyncio_mode(path):
+    import asyncio
+    from spyglass.async_server import AsyncStreamingServer
+    from spyglass.server import CameraEndpoints
+
+    async def run():
+        server = AsyncStreamingServer(('127.0.0.1', 0),
+                                      [CameraEndpoints(MagicMock(), create_frame_buffer_failing_to_start())])
+        await server.start()
+        reader, writer = await asyncio.open_connection(*server.server_address)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        server.server.close()
+        return response
+
+    assert asyncio.run(run()).startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+
+
+def test_stream_without_first_frame_returns_service_unavailable(mocker):
+    import http.client
+    import threading
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    mocker.patch('spyglass.server.FRAME_TIMEOUT', 0.1)
+    frame_buffer = FrameBuffer()
+    frame_buffer.on_demand, start, _ = create_on_demand()
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), frame_buffer)])
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*streaming_server.server_address, timeout=5)
+        connection.request('GET', '/stream')
+        assert connection.getresponse().status == 503
+        connection.close()
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+    assert start.called
+    assert frame_buffer.on_demand.clients == 0
@@ -0,0 +1,178 @@
+import pytest
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+        'picamera2': MagicMock(),
+    })
+
+
+def test_frames_of_capture_process_reach_frame_buffer():
+    pytest.importorskip('PIL')
+    from spyglass.camera.process import ProcessCamera
+    from spyglass.camera.synthetic import read_timestamp
+    cam = ProcessCamera(fake=True)
+    cam.configure(64, 48, 30, 'continuous', 0.0, 'normal')
+    cam.start(1)
+    try:
+        first = cam.frame_buffer.get_latest_frame(timeout=5)
+        second = cam.frame_buffer.get_frame(first.sequence, timeout=5)
+    finally:
+        cam.stop()
+    assert second.sequence > first.sequence
+    assert read_timestamp(second.data) is not None
+    assert second.jpeg[0] == cam.frame_buffer.exif_header
+    assert cam.process is None
+
+
+def test_schema_is_compiled_from_controls_of_capture_process():
+    pytest.importorskip('PIL')
+    from spyglass.camera.process import ProcessCamera
+    cam = ProcessCamera(fake=True)
+    cam.configure(64, 48, 30, 'continuous', 0.0, 'normal')
+    schema = cam.controls.schema
+    cam.start()
+    try:
+        assert cam.controls.schema is not schema
+    finally:
+        cam.stop()
+
+
+def test_capture_process_streams_image_files(tmp_path):
+    from spyglass.camera.process import ProcessCamera
+    image_file = tmp_path / 'image.jpg'
+    image_file.write_bytes(b'\xff\xd8image\xff\xd9')
+    cam = ProcessCamera(fake=True, image_files=[str(image_file)])
+    cam.configure(64, 48, 30, 'continuous', 0.0, 'normal')
+    cam.start()
+    try:
+        frame = cam.frame_buffer.get_latest_frame(timeout=5)
+    finally:
+        cam.stop()
+    assert frame.data.endswith(b'image\xff\xd9')
+
+
+def test_reconfigure_restarts_capture_process():
+    pytest.importorskip('PIL')
+    import io
+    from PIL import Image
+    from spyglass.camera.process import ProcessCamera
+    cam = ProcessCamera(fake=True)
+    cam.configure(64, 48, 30, 'continuous', 0.0, 'normal')
+    cam.start()
+    try:
+        frame = cam.frame_buffer.get_latest_frame(timeout=5)
+        assert cam.reconfigure({'width': 32, 'height': 24}) == {'width': 32, 'height': 24}
+        next_frame = cam.frame_buffer.get_frame(frame.sequence, timeout=5)
+    finally:
+        cam.stop()
+    assert Image.open(io.BytesIO(next_frame.data)).size == (32, 24)
+
+
+def test_failing_capture_process_raises():
+    from spyglass.camera.process import ProcessCamera
+    pytest.importorskip('PIL')
+    cam = ProcessCamera(fake=True)
+    # Frames of negative width can not be generated in the capture process
+    cam.configure(-64, 48, 30, 'continuous', 0.0, 'normal')
+    with pytest.raises(RuntimeError):
+        cam.start()
+    assert cam.process is None
+
+
+def test_reader_publishes_frames_and_counts_dropped_frames():
+    import multiprocessing
+    import threading
+    from spyglass.camera.process import ProcessCamera
+    from spyglass.shared_frames import ANNOUNCEMENT, SharedFrameRing
+    cam = ProcessCamera()
+    cam.ring = SharedFrameRing.create(4, 1024)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    try:
+        cam.ring.write(1, b'\xff\xd8frame\xff\xd9')
+        for announcement in [(1, 0), (1, 1), (1, 3)]:
+            sender.send_bytes(ANNOUNCEMENT.pack(*announcement))
+        reader_thread = threading.Thread(target=cam._read_frames, args=(receiver,))
+        reader_thread.start()
+        frame = cam.frame_buffer.get_latest_frame(timeout=5)
+        sender.close()
+        reader_thread.join()
+    finally:
+        cam.ring.close()
+        cam.ring.unlink()
+    assert frame.data == b'\xff\xd8frame\xff\xd9'
+    assert cam.frame_buffer.metrics.frames_encoded == 1
+    assert cam.frame_buffer.metrics.frames_dropped == 3
+
+
+def test_controls_are_sent_once_connected():
+    from spyglass.camera.process import RemotePicamera2
+    picam2 = RemotePicamera2()
+    picam2.set_controls({'Brightness': 0.5})
+    connection = MagicMock()
+    picam2.connect(connection)
+    picam2.set_controls({'Contrast': 1.5})
+    assert [c.args[0] for c in connection.send.call_args_list] == [
+        ('controls', {'Brightness': 0.5}),
+        ('controls', {'Contrast': 1.5}),
+    ]
+
+
+def test_to_plain_values():
+    from spyglass.camera.process import to_plain_values
+
+    class Enum:
+        def __int__(self):
+            return 2
+
+    class Rectangle:
+        def __str__(self):
+            return '(0, 0)/64x48'
+
+    assert to_plain_values({'AfMode': Enum(), 'ScalerCrop': (Rectangle(), Rectangle(), None), 'Brightness': 0.5}) == {
+        'AfMode': 2, 'ScalerCrop': ('(0, 0)/64x48', '(0, 0)/64x48', None), 'Brightness': 0.5
+    }
+
+
+def run_terminated_server(names):
+    import threading
+    from spyglass.camera.process import ProcessCamera
+    from spyglass.cli import install_terminate_handler
+    install_terminate_handler()
+    cam = ProcessCamera(fake=True)
+    cam.configure(64, 48, 30, 'continuous', 0.0, 'normal')
+    cam.start(1)
+    try:
+        names.put(cam.ring.name)
+        threading.Event().wait()
+    finally:
+        cam.stop()
+
+
+def test_terminated_server_unlinks_shared_memory():
+    pytest.importorskip('PIL')
+    import multiprocessing
+    import os
+    context = multiprocessing.get_context('fork')
+    names = context.Queue()
+    server = context.Process(target=run_terminated_server, args=(names,))
+    server.start()
+    name = names.get(timeout=30)
+    assert os.path.exists(f'/dev/shm/{name}')
+    server.terminate()
+    server.join(10)
+    assert server.exitcode == 128 + 15
+    assert not os.path.exists(f'/dev/shm/{name}')
+
+
+def test_camera_package_does_not_import_capture_process():
+    import importlib
+    import sys
+    for module in ('spyglass.camera', 'spyglass.camera.process', 'spyglass.camera.synthetic'):
+        sys.modules.pop(module, None)
+    importlib.import_module('spyglass.camera')
+    assert 'spyglass.camera.process' not in sys.modules
+    assert 'spyglass.camera.synthetic' not in sys.modules
@@ -0,0 +1,126 @@
+import struct
+
+# Minimal JPEG with a baseline frame header of 640x480
+JPEG = b'\xff\xd8\xff\xe0\x00\x04ab\xff\xc0\x00\x0b\x08\x01\xe0\x02\x80\x01\x01\x11\x00\xff\xd9'
+
+
+def write_frames(monkeypatch, frame_buffer, count, interval=0.125):
+    for i in range(count):
+        monkeypatch.setattr('time.time', lambda: 1000 + i * interval)
+        frame_buffer.write(JPEG)
+    monkeypatch.undo()
+
+
+def test_ring_keeps_last_seconds():
+    from spyglass.frame_buffer import Frame
+    from spyglass.recording import FrameRing
+    ring = FrameRing(1.0, 1024 * 1024)
+    for i in range(30):
+        frame = Frame(JPEG, i + 1)
+        frame.timestamp = 1000 + i * 0.1
+        ring.put(frame)
+    assert [frame.sequence for frame in ring.get_frames()] == list(range(20, 31))
+    assert [frame.sequence for frame in ring.get_frames(0.45)] == list(range(26, 31))
+
+
+def test_ring_evicts_frames_over_memory_budget():
+    from spyglass.frame_buffer import Frame
+    from spyglass.recording import FrameRing
+    ring = FrameRing(60, 3 * len(JPEG))
+    for i in range(5):
+        ring.put(Frame(JPEG, i + 1))
+    assert [frame.sequence for frame in ring.get_frames()] == [3, 4, 5]
+    assert ring.size == 3 * len(JPEG)
+
+
+def test_get_jpeg_size():
+    import pytest
+    from spyglass.recording import get_jpeg_size
+    assert get_jpeg_size(JPEG) == (640, 480)
+    with pytest.raises(ValueError):
+        get_jpeg_size(b'\xff\xd8\xff\xd9')
+
+
+def test_write_avi():
+    import io
+    from spyglass.frame_buffer import Frame
+    from spyglass.recording import write_avi
+    frames = []
+    for i in range(3):
+        # Odd lengths need padding, the EXIF header is written with the frame
+        frame = Frame(JPEG, i + 1, exif_header=b'\xff\xd8EXIF' if i == 1 else None)
+        frame.timestamp = 1000 + i * 0.1
+        frames.append(frame)
+    f = io.BytesIO()
+    write_avi(f, frames)
+    data = f.getvalue()
+
+    riff, size, avi = struct.unpack('<4sI4s', data[:12])
+    assert (riff, avi, size) == (b'RIFF', b'AVI ', len(data) - 8)
+    avih = data.index(b'avih') + 8
+    micro_sec_per_frame, = struct.unpack('<I', data[avih:avih + 4])
+    assert micro_sec_per_frame == 100000
+    assert struct.unpack('<II', data[avih + 32:avih + 40]) == (640, 480)
+    movi = data.index(b'movi')
+    idx1 = data.index(b'idx1')
+    entries = [struct.unpack('<4s3I', data[idx1 + 8 + i * 16:idx1 + 24 + i * 16]) for i in range(3)]
+    chunks = [data[movi + offset + 8:movi + offset + 8 + length] for _, _, offset, length in entries]
+    assert chunks == [b''.join(frame.jpeg) for frame in frames]
+    assert all(data[movi + offset:movi + offset + 4] == b'00dc' for _, _, offset, _ in entries)
+
+
+def test_save_clip_in_background(monkeypatch, tmp_path):
+    import os
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.recording import ClipRecorder
+    frame_buffer = FrameBuffer()
+    recorder = ClipRecorder(frame_buffer, str(tmp_path / 'clips'), 60, 1024 * 1024)
+    write_frames(monkeypatch, frame_buffer, 20)
+
+    clip = recorder.save_clip(1.0)
+    recorder.jobs.join()
+    assert clip['frames'] == 9
+    assert clip['seconds'] == 1.0
+    assert os.listdir(tmp_path / 'clips') == [os.path.basename(clip['path'])]
+    with open(clip['path'], 'rb') as f:
+        assert f.read(4) == b'RIFF'
+
+
+def test_save_clip_without_frames(tmp_path):
+    import pytest
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.recording import ClipRecorder
+    recorder = ClipRecorder(FrameBuffer(), str(tmp_path), 60, 1024 * 1024)
+    with pytest.raises(ValueError):
+        recorder.save_clip()
+
+
+def test_save_clip_while_previous_clip_is_written(mocker, monkeypatch, tmp_path):
+    import threading
+    import pytest
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.recording import ClipRecorder
+    written = threading.Event()
+    mocker.patch('spyglass.recording.write_avi', side_effect=lambda f, frames: written.wait(5))
+    frame_buffer = FrameBuffer()
+    recorder = ClipRecorder(frame_buffer, str(tmp_path), 60, 1024 * 1024)
+    write_frames(monkeypatch, frame_buffer, 3)
+    recorder.save_clip()
+    with pytest.raises(ValueError):
+        recorder.save_clip()
+    written.set()
+    recorder.jobs.join()
+    assert recorder.save_clip()['frames'] == 3
+
+
+def test_clips_of_different_length_get_different_names(monkeypatch, tmp_path):
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.recording import ClipRecorder
+    frame_buffer = FrameBuffer()
+    recorder = ClipRecorder(frame_buffer, str(tmp_path), 60, 1024 * 1024)
+    write_frames(monkeypatch, frame_buffer, 20)
+    first = recorder.save_clip(1.0)
+    recorder.jobs.join()
+    second = recorder.save_clip()
+    recorder.jobs.join()
+    assert first['path'] != second['path']
@@ -0,0 +1,361 @@
+import pytest
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+    })
+
+
+class PartialConnection:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.data = b''
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(bytes(b) for b in buffers)[:self.max_bytes]
+        self.data += data
+        return len(data)
+
+
+def test_send_buffers_uses_single_call():
+    from spyglass.server import send_buffers
+    connection = PartialConnection(1024)
+    send_buffers(connection, [b'abc', b'def', memoryview(b'ghi')[1:]])
+    assert connection.data == b'abcdefhi'
+    assert connection.calls == 1
+
+
+def test_send_buffers_resumes_after_partial_send():
+    from spyglass.server import send_buffers
+    connection = PartialConnection(4)
+    send_buffers(connection, [b'abc', b'defgh', b'', b'ij'])
+    assert connection.data == b'abcdefghij'
+    assert connection.calls == 3
+
+
+def create_frame(sequence=1, timestamp=1700000000.5):
+    from spyglass.frame_buffer import Frame
+    frame = Frame(b'\xff\xd8data', sequence)
+    frame.timestamp = timestamp
+    return frame
+
+
+@pytest.mark.parametrize("headers, expected_output", [
+    ({}, False),
+    ({'If-None-Match': 'ETAG'}, True),
+    ({'If-None-Match': 'W/ETAG'}, True),
+    ({'If-None-Match': '"other", ETAG'}, True),
+    ({'If-None-Match': '*'}, True),
+    ({'If-None-Match': '"other"'}, False),
+    ({'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:20 GMT'}, True),
+    ({'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:19 GMT'}, False),
+    ({'If-Modified-Since': 'invalid'}, False),
+])
+def test_is_not_modified(headers, expected_output):
+    from spyglass.server import get_etag, is_not_modified
+    frame = create_frame()
+    headers = {k: v.replace('ETAG', get_etag(frame)) for k, v in headers.items()}
+    assert is_not_modified(headers, frame) == expected_output
+
+
+def test_snapshot_headers():
+    from spyglass.server import get_etag, get_snapshot_headers
+    frame = create_frame()
+    headers = dict(get_snapshot_headers(frame))
+    assert headers['ETag'] == get_etag(frame)
+    assert headers['Last-Modified'] == 'Tue, 14 Nov 2023 22:13:20 GMT'
+    assert get_etag(frame) != get_etag(create_frame(sequence=2))
+
+
+def test_snapshot_variants_have_own_etags():
+    from spyglass.server import get_etag, get_snapshot_headers, is_not_modified
+    from spyglass.snapshot_variants import Variant
+    frame = create_frame()
+    variant = Variant(width=320)
+    etag = get_etag(frame, variant)
+    assert dict(get_snapshot_headers(frame, variant))['ETag'] == etag
+    assert etag not in (get_etag(frame), get_etag(frame, Variant(height=320)))
+    assert etag == get_etag(frame, Variant(width=320))
+    assert not is_not_modified({'If-None-Match': get_etag(frame)}, frame, variant)
+    assert is_not_modified({'If-None-Match': etag}, frame, variant)
+
+
+@pytest.mark.parametrize("url_prefix, url, expected", [
+    ('', '/stream', '/stream'),
+    ('/camera1', '/stream', '/camera1/stream'),
+    ('/camera1/', 'snapshot', '/camera1/snapshot'),
+])
+def test_join_url(url_prefix, url, expected):
+    from spyglass.server import join_url
+
+    assert join_url(url_prefix, url) == expected
+
+
+def test_routes_of_cameras():
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, create_routes
+    frame_buffer = FrameBuffer()
+    lores_frame_buffer = FrameBuffer()
+    camera = CameraEndpoints(MagicMock(), frame_buffer, url_prefix='/camera1', lores_frame_buffer=lores_frame_buffer)
+    other_camera = CameraEndpoints(MagicMock(), FrameBuffer(), stream_url='/?action=stream',
+                                   snapshot_url='/?action=snapshot')
+    routes = create_routes([camera, other_camera])
+
+    assert routes.match('/camera1/stream?fps=5') == ('stream', camera, frame_buffer)
+    assert routes.match('/camera1/lores/stream') == ('stream', camera, lores_frame_buffer)
+    assert routes.match('/camera1/lores/snapshot') == ('snapshot', camera, lores_frame_buffer)
+    assert routes.match('/camera1/metrics') == ('metrics', camera, frame_buffer)
+    assert routes.match('/?action=snapshot') == ('snapshot', other_camera, other_camera.frame_buffer)
+    assert routes.match('/lores/snapshot') is None
+    assert routes.match('/?action=other') is None
+
+
+def test_snapshots_on_persistent_connection():
+    import http.client
+    import threading
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'\xff\xd8frame\xff\xd9')
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), frame_buffer)])
+    StreamingHandler.snapshot_max_age = 60
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*streaming_server.server_address, timeout=5)
+        connection.request('GET', '/snapshot')
+        first = connection.getresponse()
+        assert first.read() == b'\xff\xd8frame\xff\xd9'
+        sock = connection.sock
+        connection.request('GET', '/metrics')
+        second = connection.getresponse()
+        second.read()
+        assert second.status == 200
+        assert connection.sock is sock
+        connection.close()
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+
+
+@pytest.mark.parametrize("path, expected", [
+    ('/stream', None),
+    ('/stream?fps=5', 5.0),
+    ('/?action=stream&fps=0.5', 0.5),
+])
+def test_get_stream_fps(path, expected):
+    from spyglass.server import get_stream_fps
+    assert get_stream_fps(path) == expected
+
+
+@pytest.mark.parametrize("path", ['/stream?fps=0', '/stream?fps=-1', '/stream?fps=fast', '/stream?fps=nan'])
+def test_get_invalid_stream_fps(path):
+    from spyglass.server import get_stream_fps
+    with pytest.raises(ValueError):
+        get_stream_fps(path)
+
+
+def test_reconfigure_camera_with_json():
+    import http.client
+    import json
+    import threading
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    reconfigure = MagicMock(return_value={'fps': 30})
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), FrameBuffer(), reconfigure=reconfigure)])
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*streaming_server.server_address, timeout=5)
+        connection.request('POST', '/api/config', body=b'{"fps": 30}')
+        response = connection.getresponse()
+        assert json.loads(response.read()) == {'changed': {'fps': 30}}
+        reconfigure.side_effect = ValueError('fps must be a positive integer')
+        connection.request('POST', '/api/config', body=b'{"fps": -1}')
+        assert connection.getresponse().status == 400
+        connection.close()
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+    reconfigure.assert_called_with({'fps': -1})
+
+
+@pytest.mark.parametrize("value, expected", [('0', 0), ('42', 42), (' 42 ', 42)])
+def test_get_content_length(value, expected):
+    from spyglass.server import get_content_length
+    assert get_content_length(value) == expected
+
+
+@pytest.mark.parametrize("value", ['-1', 'abc', '+1', '1e3', '', '100000000'])
+def test_get_invalid_content_length(value):
+    from spyglass.server import get_content_length
+    with pytest.raises(ValueError):
+        get_content_length(value)
+
+
+@pytest.mark.parametrize("length", [b'-1', b'abc'])
+def test_post_with_invalid_content_length(length):
+    import socket
+    import threading
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), FrameBuffer())])
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        with socket.create_connection(streaming_server.server_address, timeout=5) as client:
+            client.sendall(b'POST /api/controls HTTP/1.1\r\nHost: localhost\r\nContent-Length: %s\r\n\r\n{}' % length)
+            assert client.recv(1024).startswith(b'HTTP/1.1 400')
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+
+
+def test_snapshot_on_unix_socket(tmp_path):
+    import os
+    import socket
+    import stat
+    import threading
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, StreamingHandler, UnixStreamingServer, create_routes
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(b'\xff\xd8frame\xff\xd9')
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), frame_buffer)])
+    StreamingHandler.snapshot_max_age = 60
+    path = str(tmp_path / 'spyglass.sock')
+    streaming_server = UnixStreamingServer(path, StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o660
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(5)
+            sock.connect(path)
+            sock.sendall(b'GET /snapshot HTTP/1.1\r\nConnection: close\r\n\r\n')
+            response = b''
+            while chunk := sock.recv(4096):
+                response += chunk
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert response.endswith(b'\xff\xd8frame\xff\xd9')
+    assert not (tmp_path / 'spyglass.sock').exists()
+
+
+def test_remove_stale_socket_keeps_other_files(tmp_path):
+    from spyglass.server import remove_stale_socket
+    path = tmp_path / 'spyglass.sock'
+    path.write_text('not a socket')
+    remove_stale_socket(str(path))
+    remove_stale_socket(str(tmp_path / 'missing.sock'))
+    assert path.exists()
+
+
+def test_fmp4_stream_starts_with_init_segment():
+    import os
+    import http.client
+    import threading
+    from spyglass.h264 import H264FrameBuffer, split_access_units
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'h264_1080p.h264'), 'rb') as f:
+        access_units = split_access_units(f.read())
+    h264_frame_buffer = H264FrameBuffer()
+    h264_frame_buffer.write(access_units[1])
+    camera = CameraEndpoints(MagicMock(), FrameBuffer(), h264_frame_buffer=h264_frame_buffer)
+    StreamingHandler.routes = create_routes([camera])
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*streaming_server.server_address, timeout=5)
+        connection.request('GET', '/stream.mp4')
+        response = connection.getresponse()
+        while not h264_frame_buffer.metrics.stream_connections:
+            threading.Event().wait(0.01)
+        for access_unit in access_units[4:6]:
+            h264_frame_buffer.write(access_unit)
+        data = response.read(8)
+        connection.close()
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+    assert response.getheader('Content-Type') == 'video/mp4'
+    assert data[4:8] == b'ftyp'
+
+
+def test_save_clip_with_json(tmp_path):
+    import http.client
+    import json
+    import threading
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.recording import ClipRecorder
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    frame_buffer = FrameBuffer()
+    recorder = ClipRecorder(frame_buffer, str(tmp_path), 60, 1024 * 1024)
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), frame_buffer, recorder=recorder)])
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*streaming_server.server_address, timeout=5)
+        connection.request('POST', '/api/clip', body=b'')
+        assert connection.getresponse().status == 400
+        frame_buffer.write(b'\xff\xd8\xff\xc0\x00\x0b\x08\x00\x10\x00\x20\x01\x01\x11\x00\xff\xd9')
+        connection.request('POST', '/api/clip', body=b'{"seconds": "all"}')
+        assert connection.getresponse().status == 400
+        connection.request('POST', '/api/clip', body=b'{"seconds": 30}')
+        clip = json.loads(connection.getresponse().read())
+        connection.close()
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+    recorder.jobs.join()
+    assert clip['frames'] == 1
+    assert (tmp_path / clip['path']).exists()
+
+
+def test_timelapse_api(tmp_path):
+    import http.client
+    import json
+    import threading
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, StreamingHandler, StreamingServer, create_routes
+    from spyglass.timelapse import Timelapse
+    frame_buffer = FrameBuffer()
+    timelapse = Timelapse(frame_buffer, str(tmp_path))
+    StreamingHandler.routes = create_routes([CameraEndpoints(MagicMock(), frame_buffer, timelapse=timelapse)])
+    streaming_server = StreamingServer(('127.0.0.1', 0), StreamingHandler)
+    threading.Thread(target=streaming_server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection(*streaming_server.server_address, timeout=5)
+        responses = []
+        for body in [b'{"action": "start", "interval": 0}', b'{"action": "start", "name": "print"}',
+                     b'{"action": "trigger"}', b'{"action": "pause"}']:
+            connection.request('POST', '/api/timelapse', body=body)
+            response = connection.getresponse()
+            responses.append((response.status, response.read()))
+        frame_buffer.write(b'\xff\xd8frame\xff\xd9')
+        connection.request('GET', '/api/timelapse')
+        status = json.loads(connection.getresponse().read())
+        connection.close()
+    finally:
+        streaming_server.shutdown()
+        streaming_server.server_close()
+    assert [status for status, _ in responses] == [400, 200, 200, 400]
+    assert json.loads(responses[1][1])['directory'] == str(tmp_path / 'print')
+    assert status['running']
+    assert status['captured'] == 1
+
+
+def test_routes_of_motion_detection():
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.server import CameraEndpoints, create_routes
+    motion = MagicMock()
+    camera = CameraEndpoints(MagicMock(), FrameBuffer(), url_prefix='/camera1', motion=motion)
+    routes = create_routes([camera, CameraEndpoints(MagicMock(), FrameBuffer())])
+    assert routes.match('/camera1/motion') == ('motion', camera, camera.frame_buffer)
+    assert routes.match('/motion') is None
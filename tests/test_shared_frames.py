@@ -0,0 +1,74 @@
+import pytest
+
+
+@pytest.fixture
+def ring():
+    from spyglass.shared_frames import SharedFrameRing
+    ring = SharedFrameRing.create(4, 1024)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def test_read_written_frame(ring):
+    ring.write(1, b'\xff\xd8first\xff\xd9')
+    ring.write(2, memoryview(b'\xff\xd8second\xff\xd9'))
+    assert ring.read(1) == b'\xff\xd8first\xff\xd9'
+    assert ring.read(2) == b'\xff\xd8second\xff\xd9'
+    assert ring.read(3) is None
+
+
+def test_overwritten_frame_is_not_returned(ring):
+    for sequence in range(1, 6):
+        ring.write(sequence, b'frame%d' % sequence)
+    assert ring.read(1) is None
+    assert ring.read(5) == b'frame5'
+
+
+def test_frame_being_written_is_not_returned(ring):
+    from spyglass.shared_frames import SLOT_HEADER
+    ring.write(1, b'frame1')
+    # The writer started to overwrite the slot with frame 5
+    SLOT_HEADER.pack_into(ring.buf, 1 * ring.stride, 5, 0, 6)
+    assert ring.read(1) is None
+    assert ring.read(5) is None
+
+
+def test_attach_to_ring(ring):
+    from spyglass.shared_frames import SharedFrameRing
+    ring.write(1, b'frame')
+    other = SharedFrameRing.attach(ring.name, ring.slots, ring.slot_size)
+    try:
+        assert other.read(1) == b'frame'
+    finally:
+        other.close()
+
+
+def test_writer_announces_frames_after_ready(ring):
+    import multiprocessing
+    from spyglass.shared_frames import ANNOUNCEMENT, SharedFrameWriter
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    writer = SharedFrameWriter(ring, sender)
+    writer.write(b'first')
+    writer.announce(('ready',))
+    writer.write(bytearray(b'second'))
+    assert receiver.recv() == ('ready',)
+    sequence, dropped = ANNOUNCEMENT.unpack(receiver.recv_bytes())
+    assert not receiver.poll()
+    assert ring.read(sequence) == b'second'
+    assert dropped == 0
+
+
+def test_writer_counts_oversized_frames_and_warns_once(ring, caplog):
+    import multiprocessing
+    from spyglass.shared_frames import ANNOUNCEMENT, SharedFrameWriter
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    writer = SharedFrameWriter(ring, sender)
+    writer.announce(('ready',))
+    writer.write(b'frame')
+    writer.write(b'x' * 2048)
+    writer.write(b'x' * 4096)
+    receiver.recv()
+    assert [ANNOUNCEMENT.unpack(receiver.recv_bytes()) for _ in range(3)] == [(1, 0), (1, 1), (1, 2)]
+    assert writer.dropped == 2
+    assert len([r for r in caplog.records if 'Dropping frames' in r.message]) == 1
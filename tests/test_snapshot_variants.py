@@ -0,0 +1,128 @@
+import io
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+
+def create_jpeg(width, height):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def get_size(jpeg):
+    from PIL import Image
+    return Image.open(io.BytesIO(jpeg)).size
+
+
+@pytest.mark.parametrize("path, expected", [
+    ('/snapshot', None),
+    ('/snapshot?width=320', ((None, 320, None))),
+    ('/snapshot?height=240', ((None, None, 240))),
+    ('/snapshot?crop=10,20,100,50&width=80', (((10, 20, 100, 50), 80, None))),
+])
+def test_parse_variant(path, expected):
+    from spyglass.snapshot_variants import parse_variant
+    variant = parse_variant(path)
+    assert (variant.key() if variant else None) == expected
+
+
+@pytest.mark.parametrize("path", [
+    '/snapshot?width=0',
+    '/snapshot?width=abc',
+    '/snapshot?crop=1,2,3',
+    '/snapshot?crop=0,0,0,10',
+    '/snapshot?crop=-1,0,10,10',
+])
+def test_parse_invalid_variant(path):
+    from spyglass.snapshot_variants import parse_variant
+    with pytest.raises(ValueError):
+        parse_variant(path)
+
+
+def test_create_resized_variant_keeps_aspect_ratio():
+    pytest.importorskip('PIL')
+    from spyglass.snapshot_variants import Variant, create_variant
+    assert get_size(create_variant(create_jpeg(640, 480), Variant(width=320))) == (320, 240)
+
+
+def test_create_cropped_variant():
+    pytest.importorskip('PIL')
+    from spyglass.snapshot_variants import Variant, create_variant
+    assert get_size(create_variant(create_jpeg(640, 480), Variant(crop=(100, 100, 200, 100)))) == (200, 100)
+
+
+def test_create_variant_with_crop_outside_of_image():
+    pytest.importorskip('PIL')
+    from spyglass.snapshot_variants import Variant, create_variant
+    with pytest.raises(ValueError):
+        create_variant(create_jpeg(640, 480), Variant(crop=(600, 0, 100, 100)))
+
+
+def test_create_variant_of_invalid_image():
+    pytest.importorskip('PIL')
+    from spyglass.snapshot_variants import Variant, create_variant
+    with pytest.raises(ValueError):
+        create_variant(b'\xff\xd8broken\xff\xd9', Variant(width=320))
+
+
+def test_variant_is_computed_once_per_frame(mocker):
+    from spyglass.frame_buffer import Frame
+    from spyglass.metrics import Metrics
+    from spyglass.snapshot_variants import Variant, VariantCache
+    create_variant = mocker.patch('spyglass.snapshot_variants.create_variant', return_value=b'\xff\xd8small\xff\xd9')
+    metrics = Metrics()
+    cache = VariantCache(metrics)
+    frame = Frame(b'\xff\xd8frame\xff\xd9', 1)
+
+    with ThreadPoolExecutor(10) as executor:
+        results = list(executor.map(lambda _: cache.get(frame, Variant(width=320)), range(10)))
+
+    assert create_variant.call_count == 1
+    assert all(result is results[0] for result in results)
+    assert results[0].data == b'\xff\xd8small\xff\xd9'
+    assert results[0].sequence == frame.sequence
+    assert (metrics.variant_hits, metrics.variant_misses) == (9, 1)
+
+    cache.get(Frame(b'\xff\xd8next\xff\xd9', 2), Variant(width=320))
+    assert create_variant.call_count == 2
+
+
+def test_variant_cache_is_bounded(mocker):
+    from spyglass.frame_buffer import Frame
+    from spyglass.metrics import Metrics
+    from spyglass.snapshot_variants import Variant, VariantCache
+    mocker.patch('spyglass.snapshot_variants.create_variant', return_value=b'x' * 40)
+    cache = VariantCache(Metrics(), max_bytes=100)
+    frame = Frame(b'\xff\xd8frame\xff\xd9', 1)
+
+    for width in (100, 200, 300):
+        cache.get(frame, Variant(width=width))
+
+    assert cache.size == 80
+    assert list(cache.variants) == [Variant(width=200), Variant(width=300)]
+
+
+def test_old_frame_variant_does_not_hold_the_cache(mocker):
+    import threading
+    from spyglass.frame_buffer import Frame
+    from spyglass.metrics import Metrics
+    from spyglass.snapshot_variants import Variant, VariantCache
+    started, resized = threading.Event(), threading.Event()
+
+    def create_variant(data, variant):
+        if data == b'old':
+            started.set()
+            resized.wait(5)
+        return b'small'
+    mocker.patch('spyglass.snapshot_variants.create_variant', side_effect=create_variant)
+    cache = VariantCache(Metrics())
+    new_frame = Frame(b'new', 2)
+    cache.get(new_frame, Variant(width=320))
+    with ThreadPoolExecutor(1) as executor:
+        old = executor.submit(cache.get, Frame(b'old', 1), Variant(width=320))
+        assert started.wait(5)
+        # Served from the cache while the old frame is resized
+        assert cache.get(new_frame, Variant(width=320)).sequence == 2
+        resized.set()
+        assert old.result(5).sequence == 1
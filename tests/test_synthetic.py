@@ -0,0 +1,120 @@
+import pytest
+from unittest.mock import MagicMock
+
+
+@pytest.fixture(autouse=True)
+def mock_libraries(mocker):
+    mocker.patch.dict('sys.modules', {
+        'libcamera': MagicMock(),
+        'picamera2': MagicMock(),
+    })
+
+
+def test_read_inserted_timestamp():
+    from spyglass.camera.synthetic import insert_timestamp, read_timestamp
+    jpeg = insert_timestamp(b'\xff\xd8\xff\xdbdata\xff\xd9', 1700000000.123456)
+    assert jpeg.startswith(b'\xff\xd8\xff\xfe')
+    assert jpeg.endswith(b'\xff\xdbdata\xff\xd9')
+    assert read_timestamp(jpeg) == 1700000000.123456
+
+
+def test_read_timestamp_of_other_frame():
+    from spyglass.camera.synthetic import read_timestamp
+    assert read_timestamp(b'\xff\xd8\xff\xdbdata\xff\xd9') is None
+
+
+def test_configure_with_image_files(tmp_path):
+    from spyglass.camera.synthetic import Synthetic
+    image_file = tmp_path / 'image.jpg'
+    image_file.write_bytes(b'\xff\xd8data\xff\xd9')
+    cam = Synthetic([str(image_file)])
+    cam.configure(640, 480, 30)
+    assert cam.fps == 30
+    assert cam.images == [b'\xff\xd8data\xff\xd9']
+
+
+def test_generate_images():
+    pytest.importorskip('PIL')
+    from spyglass.camera.synthetic import generate_images
+    images = generate_images(64, 48, 3)
+    assert len(set(images)) == 3
+    assert all(image.startswith(b'\xff\xd8') and image.endswith(b'\xff\xd9') for image in images)
+
+
+def test_lores_frames_are_produced_with_main_frames():
+    pytest.importorskip('PIL')
+    from spyglass.camera.synthetic import Synthetic, read_timestamp
+    cam = Synthetic()
+    cam.configure(64, 48, 30, lores_size=(32, 24))
+    cam.start()
+    try:
+        lores_frame = cam.lores_frame_buffer.get_latest_frame(timeout=5)
+    finally:
+        cam.stop()
+    assert lores_frame is not None
+    assert read_timestamp(lores_frame.data) is not None
+    assert len(cam.lores_images[0]) < len(cam.images[0])
+
+
+def test_reconfigure_keeps_frame_buffer_and_clients():
+    pytest.importorskip('PIL')
+    import io
+    from PIL import Image
+    from spyglass.camera.synthetic import Synthetic
+    cam = Synthetic()
+    cam.configure(64, 48, 30)
+    cam.start()
+    frame_buffer = cam.frame_buffer
+    try:
+        frame = frame_buffer.get_latest_frame(timeout=5)
+        assert cam.reconfigure({'width': 32, 'height': 24}) == {'width': 32, 'height': 24}
+        next_frame = frame_buffer.get_frame(frame.sequence, timeout=5)
+    finally:
+        cam.stop()
+    assert cam.frame_buffer is frame_buffer
+    assert next_frame.sequence > frame.sequence
+    assert Image.open(io.BytesIO(next_frame.data)).size == (32, 24)
+
+
+def test_motion_of_moving_bar_is_detected():
+    pytest.importorskip('PIL')
+    pytest.importorskip('numpy')
+    from spyglass.camera.synthetic import Synthetic
+    cam = Synthetic()
+    cam.enable_motion_detection(30, 25)
+    cam.configure(64, 48, 30)
+    cam.start()
+    try:
+        while cam.motion_detector.frames < 3:
+            cam.frame_buffer.get_frame(cam.frame_buffer.sequence, timeout=5)
+        frame = cam.frame_buffer.get_frame(cam.frame_buffer.sequence, timeout=5)
+    finally:
+        cam.stop()
+    assert cam.motion_detector.last_motion is not None
+    assert b'X-Motion: ' in frame.part[0]
+
+
+@pytest.mark.parametrize("server_mode", ['threaded', 'asyncio'])
+def test_controls_of_camera_without_controls(server_mode):
+    pytest.importorskip('PIL')
+    import json
+    import multiprocessing
+    import urllib.request
+    from spyglass.benchmark import find_free_port, run_server, wait_for_server
+    port = find_free_port()
+    server = multiprocessing.Process(
+        target=run_server, args=(port, 64, 48, 10, server_mode, None), daemon=True)
+    server.start()
+    try:
+        wait_for_server(port, 30)
+        url = f'http://127.0.0.1:{port}'
+        with urllib.request.urlopen(f'{url}/controls') as response:
+            assert b'Available camera options' in response.read()
+        with urllib.request.urlopen(f'{url}/api/controls') as response:
+            assert json.load(response) == {}
+        request = urllib.request.Request(f'{url}/api/controls', data=b'{}', method='POST')
+        with urllib.request.urlopen(request) as response:
+            assert json.load(response) == {'changed': {}, 'controls': {}}
+    finally:
+        server.terminate()
+        server.join()
@@ -0,0 +1,110 @@
+import pytest
+
+JPEG = b'\xff\xd8frame\xff\xd9'
+
+
+def write_frames(monkeypatch, frame_buffer, count, interval=0.5):
+    for i in range(count):
+        monkeypatch.setattr('time.time', lambda: 1000 + i * interval)
+        frame_buffer.write(JPEG)
+    monkeypatch.undo()
+
+
+def test_interval_timelapse(monkeypatch, tmp_path):
+    import os
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.timelapse import Timelapse
+    frame_buffer = FrameBuffer()
+    timelapse = Timelapse(frame_buffer, str(tmp_path))
+    timelapse.start(interval=2, name='print')
+    write_frames(monkeypatch, frame_buffer, 20)
+    status = timelapse.stop()
+    timelapse.writer.queue.join()
+
+    assert status['captured'] == 5
+    assert not status['running']
+    assert sorted(os.listdir(tmp_path / 'print')) == [f'frame{i:06d}.jpg' for i in range(5)]
+    assert (tmp_path / 'print' / 'frame000000.jpg').read_bytes() == JPEG
+    assert timelapse.status()['written'] == 5
+    assert frame_buffer.queues == set()
+
+
+def test_timelapse_with_existing_name_continues_numbering(monkeypatch, tmp_path):
+    import os
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.timelapse import Timelapse
+    frame_buffer = FrameBuffer()
+    timelapse = Timelapse(frame_buffer, str(tmp_path))
+    timelapse.start(interval=2, name='print')
+    write_frames(monkeypatch, frame_buffer, 8)
+    timelapse.stop()
+    timelapse.writer.queue.join()
+    (tmp_path / 'print' / 'notes.txt').write_text('')
+    # Frames already on disk, e.g. of a timelapse started before spyglass was restarted
+    frame_buffer = FrameBuffer()
+    timelapse = Timelapse(frame_buffer, str(tmp_path))
+    assert timelapse.start(interval=2, name='print')['first_index'] == 2
+    write_frames(monkeypatch, frame_buffer, 8)
+    status = timelapse.stop()
+    timelapse.writer.queue.join()
+
+    assert status['captured'] == 2
+    assert sorted(os.listdir(tmp_path / 'print')) == [f'frame{i:06d}.jpg' for i in range(4)] + ['notes.txt']
+
+
+def test_triggered_timelapse(tmp_path):
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.timelapse import Timelapse
+    frame_buffer = FrameBuffer()
+    frame_buffer.write(JPEG)
+    timelapse = Timelapse(frame_buffer, str(tmp_path))
+    with pytest.raises(ValueError):
+        timelapse.trigger()
+    timelapse.start()
+    frame_buffer.write(JPEG)
+    timelapse.trigger()
+    timelapse.trigger()
+    for _ in range(3):
+        frame_buffer.write(JPEG)
+    assert timelapse.status()['captured'] == 2
+    with pytest.raises(ValueError):
+        timelapse.start()
+
+
+def test_full_queue_drops_frames(tmp_path):
+    from unittest.mock import MagicMock
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.timelapse import Timelapse
+    frame_buffer = FrameBuffer()
+    writer = MagicMock()
+    writer.put.side_effect = [True, False, True, True]
+    timelapse = Timelapse(frame_buffer, str(tmp_path), writer=writer)
+    timelapse.start(name='print')
+    for _ in range(4):
+        timelapse.trigger()
+        frame_buffer.write(JPEG)
+    status = timelapse.status()
+    assert (status['captured'], status['dropped']) == (3, 1)
+    # The dropped frame leaves no gap in the file numbers
+    assert [c.args[1] for c in writer.put.call_args_list] == [0, 1, 1, 2]
+
+
+def test_invalid_timelapse_name(tmp_path):
+    from spyglass.frame_buffer import FrameBuffer
+    from spyglass.timelapse import Timelapse
+    with pytest.raises(ValueError):
+        Timelapse(FrameBuffer(), str(tmp_path)).start(name='../print')
+
+
+def test_write_batch_syncs_frames(mocker, tmp_path):
+    import os
+    from unittest.mock import MagicMock
+    from spyglass.frame_buffer import Frame
+    from spyglass.timelapse import write_batch
+    fsync = mocker.patch('os.fsync')
+    job = MagicMock(directory=str(tmp_path), written=0)
+    write_batch([(job, i, Frame(JPEG, i + 1, exif_header=b'\xff\xd8EXIF')) for i in range(3)])
+    assert job.written == 3
+    assert fsync.call_count == 4
+    assert sorted(os.listdir(tmp_path)) == ['frame000000.jpg', 'frame000001.jpg', 'frame000002.jpg']
+    assert (tmp_path / 'frame000002.jpg').read_bytes() == b'\xff\xd8EXIFframe\xff\xd9'
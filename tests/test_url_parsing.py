@@ -129,9 +129,32 @@ def test_check_params_match(expected_url, incoming_url, expected_output):
     ('/a?a=b',      '/b?b=c&d=e',   False),
     ('/a?a=b&c=d',  '/b?a=b',       False),
     ('/a?a=b&c=d',  '/b?a=b&c=d',   False),
-    ('/a?a=b&c=d',  '/b?c=d&a=b',   False)
+    ('/a?a=b&c=d',  '/b?c=d&a=b',   False),
+
+    ('/stream',         '/stream?fps=5',            True),
+    ('/?action=stream', '/?action=stream&fps=5',    True),
+    ('/?action=stream', '/?fps=5',                  False)
 ])
 def test_check_urls_match(expected_url, incoming_url, expected_output):
     from spyglass.url_parsing import check_urls_match
     match_value = check_urls_match(expected_url, incoming_url)
     assert match_value == expected_output
+
+
+@pytest.mark.parametrize("incoming_url, expected_route", [
+    ('/stream', 'stream'),
+    ('/stream/?fps=5', 'stream'),
+    ('/?action=stream', 'action-stream'),
+    ('/?action=snapshot&a=b', 'action-snapshot'),
+    ('/?a=b', None),
+    ('/snapshot', None),
+])
+def test_route_table_matches_like_check_urls_match(incoming_url, expected_route):
+    from spyglass.url_parsing import RouteTable, check_urls_match
+    urls = {'/stream': 'stream', '/?action=stream': 'action-stream', '/?action=snapshot': 'action-snapshot'}
+    routes = RouteTable()
+    for url, route in urls.items():
+        routes.add(url, route)
+    assert routes.match(incoming_url) == expected_route
+    matching = [route for url, route in urls.items() if check_urls_match(url, incoming_url)]
+    assert (matching[0] if matching else None) == expected_route